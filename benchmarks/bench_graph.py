@@ -0,0 +1,55 @@
+"""
+Character graphs: Graph.create_graph on synthetic people counts, and
+corpus-wide graphs merged from per doc partials.
+"""
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from pensieve.graph import Cooccurrence, Graph, merge_partials
+from pensieve.stats import EntityStats
+from conftest import BASE_PARAGRAPHS, N_DOCS
+from tests.helpers import paragraph_words
+
+N_PEOPLE = 200
+
+
+@pytest.fixture(scope='module')
+def people_stats(synthetic_corpus):
+    """
+    EntityStats of N_DOCS docs with a few people per paragraph, drawn
+    from a skewed cast like a novel's.
+    """
+    rng = random.Random(0)
+    cast = ['Person{}'.format(i) for i in range(N_PEOPLE)]
+    weights = [1./(i + 1) for i in range(N_PEOPLE)]
+    stats = EntityStats()
+    for doc_id in range(N_DOCS):
+        for par_id in range(BASE_PARAGRAPHS*synthetic_corpus['scale']):
+            people = Counter(rng.choices(cast, weights, k=rng.randint(0, 4)))
+            stats.add_paragraph(doc_id, par_id, paragraph_words(people=people))
+    return stats
+
+
+@pytest.mark.parametrize('n', [10, 50])
+def bench_create_graph(benchmark, synthetic_corpus, people_stats, n):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    book = SimpleNamespace(id=0, corpus=SimpleNamespace(stats=people_stats),
+                           words=people_stats.totals(doc_id=0))
+
+    def create():
+        graph = Graph(book)
+        graph.create_graph(n)
+        return graph
+    benchmark(create)
+
+
+def bench_corpus_graph(benchmark, synthetic_corpus, people_stats):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+
+    def create():
+        partials = [Cooccurrence.from_stats(people_stats, doc_id, block_size=50)
+                    for doc_id in range(N_DOCS)]
+        return merge_partials(partials).graph(50)
+    benchmark(create)
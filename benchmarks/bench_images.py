@@ -0,0 +1,26 @@
+"""
+Image lookups through ImageResolver, against a local stand-in for the
+Noun Project and Bing APIs.
+"""
+import pytest
+from pensieve.find_images import ImageResolver
+
+N_KEYTERMS = 200
+
+
+@pytest.mark.parametrize('n_workers', [1, 8])
+def bench_resolve_images(benchmark, image_stub, n_workers):
+    keyterms = ['keyterm{}'.format(i) for i in range(N_KEYTERMS)]
+    # A new resolver each round, so every keyterm is searched again
+    benchmark.pedantic(
+        lambda resolver: resolver.resolve(keyterms),
+        setup=lambda: ((ImageResolver(n_workers=n_workers, **image_stub),), {}),
+        rounds=3)
+
+
+def bench_resolve_cached_images(benchmark, image_stub, tmp_path):
+    keyterms = ['keyterm{}'.format(i) for i in range(N_KEYTERMS)]
+    cache_path = str(tmp_path / 'images.json')
+    resolver = ImageResolver(cache_path, **image_stub)
+    resolver.resolve(keyterms)
+    benchmark(resolver.resolve, keyterms)
@@ -0,0 +1,27 @@
+"""
+Mood scoring with a lexicon and Paragraph.extract_mood_weights.
+"""
+from pensieve.mood import Lexicon
+from conftest import make_corpus
+
+
+def bench_score_mood(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    lexicon = Lexicon.load(synthetic_corpus['lexicon'])
+    benchmark(lexicon.score, synthetic_corpus['texts'])
+
+
+def bench_extract_mood_weights_hp_corpus(benchmark, hp_corpus):
+    doc = hp_corpus.docs[0]
+    pars = doc.paragraphs[:len(doc.mood_table.weights)]
+    benchmark(lambda: [par.extract_mood_weights() for par in pars])
+
+
+def bench_extract_mood_weights(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    docs = make_corpus(synthetic_corpus).docs
+    # Score into the mood store once, the benchmark reads from it
+    for doc in docs:
+        doc.mood_table
+    pars = [par for doc in docs for par in doc.paragraphs]
+    benchmark(lambda: [par.extract_mood_weights() for par in pars])
@@ -0,0 +1,42 @@
+"""
+Memory serialization: dump_mem_to_json, the normalized MemoryBatch and
+the streaming MemoryWriter.
+"""
+import pytest
+from pensieve.json_dump import MemoryBatch, MemoryWriter, dump_mem_to_json
+from conftest import synthetic_mem_dicts
+
+
+@pytest.fixture(scope='module')
+def mem_dicts(synthetic_corpus):
+    return synthetic_mem_dicts(synthetic_corpus['texts'])
+
+
+def bench_dump_mem_to_json(benchmark, synthetic_corpus, mem_dicts):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    benchmark(lambda: [dump_mem_to_json(mem_dict) for mem_dict in mem_dicts])
+
+
+def bench_memory_batch(benchmark, synthetic_corpus, mem_dicts, tmp_path):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    path = str(tmp_path / 'memories.batch.json')
+
+    def save():
+        batch = MemoryBatch()
+        for mem_dict in mem_dicts:
+            batch.add(mem_dict)
+        batch.save(path)
+    benchmark(save)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def bench_memory_writer(benchmark, synthetic_corpus, mem_dicts, tmp_path,
+                        compression):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    path = str(tmp_path / 'memories.jsonl')
+
+    def write():
+        with MemoryWriter(path, compression=compression) as writer:
+            for mem_dict in mem_dicts:
+                writer.add(mem_dict)
+    benchmark(write)
@@ -0,0 +1,67 @@
+"""
+spaCy parsing, entity extraction, each Paragraph.extract_* accessor and
+find_character_paragraphs. These need spaCy and its English model.
+"""
+import pytest
+from conftest import CHARACTER, make_corpus, needs_spacy
+from pensieve.extract import extract_entities
+
+pytestmark = needs_spacy
+
+EXTRACTORS = ['extract_times', 'extract_activities', 'extract_people',
+              'extract_places', 'extract_things']
+
+
+def _unparsed(synthetic):
+    return (make_corpus(synthetic).docs,), {}
+
+
+def _parse(docs):
+    return [doc.parse() for doc in docs]
+
+
+def _parsed_paragraphs(synthetic):
+    docs = make_corpus(synthetic).docs
+    return [par for doc in docs for par in doc.parse()]
+
+
+def bench_parse(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    benchmark.pedantic(_parse, setup=lambda: _unparsed(synthetic_corpus),
+                       rounds=1)
+
+
+def bench_extract_entities(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    pars = _parsed_paragraphs(synthetic_corpus)
+    profile = pars[0].doc.profile if pars else None
+    benchmark.pedantic(lambda: [extract_entities(par.spacy_doc, profile)
+                                for par in pars],
+                       rounds=3)
+
+
+@pytest.mark.parametrize('method', EXTRACTORS)
+def bench_extract(benchmark, synthetic_corpus, method):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    pars = _parsed_paragraphs(synthetic_corpus)
+    # The accessors read the cached Entities record, which is built once
+    # here so only the accessor itself is timed
+    for par in pars:
+        par.entities
+    benchmark.pedantic(lambda: [getattr(par, method)() for par in pars],
+                       rounds=3)
+
+
+def bench_find_character_paragraphs(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    docs = make_corpus(synthetic_corpus).docs
+    for doc in docs:
+        doc.parse()
+
+    def setup():
+        for doc in docs:
+            doc._mention_index = None
+        return (), {}
+    benchmark.pedantic(lambda: [doc.find_character_paragraphs(CHARACTER)
+                                for doc in docs],
+                       setup=setup, rounds=3)
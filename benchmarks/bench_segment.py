@@ -0,0 +1,29 @@
+"""
+Paragraph segmentation, Doc.paragraphs, from the raw text files.
+"""
+import pensieve
+from conftest import HP_CORPUS, HP_MOOD_DIR, make_corpus
+
+
+def _fresh_docs(corpus_dir, **kwargs):
+    corpus = pensieve.Corpus(corpus_dir, **kwargs)
+    return (corpus.docs,), {}
+
+
+def _segment(docs):
+    return sum(len(doc.paragraphs) for doc in docs)
+
+
+def bench_segment_hp_corpus(benchmark):
+    n = benchmark.pedantic(
+        _segment, setup=lambda: _fresh_docs(HP_CORPUS, mood_dir=HP_MOOD_DIR),
+        rounds=3)
+    assert n > 0
+
+
+def bench_segment_synthetic(benchmark, synthetic_corpus):
+    benchmark.extra_info['scale'] = synthetic_corpus['scale']
+    n = benchmark.pedantic(
+        _segment, setup=lambda: ((make_corpus(synthetic_corpus).docs,), {}),
+        rounds=3)
+    assert n > 0
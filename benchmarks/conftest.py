@@ -0,0 +1,150 @@
+"""
+Fixtures of the benchmark suite: the Harry Potter corpus, synthetic
+corpora scaled from it, a synthetic lexicon and a local stand-in for the
+image search APIs, so everything runs offline.
+
+PENSIEVE_BENCH_SCALES sets the synthetic corpus scales, e.g. '1,5,10,50'.
+"""
+import functools
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+from collections import Counter
+
+import pytest
+
+import pensieve
+from tests.helpers import serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HP_CORPUS = os.path.join(ROOT, 'hp_corpus')
+HP_MOOD_DIR = os.path.join(ROOT, 'mood_files')
+SCALES = [int(scale) for scale in
+          os.environ.get('PENSIEVE_BENCH_SCALES', '1,5,10,50').split(',')]
+# Paragraphs per doc of the 1x synthetic corpus
+BASE_PARAGRAPHS = 200
+N_DOCS = 2
+CHARACTER = ['Harry', 'Potter']
+
+needs_spacy = pytest.mark.skipif(importlib.util.find_spec('spacy') is None,
+                                 reason='spaCy is not installed')
+
+
+@functools.lru_cache()
+def hp_paragraphs():
+    corpus = pensieve.Corpus(HP_CORPUS, mood_dir=HP_MOOD_DIR)
+    return [text.strip() for doc in corpus.docs
+            for text in doc.paragraph_texts if text.strip()]
+
+
+def sample_paragraphs(n, seed=0):
+    """
+    n paragraphs drawn from the Harry Potter books, repeatable by seed.
+    """
+    texts = hp_paragraphs()
+    rng = random.Random(seed)
+    return [rng.choice(texts) for _ in range(n)]
+
+
+def write_lexicon(path, texts, n_words=300):
+    """
+    Write an NRC style lexicon associating the most common words of the
+    texts with the emotions in turn.
+    """
+    from pensieve.mood import EMOTIONS, STRIP
+    counts = Counter(STRIP.sub('', word).lower()
+                     for text in texts for word in text.split())
+    with io.open(path, 'w', encoding='utf-8') as f:
+        for i, (word, _) in enumerate(counts.most_common(n_words)):
+            if word:
+                f.write(u'{}\t{}\t1\n'.format(word, EMOTIONS[i % len(EMOTIONS)]))
+    return path
+
+
+@pytest.fixture(scope='session')
+def hp_corpus():
+    return pensieve.Corpus(HP_CORPUS, mood_dir=HP_MOOD_DIR)
+
+
+@pytest.fixture(scope='session', params=SCALES, ids=lambda s: '{}x'.format(s))
+def synthetic_corpus(request, tmp_path_factory):
+    """
+    Corpus of N_DOCS books of scale*BASE_PARAGRAPHS sampled paragraphs,
+    with a synthetic lexicon so moods are scored locally.
+    """
+    scale = request.param
+    corpus_dir = tmp_path_factory.mktemp('corpus_{}x'.format(scale))
+    texts = sample_paragraphs(N_DOCS*BASE_PARAGRAPHS*scale)
+    per_doc = BASE_PARAGRAPHS*scale
+    for i in range(N_DOCS):
+        path = corpus_dir / 'book{}.txt'.format(i + 1)
+        path.write_text(u'\n'.join(texts[i*per_doc:(i + 1)*per_doc]) + u'\n',
+                        encoding='utf-8')
+    lexicon = write_lexicon(str(tmp_path_factory.mktemp('lexicon') / 'nrc.txt'),
+                            texts)
+    return {'scale': scale,
+            'corpus_dir': str(corpus_dir),
+            'lexicon': lexicon,
+            'texts': texts}
+
+
+def make_corpus(synthetic):
+    return pensieve.Corpus(synthetic['corpus_dir'],
+                           lexicon=synthetic['lexicon'])
+
+
+def synthetic_mem_dicts(texts, seed=0):
+    """
+    mem_dicts shaped like Paragraph.gen_mem_dict output, one per text.
+    """
+    rng = random.Random(seed)
+    names = ['Ron', 'Hermione', 'Dumbledore', 'Hagrid', 'Snape', 'Neville']
+    places = ['Hogwarts', 'Diagon Alley', 'the Burrow', 'Hogsmeade']
+    mem_dicts = []
+    for text in texts:
+        words = re.findall(r'[a-z]{4,}', text)
+        mem_dicts.append(
+            {'people': rng.sample(names, 2),
+             'places': rng.sample(places, 1),
+             'activities': words[:3],
+             'things': words[3:6],
+             'mood_words': words[6:8],
+             'mood_weight': dict(pensieve.json_dump.DEFAULT_MOOD_WEIGHTS,
+                                 joy=rng.random()),
+             'img_url': '',
+             'narrative': text})
+    return mem_dicts
+
+
+@pytest.fixture(scope='session')
+def image_stub():
+    """
+    Local HTTP server answering Noun Project and Bing searches.
+    """
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.startswith('/np/icons/'):
+                query = url.path[len('/np/icons/'):]
+                body = {'icons': [{'preview_url': 'np/' + query}]}
+            else:
+                query = parse_qs(url.query)['q'][0]
+                body = {'value': [{'contentUrl': 'bing/' + query}]}
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    with serve(Handler) as root:
+        yield {'np_url': root + '/np', 'np_auth': ('key', 'secret'),
+               'bing_url': root + '/bing', 'bing_key': 'key'}
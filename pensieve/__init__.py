@@ -1,5 +1,32 @@
+import importlib
+
+from .version import __version__
 from .pensieve import *
-from .image import *
-from .find_images import *
 from .json_dump import *
-from .graph import *
\ No newline at end of file
+from .instrument import Instrumentation
+
+# The image, search and graph subsystems pull in boto3, PIL, requests,
+# networkx and matplotlib, and the searches need API secrets. They are
+# only imported when one of their names is first used.
+_LAZY_NAMES = {'NLP': 'pensieve',
+               'upload_image': 'image',
+               'upload_images': 'image',
+               'get_secret': 'find_images',
+               'load_secret': 'find_images',
+               'search_bing_for_image': 'find_images',
+               'search_np_for_image': 'find_images',
+               'store_best': 'find_images',
+               'view': 'find_images',
+               'Graph': 'graph',
+               'Cooccurrence': 'graph',
+               'Timeline': 'graph',
+               'corpus_partials': 'graph',
+               'merge_partials': 'graph'}
+
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        module = importlib.import_module('.'+_LAZY_NAMES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import threading
+from .profiles import get_profile
+from .version import __version__
+
+# Entries are kept in cache_dir/NAMESPACE/<fingerprint>, nothing outside
+# NAMESPACE is ever touched
+NAMESPACE = 'pensieve-parse'
+# Written in every entry directory, marks it as owned by the cache and
+# names the profile of its entries
+MARKER = 'PENSIEVE_PARSE_CACHE'
+
+
+def model_fingerprint(nlp, profile):
+    """
+    Identify the spaCy model, the extraction profile (its pipeline and
+    extractors), the spaCy release and the pensieve release that
+    produced a parse.
+
+    Args:
+        nlp: spaCy Language object
+        profile: Profile object
+
+    Returns:
+        fingerprint: short hex string
+    """
+    import spacy
+    meta = nlp.meta
+    parts = [meta.get('lang', ''), meta.get('name', ''),
+             meta.get('version', ''), ','.join(nlp.pipe_names),
+             repr(tuple(profile)), spacy.__version__, __version__]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class ParseCache(object):
+
+    def __init__(self, cache_dir, nlp, max_size=None, profile=None,
+                 fingerprint=None):
+        """
+        On-disk cache of parsed paragraphs
+
+        Each entry holds the spaCy binary serialization of a paragraph
+        and the Entities record extracted from it, keyed by a hash of
+        the paragraph text. Entries live in a directory named after the
+        model fingerprint, which includes the extraction profile, so
+        each profile keeps its own entries. Entries of the same profile
+        made by another spaCy model, spaCy release or pensieve release
+        are never read and are removed when the cache is opened. The
+        cache only writes and removes under cache_dir/NAMESPACE, so
+        cache_dir can be shared.
+
+        Args:
+            cache_dir: directory to keep the cache in
+            nlp: spaCy Language object used for parsing
+            profile: extraction profile name or Profile the entries are
+                     made with [default: None]
+            max_size: maximum size of the cache in bytes. Least recently
+                      used entries are evicted past this size. If None,
+                      the cache is unbounded [default: None]
+            fingerprint: fingerprint the entries are kept under. If
+                         None, the model_fingerprint of nlp and profile
+                         [default: None]
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.nlp = nlp
+        self.max_size = max_size
+        self.profile = get_profile(profile)
+        if fingerprint is None:
+            fingerprint = model_fingerprint(nlp, self.profile)
+        self.fingerprint = fingerprint
+        self.root = os.path.join(self.cache_dir, NAMESPACE)
+        self.entry_dir = os.path.join(self.root, self.fingerprint)
+        if not os.path.isdir(self.entry_dir):
+            os.makedirs(self.entry_dir)
+        self._write_marker()
+        self.invalidate_stale()
+        self.size = self._disk_size()
+
+    def invalidate_stale(self):
+        """
+        Remove entries of this profile made with a different model
+        fingerprint. Other profiles' entries are kept.
+        """
+        remove_stale(self.root, self.fingerprint, self.profile.name)
+
+    def _write_marker(self):
+        with open(os.path.join(self.entry_dir, MARKER), 'w') as f:
+            json.dump({'profile': self.profile.name,
+                       'fingerprint': self.fingerprint}, f)
+
+    def key(self, text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, text):
+        key = self.key(text)
+        return os.path.join(self.entry_dir, key[:2], key+'.bin')
+
+    def get(self, text):
+        """
+        Look up a paragraph in the cache.
+
+        Args:
+            text: paragraph text
+
+        Returns:
+            entry: (spacy_doc, entities) tuple, or None on a miss
+        """
+        from spacy.tokens import Doc as SpacyDoc
+        path = self.path(text)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            spacy_doc = SpacyDoc(self.nlp.vocab).from_bytes(entry['doc'])
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # Unreadable entry, drop it and parse again
+            self._remove(path)
+            return None
+        # Mark entry as recently used
+        os.utime(path, None)
+        return spacy_doc, entry['entities']
+
+    def put(self, text, spacy_doc, entities):
+        """
+        Store a parsed paragraph in the cache.
+
+        Args:
+            text: paragraph text
+            spacy_doc: spaCy Doc object for text
+            entities: Entities record extracted from spacy_doc
+        """
+        path = self.path(text)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = pickle.dumps({'doc': spacy_doc.to_bytes(),
+                             'entities': entities},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        # Workers parsing the same text must not share a temp file
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                        threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is back
+        under 90% of max_size.
+        """
+        # Other processes write to the cache too, so the size this one
+        # tracked is refreshed from disk first
+        self.size = self._disk_size()
+        if self.size <= self.max_size:
+            return
+        target = 0.9*self.max_size
+        entries = sorted((os.path.getmtime(path), path)
+                         for path in self._entry_paths())
+        for mtime, path in entries:
+            if self.size <= target:
+                break
+            self._remove(path)
+
+    def clear(self):
+        shutil.rmtree(self.entry_dir, ignore_errors=True)
+        os.makedirs(self.entry_dir)
+        self._write_marker()
+        self.size = 0
+
+    def _disk_size(self):
+        size = 0
+        for path in self._entry_paths():
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                # Evicted by another process meanwhile
+                pass
+        return size
+
+    def _entry_paths(self):
+        for root, dirs, files in os.walk(self.entry_dir):
+            for name in files:
+                if name.endswith('.bin'):
+                    yield os.path.join(root, name)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.size -= size
+        except OSError:
+            pass
+
+
+def remove_stale(root, fingerprint, profile):
+    """
+    Remove the entry directories of a profile with another fingerprint
+    in a cache root. Only directories whose marker names the profile are
+    removed.
+
+    Args:
+        root: cache_dir/NAMESPACE directory
+        fingerprint: fingerprint of the entries to keep
+        profile: name of the profile
+    """
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name == fingerprint or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, MARKER)) as f:
+                marker = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if isinstance(marker, dict) and marker.get('profile') == profile:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,110 @@
+from __future__ import unicode_literals
+import string
+from collections import namedtuple
+from .profiles import get_profile
+
+TIME_TYPES = ('DATE', 'TIME', 'EVENT')
+PERSON_TYPES = ('PERSON',)
+PLACE_TYPES = ('LOC', 'GPE', 'FACILITY')
+THING_TYPES = ('ORG', 'NORP', 'WORK_OF_ART', 'PRODUCT')
+ENTITY_TYPES = TIME_TYPES + PERSON_TYPES + PLACE_TYPES + THING_TYPES
+
+
+class Entities(namedtuple('Entities', ['times', 'people', 'places',
+                                       'things', 'verbs', 'keyterms'])):
+    """
+    Everything extracted from a parsed paragraph, as tuples of strings
+
+    Attributes:
+        times: times mentioned in the text
+        people: names of people, possessives removed
+        places: places mentioned in the text
+        things: named objects followed by noun chunks
+        verbs: lemmas of the main verbs, highest rank first
+        keyterms: (keyterm, rank) pairs from textrank, highest rank
+                  first
+    """
+    __slots__ = ()
+
+
+Entities.__new__.__defaults__ = ((),)
+
+
+def extract_entities(spacy_doc, profile=None):
+    """
+    Extract times, people, places, things and verbs from a spaCy Doc,
+    walking the named entities and the noun chunks once each. The
+    extraction profile decides which extractors run.
+
+    Args:
+        spacy_doc: spaCy Doc object
+        profile: profile name or Profile. If None, the default
+                 profile is used [default: None]
+
+    Returns:
+        entities: Entities record
+    """
+    import spacy
+    import textacy
+    profile = get_profile(profile)
+    times, people, places, things = [], [], [], []
+    for ent in textacy.extract.named_entities(spacy_doc,
+                                              include_types=ENTITY_TYPES):
+        label = ent.label_
+        if label in TIME_TYPES:
+            times.append(ent.text)
+        elif label in PERSON_TYPES:
+            name = _clean_person(ent)
+            if name is not None:
+                people.append(name)
+        elif label in PLACE_TYPES:
+            places.append(ent.text)
+        else:
+            things.append(ent.text.strip())
+    # Get noun chunks
+    if profile.things:
+        for nch in textacy.extract.noun_chunks(spacy_doc, drop_determiners=True):
+            if len(nch) == 1 and nch[0].pos == spacy.parts_of_speech.PRON:
+                continue
+            things.append(nch.text.strip())
+    verbs = []
+    if profile.activities:
+        verb_ranking = [(x, x.rank) for x in textacy.spacy_utils.get_main_verbs_of_sent(spacy_doc)]
+        verbs = [verb.lemma_ for verb, rank in sorted(verb_ranking,
+                                                      key=lambda x: -x[1])]
+    keyterms = []
+    if profile.keyterms:
+        keyterms = textacy.keyterms.textrank(spacy_doc)
+    return Entities(times=tuple(times),
+                    people=tuple(people),
+                    places=tuple(places),
+                    things=tuple(things),
+                    verbs=tuple(verbs),
+                    keyterms=tuple(keyterms))
+
+
+def _clean_person(name):
+    # Exclude words too short to be names and strange characters
+    if len(name.text) < 3:
+        return None
+    # objects should not be people
+    if name.doc[name.start - 1].text in ('the', 'a', 'an'):
+        return None
+    # Handle possessives
+    if name.text[-2] not in string.ascii_lowercase:
+        return name.text[:-2]
+    return name.text
+
+
+def top_activities(verbs, n_verbs=5):
+    """
+    Keep the lowercase lemmas among the n_verbs highest ranked verbs.
+
+    Args:
+        verbs: verb lemmas, highest rank first
+        n_verbs: number of verbs to consider
+
+    Returns: List of strings representing verbs
+    """
+    return [verb for verb in verbs[:n_verbs]
+            if verb[0] in string.ascii_lowercase]
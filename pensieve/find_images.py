@@ -1,10 +1,13 @@
 import os
 import json
+import threading
+import time
 import requests
-from PIL import Image
 import urllib
-from .image import upload_image
-from requests_oauthlib import OAuth1
+from .image import upload_images
+
+BING_URL = 'https://api.cognitive.microsoft.com/bing/v5.0/images/search'
+NP_URL = 'http://api.thenounproject.com'
 
 
 def get_secret(service):
@@ -28,15 +31,39 @@ def load_secret(service):
     secret = json.load(open(pth))
     return secret
 
-BING_API_KEY = load_secret('bing')
-NP_API_KEY, NP_API_SECRET = load_secret('noun_project')
+_SECRETS = {}
+
+
+def cached_secret(service):
+    """Load secrets for a service the first time they are needed."""
+    if service not in _SECRETS:
+        _SECRETS[service] = load_secret(service)
+    return _SECRETS[service]
+
 
-def search_bing_for_image(query):
+def __getattr__(name):
+    # The API keys used to be read at import time
+    if name == 'BING_API_KEY':
+        return cached_secret('bing')
+    if name in ('NP_API_KEY', 'NP_API_SECRET'):
+        key, secret = cached_secret('noun_project')
+        return key if name == 'NP_API_KEY' else secret
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
+
+def search_bing_for_image(query, session=None, url=BING_URL, key=None,
+                          timeout=None):
     """
     Perform a Bing image search.
 
     Args:
         query: Image search query
+        session: requests Session to reuse connections. If None, a new
+                 connection is made [default: None]
+        url: Bing image search endpoint [default: BING_URL]
+        key: Bing API key. If None, read from the secrets store
+             [default: None]
+        timeout: request timeout in seconds [default: None]
 
     Returns:
         results: List of urls from results
@@ -44,51 +71,240 @@ def search_bing_for_image(query):
     search_params = {'q': query,
                      'mkt': 'en-us',
                      'safeSearch': 'strict'}
-    auth = {'Ocp-Apim-Subscription-Key': BING_API_KEY}
-    url = 'https://api.cognitive.microsoft.com/bing/v5.0/images/search'
-    r = requests.get(url, params=search_params, headers=auth)
+    if key is None:
+        key = cached_secret('bing')
+    auth = {'Ocp-Apim-Subscription-Key': key}
+    r = (session or requests).get(url, params=search_params, headers=auth,
+                                  timeout=timeout)
+    r.raise_for_status()
     results = r.json()['value']
     urls = [result['contentUrl'] for result in results]
     return urls
 
-def search_np_for_image(query):
+def search_np_for_image(query, session=None, url=NP_URL, auth=None,
+                        timeout=None):
     """
     Perform a Noun Project image search.
 
     Args:
         query: Image search query
+        session: requests Session to reuse connections. If None, a new
+                 connection is made [default: None]
+        url: Noun Project API root [default: NP_URL]
+        auth: requests auth. If None, OAuth1 with the key and secret
+              from the secrets store [default: None]
+        timeout: request timeout in seconds [default: None]
 
     Returns:
         results: List of image result JSON dicts
     """
-    auth = OAuth1(NP_API_KEY, NP_API_SECRET)
-    endpoint = 'http://api.thenounproject.com/icons/{}'.format(query)
+    if auth is None:
+        from requests_oauthlib import OAuth1
+        np_api_key, np_api_secret = cached_secret('noun_project')
+        auth = OAuth1(np_api_key, np_api_secret)
+    endpoint = '{}/icons/{}'.format(url.rstrip('/'), query)
     params = {'limit_to_public_domain': 1,
               'limit': 5}
-    response = requests.get(endpoint, params=params, auth=auth)
+    response = (session or requests).get(endpoint, params=params, auth=auth,
+                                         timeout=timeout)
+    response.raise_for_status()
     urls = [icon['preview_url'] for icon in response.json()['icons']]
     return urls
 
-def store_best(search_results, n=1):
+def search_for_image(query, **kwargs):
+    """
+    Find an image for a query on the Noun Project, falling back to Bing.
+
+    Args:
+        query: Image search query
+        kwargs: session and timeout for both searches, plus np_url,
+                np_auth, bing_url and bing_key
+
+    Returns:
+        url: url of the first result, '' if neither search found one
+    """
+    session = kwargs.get('session')
+    timeout = kwargs.get('timeout')
+    try:
+        urls = search_np_for_image(query, session=session,
+                                   url=kwargs.get('np_url', NP_URL),
+                                   auth=kwargs.get('np_auth'),
+                                   timeout=timeout)
+    except Exception:
+        urls = []
+    if not urls:
+        urls = search_bing_for_image(query, session=session,
+                                     url=kwargs.get('bing_url', BING_URL),
+                                     key=kwargs.get('bing_key'),
+                                     timeout=timeout)
+    return urls[0] if urls else ''
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        """
+        Spaces calls out to at most rate per second, across threads
+
+        Args:
+            rate: calls per second. If None, calls are not limited
+        """
+        self.interval = 1./rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next = 0.
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ImageResolver(object):
+
+    def __init__(self, cache_path=None, n_workers=8, rate=None,
+                 retries=3, backoff=0.5, timeout=10., np_url=NP_URL,
+                 np_auth=None, bing_url=BING_URL, bing_key=None):
+        """
+        Resolves search keyterms to image urls, concurrently and through
+        a persistent keyterm -> url cache
+
+        Args:
+            cache_path: JSON file of resolved keyterms. If None, results
+                        are only kept in memory [default: None]
+            n_workers: number of concurrent searches [default: 8]
+            rate: maximum searches per second. If None, searches are not
+                  limited [default: None]
+            retries: retries of connection errors and 429/5xx responses,
+                     with exponential backoff [default: 3]
+            backoff: backoff factor of the retries in seconds
+                     [default: 0.5]
+            timeout: request timeout in seconds [default: 10.]
+            np_url: Noun Project API root [default: NP_URL]
+            np_auth: Noun Project requests auth. If None, read from the
+                     secrets store [default: None]
+            bing_url: Bing image search endpoint [default: BING_URL]
+            bing_key: Bing API key. If None, read from the secrets
+                      store [default: None]
+
+        Attributes:
+            cache: dict of keyterm -> url, '' for keyterms without image
+        """
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.cache_path = cache_path
+        self.n_workers = n_workers
+        self.limiter = RateLimiter(rate)
+        self.search_kwargs = {'timeout': timeout,
+                              'np_url': np_url,
+                              'np_auth': np_auth,
+                              'bing_url': bing_url,
+                              'bing_key': bing_key}
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=n_workers,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = self._read_cache()
+
+    def _read_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path, 'r') as f:
+            return json.load(f)
+
+    def save(self):
+        """
+        Write the cache, merged with what other processes wrote since it
+        was read.
+        """
+        if self.cache_path is None:
+            return
+        cache = self._read_cache()
+        cache.update(self.cache)
+        self.cache = cache
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def search(self, keyterm):
+        """
+        Search for one keyterm, bypassing the cache.
+        """
+        self.limiter.wait()
+        return search_for_image(keyterm, session=self.session,
+                                **self.search_kwargs)
+
+    def resolve(self, keyterms):
+        """
+        Find an image url for every keyterm. Each distinct keyterm is
+        looked up in the cache, and the misses are searched concurrently.
+        Keyterms whose search failed are left out of the cache and
+        resolve to ''.
+
+        Args:
+            keyterms: iterable of keyterms, None is resolved to ''
+
+        Returns:
+            urls: dict of keyterm -> url
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        keyterms = set(keyterm for keyterm in keyterms
+                       if keyterm is not None)
+        misses = sorted(keyterm for keyterm in keyterms
+                        if keyterm not in self.cache)
+        urls = {None: ''}
+        if misses:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                futures = [(keyterm, pool.submit(self.search, keyterm))
+                           for keyterm in misses]
+                for keyterm, future in futures:
+                    try:
+                        self.cache[keyterm] = future.result()
+                    except Exception as e:
+                        print('Image search for {} failed: {}'
+                              .format(keyterm, e))
+                        urls[keyterm] = ''
+            self.save()
+        for keyterm in keyterms:
+            if keyterm in self.cache:
+                urls[keyterm] = self.cache[keyterm]
+        return urls
+
+    def close(self):
+        self.session.close()
+
+
+def store_best(search_results, n=1, storage=None):
     """
     Store the top n results from a search in S3 bucket.
 
     Args:
         search_results: list of search result JSON dicts
         n: number of results to store
+        storage: storage backend. If None, the default S3 bucket
+                 [default: None]
 
     Returns:
         urls: urls of images
         success: list of S3 upload success states
         full_key_names: list of uuids to store in imageURL
     """
-    urls, success, full_key_names = [], [], []
-    for i, result in enumerate(search_results):
-        if i >= n:
-            break
-        urls.append(result['contentUrl'])
-    for url in urls:
-        s, fkn = upload_image(url)
+    urls = [result['contentUrl'] for result in search_results[:n]]
+    success, full_key_names = [], []
+    for s, fkn in upload_images(urls, storage=storage):
         success.append(s)
         full_key_names.append(fkn)
     return urls, success, full_key_names
@@ -104,6 +320,7 @@ def view(urls):
     Returns:
         None
     """
+    from PIL import Image
     for i, url in enumerate(urls):
         resp = requests.get(url)
         dat = urllib.request.urlopen(resp.url)
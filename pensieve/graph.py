@@ -1,66 +1,608 @@
+import hashlib
+import json
+import os
 import networkx as nx
 import numpy as np
-import matplotlib.pyplot as plt
-import pylab
-import pensieve
 from collections import Counter
-import math
+
+# Graphs with more nodes than this get the spectral layout by default
+LARGE_GRAPH = 500
+EXPORT_FORMATS = ('.gexf', '.graphml', '.json')
+RENDER_FORMATS = ('.png', '.svg', '.pdf')
+
+
+def cooccurrence(matrix):
+    """
+    Pairwise co-occurrence weights of the columns of a paragraph x
+    person count matrix: for each pair, the sum over the paragraphs
+    mentioning both of twice their combined mentions, which is how
+    Graph.create_graph has always counted them.
+
+    Args:
+        matrix: scipy.sparse matrix of counts, one row per paragraph
+
+    Returns:
+        weights: scipy.sparse CSR matrix, symmetric with an empty
+                 diagonal
+    """
+    import scipy.sparse
+    matrix = scipy.sparse.csr_matrix(matrix)
+    present = (matrix > 0).astype(matrix.dtype)
+    # shared[i, j]: mentions of i in the paragraphs that mention j
+    shared = (matrix.T @ present).tocsr()
+    weights = 2*(shared + shared.T)
+    weights.setdiag(0)
+    weights.eliminate_zeros()
+    return weights.tocsr()
+
+
+def _reindex(matrix, columns, size):
+    # Move the rows and columns of a square sparse matrix to new indices
+    import scipy.sparse
+    coo = scipy.sparse.coo_matrix(matrix)
+    return scipy.sparse.csr_matrix((coo.data, (columns[coo.row], columns[coo.col])),
+                                   shape=(size, size))
+
+
+class Cooccurrence(object):
+
+    def __init__(self, people, mentions, weights, n_paragraphs=0,
+                 block_size=None, block_mentions=None, block_weights=None):
+        """
+        People mentions and pair co-occurrence weights over some
+        paragraphs
+
+        Partials of different docs are combined with merge, which is
+        associative and commutative, so they can be computed in any
+        order and in parallel. Optional per block partials, one per
+        block_size paragraphs, feed a Timeline.
+
+        Args:
+            people: list of names, the index of the arrays
+            mentions: int array of the mentions of each person
+            weights: sparse pair weights, see cooccurrence
+            n_paragraphs: number of paragraphs covered [default: 0]
+            block_size: paragraphs per block [default: None]
+            block_mentions: list of mentions arrays, one per block
+                            [default: None]
+            block_weights: list of sparse weights, one per block
+                           [default: None]
+        """
+        self.people = list(people)
+        self.mentions = np.asarray(mentions)
+        self.weights = weights
+        self.n_paragraphs = n_paragraphs
+        self.block_size = block_size
+        self.block_mentions = block_mentions or []
+        self.block_weights = block_weights or []
+
+    @classmethod
+    def from_stats(cls, stats, doc_id, n_paragraphs=None, block_size=None):
+        """
+        Partial of one doc from its per paragraph people counts.
+
+        Args:
+            stats: EntityStats holding the doc
+            doc_id: id of the doc
+            n_paragraphs: number of paragraphs of the doc, needed for
+                          the trailing blocks [default: None]
+            block_size: also keep partials of every block_size
+                        paragraphs [default: None]
+
+        Returns:
+            partial: Cooccurrence object
+        """
+        from .stats import CATEGORIES
+        doc, par, cat, ent, count = stats.arrays()
+        mask = (doc == doc_id) & (cat == CATEGORIES.index('people'))
+        people = [stats.strings[i] for i in np.unique(ent[mask])]
+        _, par, counts = stats.paragraph_matrix('people', people, doc_id)
+        if n_paragraphs is None:
+            n_paragraphs = int(par.max()) + 1 if len(par) else 0
+        mentions = np.asarray(counts.sum(axis=0)).ravel()
+        partial = cls(people, mentions, cooccurrence(counts), n_paragraphs,
+                      block_size)
+        if block_size:
+            blocks = par // block_size
+            for block in range(-(-n_paragraphs // block_size)):
+                rows = np.flatnonzero(blocks == block)
+                partial.block_mentions.append(
+                    np.asarray(counts[rows].sum(axis=0)).ravel())
+                partial.block_weights.append(cooccurrence(counts[rows]))
+        return partial
+
+    def merge(self, other):
+        """
+        Totals of two partials, over the union of their people. Blocks
+        are not merged, use a Timeline to follow blocks across docs.
+
+        Returns:
+            partial: new Cooccurrence object
+        """
+        people = list(self.people)
+        index = dict((name, i) for i, name in enumerate(people))
+        for name in other.people:
+            if name not in index:
+                index[name] = len(people)
+                people.append(name)
+        mine = np.arange(len(self.people))
+        theirs = np.array([index[name] for name in other.people], dtype=np.int64)
+        mentions = np.zeros(len(people), dtype=np.int64)
+        mentions[mine] += self.mentions.astype(np.int64)
+        mentions[theirs] += other.mentions.astype(np.int64)
+        weights = (_reindex(self.weights, mine, len(people))
+                   + _reindex(other.weights, theirs, len(people)))
+        return Cooccurrence(people, mentions, weights,
+                            self.n_paragraphs + other.n_paragraphs)
+
+    def top(self, n):
+        """
+        The n most mentioned people, most mentioned first.
+        """
+        order = np.argsort(-self.mentions, kind='stable')[:n]
+        return [self.people[i] for i in order]
+
+    def select(self, people):
+        """
+        Mentions and dense weights of some people.
+
+        Args:
+            people: list of names
+
+        Returns:
+            mentions: int array, zero for unknown people
+            weights: dense array of pair weights
+        """
+        return _select(self.people, self.mentions, self.weights, people)
+
+    def graph(self, n=None, people=None):
+        """
+        Co-occurrence graph of the n most mentioned people, or of a
+        list of people.
+        """
+        if people is None:
+            people = self.top(n)
+        mentions, weights = self.select(people)
+        return build_graph(people, mentions, weights)
+
+
+def _select(all_people, mentions, weights, people):
+    index = dict((name, i) for i, name in enumerate(all_people))
+    known = np.array([name in index for name in people], dtype=bool)
+    columns = np.array([index[name] for name in people if name in index],
+                       dtype=np.int64)
+    selected = np.zeros(len(people), dtype=np.int64)
+    selected[known] = np.asarray(mentions)[columns]
+    dense = np.zeros((len(people), len(people)), dtype=np.int64)
+    if len(columns):
+        sub = weights[columns][:, columns]
+        dense[np.ix_(known, known)] = sub.toarray()
+    return selected, dense
+
+
+def build_graph(people, mentions, weights):
+    """
+    networkx graph of people with their mentions as node weight and
+    their co-occurrence weights as edges, like Graph.create_graph.
+
+    Args:
+        people: list of names
+        mentions: mentions of each person
+        weights: dense or sparse pair weights, indexed like people
+
+    Returns:
+        G: networkx Graph
+    """
+    import scipy.sparse
+    G = nx.Graph()
+    G.add_nodes_from((name, {'weight': int(weight)})
+                     for name, weight in zip(people, mentions))
+    upper = scipy.sparse.triu(scipy.sparse.coo_matrix(weights), k=1).tocoo()
+    G.add_edges_from((people[i], people[j], {'weight': w, 'thickness': 1})
+                     for i, j, w in zip(upper.row.tolist(), upper.col.tolist(),
+                                        upper.data.tolist()))
+    return G
+
+
+class Timeline(object):
+
+    def __init__(self, partials, people):
+        """
+        Co-occurrence of some people over consecutive blocks of
+        paragraphs, across docs
+
+        Block totals are accumulated once, so any window of blocks is
+        the difference of two cumulative sums.
+
+        Args:
+            partials: Cooccurrence objects with blocks, in corpus order
+            people: list of names followed through the blocks
+
+        Attributes:
+            blocks: list of (doc index, first paragraph id) per block
+            cum_mentions: int array (n_blocks+1, n_people) of mentions
+                          before each block
+            cum_weights: int array (n_blocks+1, n_people, n_people) of
+                         pair weights before each block
+        """
+        self.people = list(people)
+        self.blocks = []
+        mentions, weights = [], []
+        for doc_index, partial in enumerate(partials):
+            for block, (block_mentions, block_weights) in enumerate(
+                    zip(partial.block_mentions, partial.block_weights)):
+                self.blocks.append((doc_index, block*partial.block_size))
+                m, w = _select(partial.people, block_mentions, block_weights,
+                               self.people)
+                mentions.append(m)
+                weights.append(w)
+        n = len(self.people)
+        self.cum_mentions = np.zeros((len(mentions)+1, n), dtype=np.int64)
+        self.cum_weights = np.zeros((len(weights)+1, n, n), dtype=np.int64)
+        if mentions:
+            np.cumsum(mentions, axis=0, out=self.cum_mentions[1:])
+            np.cumsum(weights, axis=0, out=self.cum_weights[1:])
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def window(self, start, stop):
+        """
+        Mentions and pair weights over blocks start to stop (excluded).
+        """
+        return (self.cum_mentions[stop] - self.cum_mentions[start],
+                self.cum_weights[stop] - self.cum_weights[start])
+
+    def sliding(self, width, step=1):
+        """
+        Slide a window of width blocks along the timeline.
+
+        Yields:
+            (start, stop, mentions, weights) for each window
+        """
+        for start in range(0, max(len(self) - width, 0) + 1, step):
+            stop = min(start + width, len(self))
+            mentions, weights = self.window(start, stop)
+            yield start, stop, mentions, weights
+
+    def graph(self, start, stop):
+        """
+        Co-occurrence graph over blocks start to stop (excluded).
+        """
+        mentions, weights = self.window(start, stop)
+        return build_graph(self.people, mentions, weights)
+
+
+def _doc_partial(corpus, doc, block_size):
+    corpus.stats.add_doc(doc)
+    return Cooccurrence.from_stats(corpus.stats, doc.id, len(doc.segments),
+                                   block_size)
+
+
+def _doc_partial_worker(config, file_path, doc_id, block_size):
+    from .pensieve import Corpus
+    corpus = Corpus(**config)
+    return _doc_partial(corpus, corpus.load_doc(file_path, doc_id), block_size)
+
+
+def corpus_partials(corpus, block_size=None, n_jobs=1):
+    """
+    Co-occurrence partial of every doc of a corpus.
+
+    Args:
+        corpus: pensieve.Corpus
+        block_size: also keep partials of every block_size paragraphs,
+                    for timelines [default: None]
+        n_jobs: number of worker processes, each parsing its own docs
+                [default: 1]
+
+    Returns:
+        partials: list of Cooccurrence objects, in corpus order
+    """
+    if n_jobs <= 1:
+        return [_doc_partial(corpus, doc, block_size) for doc in corpus.docs]
+    from concurrent.futures import ProcessPoolExecutor
+    config = corpus.config()
+    config['n_process'] = 1
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_doc_partial_worker, config, file_path,
+                               doc_id, block_size)
+                   for file_path, doc_id in corpus.doc_paths()]
+        return [future.result() for future in futures]
+
+
+def merge_partials(partials):
+    """
+    Corpus totals of doc partials. Merging is associative, so partials
+    can be merged in any grouping, e.g. as workers finish.
+    """
+    from functools import reduce
+    return reduce(Cooccurrence.merge, partials,
+                  Cooccurrence([], [], _empty_weights()))
+
+
+def _empty_weights():
+    import scipy.sparse
+    return scipy.sparse.csr_matrix((0, 0), dtype=np.int64)
+
+
+def graph_key(G, method=None, seed=None):
+    """
+    Content hash of a graph: its nodes, edges and their weights, plus
+    the layout method and seed. Equal graphs have equal keys whatever
+    the order they were built in.
+    """
+    nodes = sorted((str(node), weight) for node, weight
+                   in G.nodes(data='weight'))
+    edges = sorted(tuple(sorted((str(u), str(v)))) + (w,)
+                   for u, v, w in G.edges(data='weight'))
+    content = json.dumps([nodes, edges, method, seed], default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class LayoutCache(object):
+
+    def __init__(self, cache_dir):
+        """
+        Node positions of laid out graphs, one JSON file per graph
+        content key (see graph_key)
+
+        Args:
+            cache_dir: directory of the cache, created if needed
+        """
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """
+        Cached positions, or None.
+
+        Returns:
+            pos: dict of node -> (x, y) array
+        """
+        try:
+            with open(self.path(key)) as f:
+                return {node: np.array(xy) for node, xy in json.load(f)}
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, pos):
+        tmp_path = '{}.{}.tmp'.format(self.path(key), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump([[node, [float(x), float(y)]]
+                       for node, (x, y) in pos.items()], f)
+        os.replace(tmp_path, self.path(key))
+
+
+def layout(G, method='auto', previous=None, seed=0, iterations=50,
+           warm_iterations=15):
+    """
+    Node positions of a graph.
+
+    Args:
+        G: networkx Graph
+        method: 'spring', 'spectral', or 'auto' for spectral above
+                LARGE_GRAPH nodes and spring otherwise [default: 'auto']
+        previous: dict of node -> position of an earlier layout, e.g.
+                  of the graph before it changed. Spring layouts start
+                  from these positions and only refine them; new nodes
+                  start next to their placed neighbours [default: None]
+        seed: random seed [default: 0]
+        iterations: spring iterations from scratch [default: 50]
+        warm_iterations: spring iterations from previous positions
+                         [default: 15]
+
+    Returns:
+        pos: dict of node -> (x, y) array
+    """
+    if method == 'auto':
+        method = 'spectral' if len(G) > LARGE_GRAPH else 'spring'
+    if len(G) == 0:
+        return {}
+    if method == 'spectral':
+        return nx.spectral_layout(G, weight='weight')
+    if method != 'spring':
+        raise ValueError('Unknown layout method {}, choose from spring, '
+                         'spectral or auto'.format(method))
+    initial = None
+    if previous:
+        initial = _warm_positions(G, previous, np.random.RandomState(seed))
+        iterations = warm_iterations
+    return nx.spring_layout(G, pos=initial, iterations=iterations, seed=seed)
+
+
+def _warm_positions(G, previous, rng):
+    pos = {node: np.asarray(previous[node], dtype=float)
+           for node in G if node in previous}
+    for node in G:
+        if node in pos:
+            continue
+        placed = [pos[neighbour] for neighbour in G[node] if neighbour in pos]
+        center = np.mean(placed, axis=0) if placed else np.zeros(2)
+        pos[node] = center + rng.uniform(-0.1, 0.1, 2)
+    return pos
+
 
 class Graph(object):
     G = None
     book = None
+    pos = None
+    weighted = False
     def __init__(self, book=None):
         self.book = book
         self.G = nx.Graph()
     
     def max_degree(self):
-        max_deg = 0
-        for node in self.G.nodes():
-            if self.G.degree(node) > max_deg:
-                max_deg = self.G.degree(node)
-        return max_deg
+        return max(dict(self.G.degree()).values(), default=0)
     
+    @classmethod
+    def from_cooccurrence(cls, partial, n=None, people=None):
+        """
+        Graph of the n most mentioned people of a Cooccurrence partial
+        or merged corpus totals, or of a list of people.
+        """
+        graph = cls()
+        graph.G = partial.graph(n, people)
+        return graph
+
     def create_graph(self,n):
         list_of_people = Counter(self.book.words['people'])
         list_of_people = dict(list_of_people.most_common(n))
-        for key in list_of_people.keys():
-            self.G.add_node(key, weight=list_of_people[key])
-        for i in range(len(self.book.paragraphs)):
-            para_ppl = self.book.paragraphs[i].build_words_dict()['people']
-            for person1 in para_ppl.keys():
-                if person1 in list_of_people.keys():
-                    for person2 in para_ppl.keys():
-                        if person2 in list_of_people.keys() and person2 != person1:
-                            w = para_ppl[person1] + para_ppl[person2]
-                            if (person1,person2) in self.G.edges() or (person2,person1) in self.G.edges():
-                                self.G[person1][person2]['weight'] += w
-                            else:
-                                self.G.add_edge(person1,person2,weight=w,thickness=1)
+        people = list(list_of_people)
+        # Per paragraph people counts come from the corpus statistics
+        # filled in by book.words, nothing is extracted again
+        stats = self.book.corpus.stats
+        _, _, counts = stats.paragraph_matrix('people', people,
+                                              doc_id=self.book.id)
+        self.G = build_graph(people, list(list_of_people.values()),
+                             cooccurrence(counts))
+        self.weighted = False
         print(list_of_people)
         
     def set_weights(self):
-        for edge in self.G.edges(data = True):
-            p1 = (edge[2]['weight']/self.G.node[edge[0]]['weight'])
-            p2 = (edge[2]['weight']/self.G.node[edge[1]]['weight'])
-            edge[2]['weight'] = max(p1*math.pow(p2,0.8),p2*math.pow(p1,0.8))
-            edge[2]['thickness'] = math.sqrt(edge[2]['weight'])
+        # Weights are normalized once, drawing again doesn't redo it
+        if self.weighted:
+            return
+        self.weighted = True
+        edges = list(self.G.edges(data='weight'))
+        if not edges:
+            return
+        node_weights = nx.get_node_attributes(self.G, 'weight')
+        u, v, w = zip(*edges)
+        w = np.asarray(w, dtype=float)
+        p1 = w/np.array([node_weights[node] for node in u], dtype=float)
+        p2 = w/np.array([node_weights[node] for node in v], dtype=float)
+        weights = np.maximum(p1*np.power(p2, 0.8), p2*np.power(p1, 0.8))
+        nx.set_edge_attributes(self.G, dict(zip(zip(u, v), weights.tolist())),
+                               'weight')
+        nx.set_edge_attributes(self.G, dict(zip(zip(u, v),
+                                                np.sqrt(weights).tolist())),
+                               'thickness')
     
-    def graph(self):
+    def layout(self, method='auto', cache=None, previous=None, seed=0,
+               iterations=50):
+        """
+        Lay out the graph, reusing cached positions of the same graph.
+        When the graph changed since the last layout, the previous
+        positions are refined instead of starting over.
+
+        Args:
+            method: 'spring', 'spectral' or 'auto', see layout
+                    [default: 'auto']
+            cache: LayoutCache or cache directory [default: None]
+            previous: dict of node -> position to start from. If None,
+                      the positions of the last layout [default: None]
+            seed: random seed [default: 0]
+            iterations: spring iterations from scratch [default: 50]
+
+        Returns:
+            pos: dict of node -> (x, y) array, also kept in self.pos
+        """
+        if isinstance(cache, str):
+            cache = LayoutCache(cache)
+        key = graph_key(self.G, method, seed)
+        pos = cache.get(key) if cache is not None else None
+        # JSON keys are strings, so only trust entries matching the nodes
+        if pos is not None and set(pos) != set(self.G):
+            pos = None
+        if pos is None:
+            if previous is None:
+                previous = self.pos
+            pos = layout(self.G, method, previous, seed, iterations)
+            if cache is not None:
+                cache.put(key, pos)
+        self.pos = pos
+        return pos
+
+    def export(self, path, **layout_kwargs):
+        """
+        Write the graph with its node positions. The format follows
+        the extension: .gexf (positions as viz attributes), .graphml
+        (x and y node attributes) or .json (nodes and links lists).
+
+        Args:
+            path: output file
+            layout_kwargs: passed to Graph.layout when the graph hasn't
+                           been laid out yet
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in EXPORT_FORMATS:
+            raise ValueError('Unknown graph format {}, choose from {}'
+                             .format(extension, ', '.join(EXPORT_FORMATS)))
+        pos = self.pos
+        if pos is None or set(pos) != set(self.G) or layout_kwargs:
+            pos = self.layout(**layout_kwargs)
+        G = self.G.copy()
+        for node, (x, y) in pos.items():
+            G.nodes[node]['x'] = float(x)
+            G.nodes[node]['y'] = float(y)
+        if extension == '.gexf':
+            for node, data in G.nodes(data=True):
+                data['viz'] = {'position': {'x': data.pop('x'),
+                                            'y': data.pop('y'),
+                                            'z': 0.}}
+            nx.write_gexf(G, path)
+        elif extension == '.graphml':
+            nx.write_graphml(G, path)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'nodes': [dict(data, id=node)
+                                     for node, data in G.nodes(data=True)],
+                           'links': [dict(data, source=u, target=v)
+                                     for u, v, data in G.edges(data=True)]},
+                          f, default=float)
+
+    def draw(self, ax, pos):
         self.set_weights()
-        pos=nx.spring_layout(self.G)
-        
         edge_colors = ['blue' for edge in self.G.edges()]
         edge_widths = [d['thickness'] for u,v,d in self.G.edges(data=True)]
         
-        nx.draw_networkx_edges(self.G, pos, width=edge_widths, edge_color=edge_colors)
+        nx.draw_networkx_edges(self.G, pos, width=edge_widths, edge_color=edge_colors, ax=ax)
         
+        max_degree = self.max_degree() or 1
         node_sizes = [100+50*self.G.degree(node) for node in self.G.nodes()]
-        node_colors = [self.G.degree(node)/self.max_degree() for node in self.G.nodes()]
+        node_colors = [self.G.degree(node)/max_degree for node in self.G.nodes()]
         node_labels = {node[0]:node[0] for node in self.G.nodes(data=True)}
         
-        nx.draw_networkx_nodes(self.G, pos,node_color = node_colors, node_size=node_sizes, node_shape='h', cmap=plt.get_cmap('GnBu'),vmin=0,vmax=1, linewidths=5)
-        nx.draw_networkx_labels(self.G, pos, labels=node_labels)
+        nx.draw_networkx_nodes(self.G, pos,node_color = node_colors, node_size=node_sizes, node_shape='h', cmap='GnBu',vmin=0,vmax=1, linewidths=5, ax=ax)
+        nx.draw_networkx_labels(self.G, pos, labels=node_labels, ax=ax)
         
-        plt.axis('off')
+        ax.axis('off')
+
+    def render(self, path, figsize=(12, 12), dpi=100, **layout_kwargs):
+        """
+        Draw the graph to an image file, without a display. The format
+        follows the extension: .png, .svg or .pdf.
+
+        Args:
+            path: output file
+            figsize: figure size in inches [default: (12, 12)]
+            dpi: resolution of .png files [default: 100]
+            layout_kwargs: passed to Graph.layout when the graph hasn't
+                           been laid out yet
+        """
+        # A bare Figure on the Agg canvas never touches pyplot or a GUI
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in RENDER_FORMATS:
+            raise ValueError('Unknown image format {}, choose from {}'
+                             .format(extension, ', '.join(RENDER_FORMATS)))
+        pos = self.pos
+        if pos is None or set(pos) != set(self.G) or layout_kwargs:
+            pos = self.layout(**layout_kwargs)
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        self.draw(fig.add_subplot(1, 1, 1), pos)
+        fig.savefig(path, dpi=dpi)
+
+    def graph(self):
+        import matplotlib.pyplot as plt
+        import pylab
+        pos = self.layout()
+        self.draw(plt.gca(), pos)
         pylab.show()
-     
\ No newline at end of file
@@ -1,17 +1,343 @@
 from io import BytesIO
+from collections import OrderedDict
+import hashlib
 import json
 import os
-import requests
-import urllib
+import threading
 import uuid
 
-# pillow
-from PIL import Image
-# boto3 for AWS
-import boto3
+DEFAULT_BUCKET = 'gx42-image-source'
+# Bounding boxes of the renditions made of each image, largest first.
+# display goes in imageURL and icon in iconURL
+RENDITIONS = OrderedDict([('display', (1024, 1024)),
+                          ('thumbnail', (256, 256)),
+                          ('icon', (64, 64))])
 
 
-def upload_image(url, bucket='gx42-image-source'):
+def content_key(data):
+    """
+    Storage key of an image, derived from its content so identical
+    images share a key. Keys are formatted like the uuids stored in
+    imageURL, eg. 64C27228-0004-4C60-8B7E-95702956700F
+
+    Args:
+        data: bytes of the downloaded image
+
+    Returns:
+        key: uppercase uuid string
+    """
+    digest = hashlib.sha256(data).digest()
+    return str(uuid.UUID(bytes=digest[:16])).upper()
+
+
+def encode_jpeg(data):
+    """
+    Re-encode an image as an optimized progressive JPEG.
+
+    Args:
+        data: bytes of the image, in any format Pillow reads
+
+    Returns:
+        jpeg: bytes of the JPEG
+    """
+    from PIL import Image
+    img = normalize_mode(Image.open(BytesIO(data)))
+    out = BytesIO()
+    img.save(out, 'JPEG', optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def rendition_key(key, name):
+    """
+    Storage key of a rendition of the image stored under key, formatted
+    like key. The None rendition is the image itself.
+    """
+    if name is None:
+        return key
+    return str(uuid.uuid5(uuid.UUID(key), name)).upper()
+
+
+def normalize_mode(img):
+    """
+    Convert an image to a mode JPEG can store: RGB, or L for greyscale.
+    Transparent images are flattened onto white.
+    """
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        from PIL import Image
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    return img
+
+
+def make_renditions(data, renditions=RENDITIONS, quality=75):
+    """
+    Make downscaled JPEG renditions of an image from a single decode.
+    JPEGs are decoded straight at the smallest scale that covers the
+    largest rendition (Image.draft), EXIF orientation is applied, and
+    each rendition is reduced from the previous, larger one. Images are
+    never upscaled.
+
+    Args:
+        data: bytes of the image, in any format Pillow reads
+        renditions: dict of rendition name -> (width, height) bounding
+                    box [default: RENDITIONS]
+        quality: JPEG quality [default: 75]
+
+    Returns:
+        renditions: OrderedDict of rendition name -> JPEG bytes
+    """
+    from PIL import Image, ImageOps
+    sizes = sorted(renditions.items(), key=lambda item: -max(item[1]))
+    img = Image.open(BytesIO(data))
+    # Square box: the EXIF rotation isn't known before decoding
+    largest = max(sizes[0][1])
+    img.draft(img.mode, (largest, largest))
+    img = normalize_mode(ImageOps.exif_transpose(img))
+    encoded = OrderedDict()
+    for name, size in sizes:
+        img = img.copy()
+        img.thumbnail(size, Image.LANCZOS, reducing_gap=3.)
+        out = BytesIO()
+        img.save(out, 'JPEG', quality=quality, optimize=True,
+                 progressive=True)
+        encoded[name] = out.getvalue()
+    return OrderedDict((name, encoded[name]) for name in renditions)
+
+
+def _encode_image(args):
+    # Errors are returned, so one bad image doesn't fail its batch
+    encode, renditions, data = args
+    try:
+        if renditions is None:
+            return {None: encode(data)}
+        return make_renditions(data, renditions)
+    except Exception as e:
+        return e
+
+
+class S3Storage(object):
+
+    def __init__(self, bucket=DEFAULT_BUCKET, client=None,
+                 acl='public-read'):
+        """
+        Image storage in an S3 bucket
+
+        Args:
+            bucket: name of the bucket [default: DEFAULT_BUCKET]
+            client: boto3 S3 client, shared by all uploads. If None, one
+                    is made with the default credentials
+                    (~/.aws/credentials) [default: None]
+            acl: canned ACL of the uploaded objects
+                 [default: 'public-read']
+        """
+        if client is None:
+            import boto3
+            client = boto3.client('s3')
+        self.bucket = bucket
+        self.client = client
+        self.acl = acl
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def put(self, key, data, content_type):
+        self.client.put_object(Bucket=self.bucket,
+                               Key=key,
+                               Body=data,
+                               ACL=self.acl,
+                               ContentType=content_type)
+
+
+class LocalStorage(object):
+
+    def __init__(self, root):
+        """
+        Image storage in a local directory, one file per key
+
+        Args:
+            root: directory of the images, created if needed
+        """
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data, content_type):
+        tmp_path = '{}.{}.{}.tmp'.format(self.path(key), os.getpid(),
+                                        threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+
+
+class ImageUploader(object):
+
+    def __init__(self, storage=None, n_workers=8, timeout=10.,
+                 session=None, encode=encode_jpeg, renditions=None,
+                 n_procs=1):
+        """
+        Uploads batches of images, each stored once by content
+
+        Images are downloaded once through a shared HTTP session on a
+        bounded thread pool. An image whose content is already stored,
+        in this batch or before, is not uploaded again and its existing
+        key is returned.
+
+        Args:
+            storage: storage backend with exists(key) and
+                     put(key, data, content_type) methods. If None,
+                     S3Storage() [default: None]
+            n_workers: number of concurrent downloads and uploads
+                       [default: 8]
+            timeout: download timeout in seconds [default: 10.]
+            session: requests Session. If None, a pooled session is
+                     made [default: None]
+            encode: function turning downloaded bytes into the stored
+                    JPEG bytes, when there are no renditions
+                    [default: encode_jpeg]
+            renditions: dict of rendition name -> bounding box, see
+                        make_renditions. If None, only the encoded image
+                        is stored [default: None]
+            n_procs: number of processes encoding images. Decoding and
+                     resizing are CPU bound, so large batches gain from
+                     more than 1 [default: 1]
+        """
+        if storage is None:
+            storage = S3Storage()
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=n_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.storage = storage
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.session = session
+        self.encode = encode
+        self.renditions = renditions
+        self.n_procs = n_procs
+        self._stored = set()
+
+    def download(self, url):
+        resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.content
+
+    def keys(self, key):
+        """
+        Keys of the stored renditions of the image with content key.
+
+        Returns:
+            keys: dict of rendition name -> key, or the key itself when
+                  there are no renditions
+        """
+        if self.renditions is None:
+            return key
+        return OrderedDict((name, rendition_key(key, name))
+                           for name in self.renditions)
+
+    def _exists(self, key):
+        # Renditions are put in order, the last one marks a stored image
+        keys = self.keys(key)
+        if self.renditions is not None:
+            keys = list(keys.values())[-1]
+        try:
+            return self.storage.exists(keys)
+        except Exception:
+            return False
+
+    def _encode_all(self, datas):
+        args = [(self.encode, self.renditions, data) for data in datas]
+        if self.n_procs > 1 and len(datas) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.n_procs) as pool:
+                return list(pool.map(_encode_image, args))
+        return [_encode_image(arg) for arg in args]
+
+    def _put(self, key, encoded):
+        if isinstance(encoded, Exception):
+            return encoded
+        try:
+            for name, data in encoded.items():
+                self.storage.put(rendition_key(key, name), data, 'image/jpg')
+        except Exception as e:
+            return e
+        return None
+
+    def upload(self, urls):
+        """
+        Upload the images at urls. Each distinct url is fetched once,
+        and each distinct image is encoded and stored once.
+
+        Args:
+            urls: list of image urls
+
+        Returns:
+            results: list of (success, full_key_name) tuples, one per
+                     url. full_key_name is a dict of rendition name ->
+                     key when there are renditions, and the exception
+                     when the upload failed
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def download(url):
+            try:
+                return self.download(url)
+            except Exception as e:
+                return e
+
+        unique_urls = list(dict.fromkeys(urls))
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            content_keys = {}
+            for url, data in zip(unique_urls, pool.map(download, unique_urls)):
+                if isinstance(data, Exception):
+                    results[url] = data
+                    continue
+                key = content_key(data)
+                content_keys.setdefault(key, data)
+                results[url] = key
+            # Images stored before are not encoded again
+            new_keys = [key for key in content_keys if key not in self._stored]
+            exists = pool.map(self._exists, new_keys)
+            new_keys = [key for key, stored in zip(new_keys, exists)
+                        if not stored]
+            encoded = self._encode_all([content_keys[key] for key in new_keys])
+            errors = dict(zip(new_keys, pool.map(self._put, new_keys, encoded)))
+        self._stored.update(key for key in content_keys
+                            if errors.get(key) is None)
+        upload_results = {}
+        for url, key in results.items():
+            error = key if isinstance(key, Exception) else errors.get(key)
+            if error is not None:
+                print('upload_image ERROR', error)
+                upload_results[url] = (False, error)
+            else:
+                upload_results[url] = (True, self.keys(key))
+        return [upload_results[url] for url in urls]
+
+
+def upload_image(url, bucket=DEFAULT_BUCKET):
     """ Save image to S3 bucket for later retrieval
 
     Args:
@@ -25,23 +351,35 @@ def upload_image(url, bucket='gx42-image-source'):
 
     Security Defaults to ~/.aws/credential
     """
-    imguid = str(uuid.uuid4()).upper()
-    try:
-        s3 = boto3.resource('s3')
-        resp = requests.get(url)
-        dat = urllib.request.urlopen(resp.url)
-        img = Image.open(dat)
-        out_im2 = BytesIO()
-        img.save(out_im2, 'JPEG', optimize=True, progressive=True)
-        out_im2.seek(0)
-        full_key_name = imguid
-        s3.Bucket(bucket).put_object(
-            Key=full_key_name,
-            Body=out_im2,
-            ACL='public-read',
-            ContentType='image/jpg',
-        )
-        return True, full_key_name
-    except Exception as e:
-        print('upload_image ERROR', e)
-        return False, e
\ No newline at end of file
+    return ImageUploader(S3Storage(bucket), n_workers=1).upload([url])[0]
+
+
+def upload_images(urls, storage=None, n_workers=8, renditions=None,
+                  n_procs=1):
+    """ Save a batch of images for later retrieval
+
+    Args:
+        urls: list of image urls to store
+        storage: storage backend, eg. S3Storage or LocalStorage. If
+                 None, the default S3 bucket [default: None]
+        n_workers: number of concurrent uploads [default: 8]
+        renditions: dict of rendition name -> bounding box, eg.
+                    RENDITIONS. If None, each image is stored once at
+                    full size [default: None]
+        n_procs: number of processes encoding images [default: 1]
+
+    Returns:
+        results: list of (success, full_key_name) tuples, one per url
+    """
+    return ImageUploader(storage, n_workers=n_workers, renditions=renditions,
+                         n_procs=n_procs).upload(urls)
+
+
+def open_storage(location):
+    """
+    Storage backend for a location: 's3://bucket' for S3, otherwise a
+    local directory.
+    """
+    if location.startswith('s3://'):
+        return S3Storage(location[len('s3://'):])
+    return LocalStorage(location)
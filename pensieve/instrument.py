@@ -0,0 +1,402 @@
+"""
+Per-stage timing and counters of a run
+
+Stages are timed with
+
+    with stage('parse', doc_id, items_in=len(pars)) as s:
+        ...
+        s.items_out = n_parsed
+
+When no Instrumentation is running, stage returns a shared no-op
+context manager, so instrumented code costs one global lookup.
+"""
+import json
+import time
+from collections import OrderedDict
+
+# Stage names used by Corpus, Doc and Paragraph
+STAGES = ('read', 'segment', 'filter', 'mood', 'parse', 'extract',
+          'select', 'images', 'serialize')
+
+_RUN = None
+
+
+class StageStats(object):
+    __slots__ = ('calls', 'seconds', 'self_seconds', 'items_in',
+                 'items_out', 'bytes')
+
+    def __init__(self, calls=0, seconds=0., self_seconds=0., items_in=0,
+                 items_out=0, bytes=0):
+        """
+        Totals of one stage
+
+        Attributes:
+            calls: number of times the stage ran
+            seconds: wall time, including nested stages
+            self_seconds: wall time, excluding nested stages
+            items_in: paragraphs (or other items) given to the stage
+            items_out: paragraphs (or other items) it produced
+            bytes: bytes read or written
+        """
+        self.calls = calls
+        self.seconds = seconds
+        self.self_seconds = self_seconds
+        self.items_in = items_in
+        self.items_out = items_out
+        self.bytes = bytes
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def to_json(self):
+        return OrderedDict((name, getattr(self, name))
+                           for name in self.__slots__)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+class _NullStage(object):
+    # Shared by every stage while instrumentation is off, the counts
+    # set on it are simply dropped
+    items_in = items_out = bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    __slots__ = ('run', 'name', 'doc_id', 'items_in', 'items_out', 'bytes',
+                 'child_seconds', '_start', '_profiling')
+
+    def __init__(self, run, name, doc_id, items_in, nbytes):
+        self.run = run
+        self.name = name
+        self.doc_id = doc_id
+        self.items_in = items_in
+        self.items_out = 0
+        self.bytes = nbytes
+        self.child_seconds = 0.
+
+    def __enter__(self):
+        self._profiling = self.run._start_profile(self.name)
+        self.run._stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        self.run._stack.pop()
+        if self._profiling:
+            self.run._stop_profile()
+        self.run._record(self, seconds)
+        return False
+
+
+def stage(name, doc_id=None, items_in=0, nbytes=0):
+    """
+    Time a stage of the running Instrumentation, if any.
+
+    Args:
+        name: stage name, one of STAGES for the built in stages
+        doc_id: id of the doc processed [default: None]
+        items_in: number of items given to the stage [default: 0]
+        nbytes: bytes read or written [default: 0]
+
+    Returns:
+        context manager, whose items_in, items_out and bytes can be
+        set while the stage runs
+    """
+    if _RUN is None:
+        return NULL_STAGE
+    return _Stage(_RUN, name, doc_id, items_in, nbytes)
+
+
+def active():
+    """
+    The running Instrumentation, or None.
+    """
+    return _RUN
+
+
+class Instrumentation(object):
+
+    def __init__(self, callback=None, profile=None, profile_every=1,
+                 profile_lines=30):
+        """
+        Collects per doc, per stage timings and counters while running
+
+        Only one Instrumentation runs at a time, between start and stop
+        or inside a with block. Worker processes of the gather methods
+        run their own with the same profile settings, and their stats
+        and profiles are merged into this one.
+
+        Args:
+            callback: callable taking a dict of stage, doc_id, seconds,
+                      self_seconds, items_in, items_out and bytes, called
+                      as each stage finishes, in this process
+                      [default: None]
+            profile: stage to run under cProfile, or 'hottest' for the
+                     stage with the most self time so far [default: None]
+            profile_every: only profile one in this many calls of the
+                           stage [default: 1]
+            profile_lines: number of functions listed in the profile
+                           of the report [default: 30]
+
+        Attributes:
+            stats: OrderedDict of (doc_id, stage) -> StageStats
+            seconds: wall time between start and stop
+        """
+        self.callback = callback
+        self.profile = profile
+        self.profile_every = profile_every
+        self.profile_lines = profile_lines
+        self.stats = OrderedDict()
+        self.seconds = 0.
+        self._stack = []
+        self._calls = {}
+        self._self_seconds = {}
+        self._profilers = {}
+        self._merged_profiles = {}
+        self._profiling = None
+        self._started = None
+
+    def start(self):
+        global _RUN
+        if _RUN is not None and _RUN is not self:
+            raise RuntimeError('Another Instrumentation is running')
+        _RUN = self
+        self._started = time.perf_counter()
+        return self
+
+    def stop(self):
+        global _RUN
+        if _RUN is self:
+            _RUN = None
+            self.seconds += time.perf_counter() - self._started
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _record(self, stage, seconds):
+        self_seconds = seconds - stage.child_seconds
+        if self._stack:
+            self._stack[-1].child_seconds += seconds
+        key = (stage.doc_id, stage.name)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = StageStats()
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.self_seconds += self_seconds
+        stats.items_in += stage.items_in
+        stats.items_out += stage.items_out
+        stats.bytes += stage.bytes
+        self._self_seconds[stage.name] = (self._self_seconds.get(stage.name, 0.)
+                                          + self_seconds)
+        if self.callback is not None:
+            self.callback({'stage': stage.name,
+                           'doc_id': stage.doc_id,
+                           'seconds': seconds,
+                           'self_seconds': self_seconds,
+                           'items_in': stage.items_in,
+                           'items_out': stage.items_out,
+                           'bytes': stage.bytes})
+
+    def _start_profile(self, name):
+        # Stages nested in a profiled one are part of its profile
+        if self.profile is None or self._profiling is not None:
+            return False
+        target = self.profile
+        if target == 'hottest':
+            if not self._self_seconds:
+                return False
+            target = max(self._self_seconds, key=self._self_seconds.get)
+        if name != target:
+            return False
+        calls = self._calls[name] = self._calls.get(name, 0) + 1
+        if (calls - 1) % self.profile_every:
+            return False
+        # With 'hottest' the target can change as the run goes on, each
+        # stage keeps its own profile and the report shows the hottest
+        import cProfile
+        profiler = self._profilers.get(name)
+        if profiler is None:
+            profiler = self._profilers[name] = cProfile.Profile()
+        self._profiling = profiler
+        profiler.enable()
+        return True
+
+    def _stop_profile(self):
+        self._profiling.disable()
+        self._profiling = None
+
+    def settings(self):
+        """
+        Arguments of an Instrumentation run elsewhere, e.g. in a worker
+        process, whose stats and profiles are merged into this one. The
+        callback stays in this process.
+        """
+        return {'profile': self.profile,
+                'profile_every': self.profile_every,
+                'profile_lines': self.profile_lines}
+
+    def merge(self, stats, profiles=None):
+        """
+        Add stats collected elsewhere, e.g. by a worker process.
+
+        Args:
+            stats: Instrumentation, or its stats as given by
+                   Instrumentation.stats_json
+            profiles: its profiles, as given by
+                      Instrumentation.profile_data [default: None]
+        """
+        if isinstance(stats, Instrumentation):
+            stats, profiles = stats.stats_json(), stats.profile_data()
+        for name, data in (profiles or {}).items():
+            other = _profile_stats(data)
+            if name in self._merged_profiles:
+                self._merged_profiles[name].add(other)
+            else:
+                self._merged_profiles[name] = other
+        for entry in stats:
+            key = (entry['doc_id'], entry['stage'])
+            other = StageStats.from_json(entry['stats'])
+            self.stats.setdefault(key, StageStats()).add(other)
+            self._self_seconds[entry['stage']] = (
+                self._self_seconds.get(entry['stage'], 0.)
+                + other.self_seconds)
+
+    def stats_json(self):
+        return [{'doc_id': doc_id, 'stage': name, 'stats': stats.to_json()}
+                for (doc_id, name), stats in self.stats.items()]
+
+    def profile_data(self):
+        """
+        Raw cProfile stats of each profiled stage, which can be pickled
+        and passed to merge.
+
+        Returns:
+            profiles: dict of stage -> pstats stats dict
+        """
+        return dict((name, stats.stats)
+                    for name, stats in self._profile_stats().items())
+
+    def _profile_stats(self):
+        import pstats
+        profiles = {}
+        for name in set(self._profilers) | set(self._merged_profiles):
+            parts = []
+            if name in self._profilers:
+                parts.append(pstats.Stats(self._profilers[name]))
+            if name in self._merged_profiles:
+                parts.append(self._merged_profiles[name])
+            profiles[name] = parts[0]
+            for part in parts[1:]:
+                profiles[name].add(part)
+        return profiles
+
+    def totals(self):
+        """
+        Stats of each stage summed over the docs.
+
+        Returns:
+            totals: OrderedDict of stage -> StageStats
+        """
+        totals = OrderedDict()
+        for (doc_id, name), stats in self.stats.items():
+            totals.setdefault(name, StageStats()).add(stats)
+        return totals
+
+    def hottest(self):
+        """
+        Name of the stage with the most self time, or None.
+        """
+        totals = self.totals()
+        if not totals:
+            return None
+        return max(totals, key=lambda name: totals[name].self_seconds)
+
+    def profiled(self):
+        """
+        Name of the stage whose profile is reported: the profiled stage,
+        or with 'hottest' the hottest of the stages profiled.
+        """
+        names = set(self._profilers) | set(self._merged_profiles)
+        if not names:
+            return None
+        totals = self.totals()
+        return max(sorted(names),
+                   key=lambda name: totals[name].self_seconds)
+
+    def profile_text(self):
+        """
+        cProfile listing of the profiled stage, by cumulative time.
+        """
+        name = self.profiled()
+        if name is None:
+            return None
+        import io
+        out = io.StringIO()
+        stats = self._profile_stats()[name]
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(self.profile_lines)
+        return out.getvalue()
+
+    def report(self):
+        """
+        Report of the run.
+
+        Returns:
+            report: dict of seconds, hottest stage, totals per stage,
+                    stats per doc and stage, and the profile of the
+                    profiled stage
+        """
+        docs = OrderedDict()
+        for (doc_id, name), stats in self.stats.items():
+            docs.setdefault(str(doc_id), OrderedDict())[name] = stats.to_json()
+        return OrderedDict([
+            ('seconds', self.seconds),
+            ('hottest', self.hottest()),
+            ('stages', OrderedDict((name, stats.to_json())
+                                   for name, stats in self.totals().items())),
+            ('docs', docs),
+            ('profiled', self.profiled()),
+            ('profile', self.profile_text())])
+
+    def save(self, path):
+        """
+        Write the report to a JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+class _ProfileData(object):
+    # pstats.Stats loads anything with create_stats and stats
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _profile_stats(data):
+    import pstats
+    # Copied, Stats.add updates the dict in place
+    return pstats.Stats(_ProfileData(dict(data)))
@@ -1,5 +1,8 @@
+import gzip
+import io
 import json
 import os
+import zlib
 from datetime import datetime
 
 CONCEPT_MAP = {'people': 'Person',
@@ -8,76 +11,409 @@ CONCEPT_MAP = {'people': 'Person',
                'activities': 'Activity',
                'times': 'Time',
                'mood_words': 'Mood'}
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+FSYNC_POLICIES = ('never', 'close', 'flush')
 
 
-def dump_mem_to_json(mem_dict, save=None):
+DEFAULT_MOOD_WEIGHTS = {'weight': 0.5,
+                        'joy': 0.0,
+                        'fear': 0.0,
+                        'surprise': 0.0,
+                        'sadness': 0.0,
+                        'disgust': 0.0,
+                        'anger': 0.0}
+
+
+def utc_timestamp():
     """
-    Convert mem_dict into a JSON file following the schema and write
+    Current UTC time, formatted as in the memory schema.
+    """
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def iter_concepts(mem_dict):
+    """
+    Concepts of a mem_dict, in schema order.
 
     Args:
         mem_dict: dictionary of mem information
-        save: path to save JSON to [default: None]
 
-    Returns:
-        mem_json: JSON object for memory
+    Yields:
+        (concept, name) pairs, e.g. ('Person', 'ron_weasley')
     """
-    node = {'name': '',
-            'label': '',
-            'imageURL': mem_dict.get('img_url', ''),
-            'iconURL': '',
-            'created': '',
-            'updated': ''}
-    default_mood_weights = {'weight': 0.5,
-                            'joy': 0.0,
-                            'fear': 0.0,
-                            'surprise': 0.0,
-                            'sadness': 0.0,
-                            'disgust': 0.0,
-                            'anger': 0.0}
-    relation = mem_dict.get('mood_weight', default_mood_weights)
-    concepts = []
     for concept_type, concept_items in mem_dict.items():
         if concept_items is None:
             continue
-        if concept_type in ('img_url', 'narrative', 'mood_weight'):
+        if concept_type in ('img_url', 'icon_url', 'narrative',
+                            'mood_weight'):
             continue
         for concept_item in concept_items:
             clean_text = concept_item.replace(' ', '_')
             clean_text = clean_text.lower()
-            concept = {'node': {}, 'relation': {}}
-            concept['node'] = {'concept': CONCEPT_MAP[concept_type],
-                               'name': clean_text,
-                               'label': '',
-                               'iconURL': '',
-                               'imageURL': ''}
-            concept_relation = 'Has_{}'.format(concept['node']['concept'])
-            concept['relation'] = {'relation': concept_relation,
-                                   'name': '',
-                                   'iconURL': '',
-                                   'imageURL': '',
-                                   'weight': 0.5,
-                                   'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-                                   'updated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-                                   'originType': 'OriginUserDefined',
-                                   'joy': 0.0,
-                                   'fear': 0.0,
-                                   'surprise': 0.0,
-                                   'sadness': 0.0,
-                                   'disgust': 0.0,
-                                   'anger': 0.0}
-            concepts.append(concept)
+            yield CONCEPT_MAP[concept_type], clean_text
+
+
+def _concept_json(concept, name, timestamp):
+    return {'node': {'concept': concept,
+                     'name': name,
+                     'label': '',
+                     'iconURL': '',
+                     'imageURL': ''},
+            'relation': {'relation': 'Has_{}'.format(concept),
+                         'name': '',
+                         'iconURL': '',
+                         'imageURL': '',
+                         'weight': 0.5,
+                         'created': timestamp,
+                         'updated': timestamp,
+                         'originType': 'OriginUserDefined',
+                         'joy': 0.0,
+                         'fear': 0.0,
+                         'surprise': 0.0,
+                         'sadness': 0.0,
+                         'disgust': 0.0,
+                         'anger': 0.0}}
+
+
+def _memory_json(image_url, icon_url, relation, concepts, text):
+    node = {'name': '',
+            'label': '',
+            'imageURL': image_url,
+            'iconURL': icon_url,
+            'created': '',
+            'updated': ''}
     narrative = {'node': {'name': '',
                           'label': 'title',
-                          'text': mem_dict['narrative']},
+                          'text': text},
                  'relation': {'weight': 0.5}}
-    mem = {'memory': '',
-           'node': node,
-           'relation': relation,
-           'concepts': concepts,
-           'narrative': narrative}
+    return {'memory': '',
+            'node': node,
+            'relation': relation,
+            'concepts': concepts,
+            'narrative': narrative}
+
+
+def dump_mem_to_json(mem_dict, save=None, timestamp=None):
+    """
+    Convert mem_dict into a JSON file following the schema and write
+
+    Args:
+        mem_dict: dictionary of mem information
+        save: path to save JSON to [default: None]
+        timestamp: creation time of the concept relations. If None,
+                   the current time [default: None]
+
+    Returns:
+        mem_json: JSON object for memory
+    """
+    if timestamp is None:
+        timestamp = utc_timestamp()
+    relation = mem_dict.get('mood_weight', DEFAULT_MOOD_WEIGHTS)
+    concepts = [_concept_json(concept, name, timestamp)
+                for concept, name in iter_concepts(mem_dict)]
+    mem = _memory_json(mem_dict.get('img_url', ''),
+                       mem_dict.get('icon_url', ''), relation, concepts,
+                       mem_dict['narrative'])
 
     if save is not None:
         with open(os.path.abspath(save), 'w') as f:
             json.dump(mem, f)
 
     return dict(mem)
+
+
+class MemoryBatch(object):
+
+    def __init__(self, timestamp=None):
+        """
+        Normalized memories sharing one concept table and one timestamp
+
+        Each distinct concept is stored once and memories refer to it by
+        id, instead of repeating a full concept node and relation in
+        every memory. Iterating the batch expands the memories back to
+        the dump_mem_to_json schema.
+
+        Args:
+            timestamp: creation time of every concept relation. If
+                       None, the current time [default: None]
+
+        Attributes:
+            timestamp: creation time of the batch
+            concepts: list of (concept, name) pairs, indexed by concept
+                      id
+            memories: list of normalized memories, dicts of imageURL,
+                      iconURL, relation (mood weights), concepts (list of concept
+                      ids) and text
+        """
+        if timestamp is None:
+            timestamp = utc_timestamp()
+        self.timestamp = timestamp
+        self.concepts = []
+        self.memories = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.memories)
+
+    def __iter__(self):
+        for memory in self.memories:
+            yield self.expand_memory(memory)
+
+    def intern(self, concept, name):
+        key = (concept, name)
+        concept_id = self._index.get(key)
+        if concept_id is None:
+            concept_id = len(self.concepts)
+            self._index[key] = concept_id
+            self.concepts.append(key)
+        return concept_id
+
+    def add(self, mem_dict):
+        """
+        Add a memory.
+
+        Args:
+            mem_dict: dictionary of mem information, as given by
+                      Paragraph.gen_mem_dict
+        """
+        self.memories.append(
+            {'imageURL': mem_dict.get('img_url', ''),
+             'iconURL': mem_dict.get('icon_url', ''),
+             'relation': mem_dict.get('mood_weight', DEFAULT_MOOD_WEIGHTS),
+             'concepts': [self.intern(concept, name)
+                          for concept, name in iter_concepts(mem_dict)],
+             'text': mem_dict['narrative']})
+
+    def extend(self, other):
+        """
+        Add the memories of another batch, keeping this batch's
+        timestamp.
+        """
+        ids = [self.intern(concept, name) for concept, name in other.concepts]
+        for memory in other.memories:
+            memory = dict(memory)
+            memory['concepts'] = [ids[i] for i in memory['concepts']]
+            self.memories.append(memory)
+        return self
+
+    def expand_memory(self, memory):
+        """
+        Expand a normalized memory to the dump_mem_to_json schema.
+        """
+        concepts = [_concept_json(self.concepts[i][0], self.concepts[i][1],
+                                  self.timestamp)
+                    for i in memory['concepts']]
+        return _memory_json(memory['imageURL'], memory.get('iconURL', ''),
+                            memory['relation'], concepts, memory['text'])
+
+    def expand(self):
+        """
+        Returns:
+            memories: list of memories in the dump_mem_to_json schema
+        """
+        return list(self)
+
+    def to_json(self):
+        return {'timestamp': self.timestamp,
+                'concepts': [{'concept': concept, 'name': name}
+                             for concept, name in self.concepts],
+                'memories': self.memories}
+
+    @classmethod
+    def from_json(cls, data):
+        batch = cls(data['timestamp'])
+        for concept in data['concepts']:
+            batch.intern(concept['concept'], concept['name'])
+        batch.memories = data['memories']
+        return batch
+
+    def save(self, path):
+        """
+        Write the batch to a JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a batch written by MemoryBatch.save.
+        """
+        with open(path, 'r') as f:
+            return cls.from_json(json.load(f))
+
+
+class MemoryWriter(object):
+
+    def __init__(self, path, compression=None, buffer_size=1 << 16,
+                 fsync='close'):
+        """
+        Streaming JSON lines sink for memories
+
+        Each memory is written as one compact JSON line. Lines are held
+        in a buffer of at most buffer_size bytes, so memory use stays flat
+        however many memories are written, and whatever was flushed
+        before a crash can still be read back with MemoryReader.
+
+        Args:
+            path: path of the file, truncated if it exists
+            compression: None, 'gzip' or 'zstd' (needs the zstandard
+                         package) [default: None]
+            buffer_size: bytes of lines buffered before they are written
+                         out [default: 65536]
+            fsync: 'never', 'close' to fsync when the file is closed, or
+                   'flush' to fsync on every buffer flush
+                   [default: 'close']
+
+        Attributes:
+            n_written: number of memories written
+        """
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unknown compression {}, choose from gzip, zstd'
+                             .format(compression))
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy {}, choose from {}'
+                             .format(fsync, ', '.join(FSYNC_POLICIES)))
+        self.path = path
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.n_written = 0
+        self._buffer = []
+        self._buffered = 0
+        # Imported before the file is opened, so a missing zstandard
+        # leaves no empty file behind
+        if compression == 'zstd':
+            import zstandard
+        self._raw = io.open(path, 'wb')
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        elif compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(
+                self._raw, closefd=False)
+        else:
+            self._stream = self._raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, memory):
+        """
+        Add a memory, as returned by dump_mem_to_json.
+        """
+        line = json.dumps(memory, separators=(',', ':'), ensure_ascii=False)
+        line = (line + '\n').encode('utf-8')
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self.n_written += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def add(self, mem_dict):
+        """
+        Convert a mem_dict with dump_mem_to_json and write it.
+        """
+        self.write(dump_mem_to_json(mem_dict))
+
+    def flush(self):
+        """
+        Write the buffered lines out, so they survive a crash of this
+        process (and of the machine, with fsync='flush').
+        """
+        if self._buffer:
+            self._stream.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        if self.compression == 'zstd':
+            import zstandard
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+        elif self.compression == 'gzip':
+            self._stream.flush()
+        self._raw.flush()
+        if self.fsync == 'flush':
+            os.fsync(self._raw.fileno())
+
+    def close(self):
+        if self._raw.closed:
+            return
+        self.flush()
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.flush()
+        if self.fsync != 'never':
+            os.fsync(self._raw.fileno())
+        self._raw.close()
+
+
+class MemoryReader(object):
+
+    def __init__(self, paths):
+        """
+        Lazy reader of memories written by MemoryWriter
+
+        Memories are decoded one line at a time, in file order, and the
+        reader can be iterated any number of times. The compression is
+        detected from the file contents. A truncated last line, left by
+        a crash, is skipped.
+
+        Args:
+            paths: path or list of paths of JSON lines files, read one
+                   after the other
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+
+    def __iter__(self):
+        for path in self.paths:
+            for memory in _iter_jsonl(path):
+                yield memory
+
+    def __add__(self, other):
+        return MemoryReader(self.paths + other.paths)
+
+    def __repr__(self):
+        return 'MemoryReader({!r})'.format(self.paths)
+
+
+def _iter_jsonl(path, chunk_size=1 << 16):
+    # Decompress incrementally, so lines flushed before a crash are read
+    # even when the compressed stream was never finished
+    with io.open(path, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic.startswith(GZIP_MAGIC):
+            decompress = _GzipDecompressor().decompress
+        elif magic == ZSTD_MAGIC:
+            import zstandard
+            decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+        else:
+            decompress = bytes
+        pending = b''
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            lines = (pending + decompress(chunk)).split(b'\n')
+            # The last piece is an incomplete line, or empty
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+
+
+class _GzipDecompressor(object):
+    # zlib decompressor for gzip data, following concatenated members
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        out = self._zlib.decompress(data)
+        while self._zlib.eof and self._zlib.unused_data:
+            unused = self._zlib.unused_data
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self._zlib.decompress(unused)
+        return out
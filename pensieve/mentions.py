@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class MentionIndex(object):
+
+    def __init__(self, n_sentences, people):
+        """
+        Index of the people mentioned in a sequence of paragraphs
+
+        Built once, after which the mention density of any set of
+        aliases is a vectorized lookup instead of a pass over the
+        paragraphs.
+
+        Args:
+            n_sentences: number of sentences in each paragraph
+            people: Counter of people mentions for each paragraph
+
+        Attributes:
+            n_sentences: int array of sentences per paragraph
+            indexed: bool array, True for the paragraphs indexed
+            postings: dict of name -> (paragraph positions, counts)
+                      int arrays
+        """
+        self.n_sentences = np.array(n_sentences, dtype=np.int32)
+        self.indexed = np.ones(len(self.n_sentences), dtype=bool)
+        positions = {}
+        counts = {}
+        for i, par_people in enumerate(people):
+            for name, count in par_people.items():
+                positions.setdefault(name, []).append(i)
+                counts.setdefault(name, []).append(count)
+        self.postings = {name: (np.array(positions[name], dtype=np.int32),
+                                np.array(counts[name], dtype=np.int32))
+                         for name in positions}
+
+    @classmethod
+    def empty(cls, n_paragraphs):
+        """
+        Index of n_paragraphs paragraphs, none indexed yet. Paragraphs
+        are added with update as they get parsed.
+        """
+        index = cls(np.zeros(n_paragraphs, dtype=np.int32), [])
+        index.indexed = np.zeros(n_paragraphs, dtype=bool)
+        return index
+
+    def update(self, positions, n_sentences, people):
+        """
+        Index more paragraphs. Paragraphs not indexed yet have no
+        sentences, so they are never selected.
+
+        Args:
+            positions: positions of the paragraphs, not indexed before
+            n_sentences: number of sentences in each paragraph
+            people: Counter of people mentions for each paragraph
+        """
+        self.n_sentences[positions] = n_sentences
+        self.indexed[positions] = True
+        added = MentionIndex(np.zeros(0, dtype=np.int32), people)
+        positions = np.asarray(positions, dtype=np.int32)
+        for name, (new_positions, new_counts) in added.postings.items():
+            new_positions = positions[new_positions]
+            if name in self.postings:
+                old_positions, old_counts = self.postings[name]
+                new_positions = np.concatenate([old_positions, new_positions])
+                new_counts = np.concatenate([old_counts, new_counts])
+            self.postings[name] = (new_positions, new_counts)
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs):
+        """
+        Build the index from parsed Paragraph objects.
+
+        Args:
+            paragraphs: list of Paragraph objects
+
+        Returns:
+            index: MentionIndex, positions follow the paragraph list
+        """
+        n_sentences = [len(list(par.spacy_doc.sents)) for par in paragraphs]
+        people = [par.words['people'] for par in paragraphs]
+        return cls(n_sentences, people)
+
+    def __len__(self):
+        return len(self.n_sentences)
+
+    def mentions(self, aliases):
+        """
+        Count mentions of any of the aliases in each paragraph.
+
+        Args:
+            aliases: name or list of aliases
+
+        Returns:
+            mentions: int array of mentions per paragraph
+        """
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        mentions = np.zeros(len(self), dtype=np.int32)
+        for alias in aliases:
+            if alias in self.postings:
+                positions, counts = self.postings[alias]
+                mentions[positions] += counts
+        return mentions
+
+    def density(self, aliases):
+        """
+        Mentions per sentence of the aliases in each paragraph.
+
+        Args:
+            aliases: name or list of aliases
+
+        Returns:
+            density: float array, NaN for paragraphs without sentences
+        """
+        mentions = self.mentions(aliases)
+        density = np.full(len(self), np.nan)
+        has_sentences = self.n_sentences > 0
+        density[has_sentences] = (mentions[has_sentences]
+                                  / self.n_sentences[has_sentences])
+        return density
+
+    def select(self, aliases, density_cut=0.8):
+        """
+        Find the paragraphs where the aliases are mentioned heavily.
+
+        Args:
+            aliases: name or list of aliases
+            density_cut: only keep paragraphs that pass this cut on
+                         (number of mentions)/(number of sentences)
+
+        Returns:
+            positions: int array of paragraph positions, in order
+        """
+        # NaN densities never pass the cut
+        return np.flatnonzero(self.density(aliases) > density_cut)
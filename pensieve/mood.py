@@ -0,0 +1,447 @@
+import io
+import json
+import mmap
+import os
+import re
+import struct
+from array import array
+import numpy as np
+
+# Emotions counted from the NRC lexicon, in the column order of the
+# book_emo tables
+EMOTIONS = ('anger', 'disgust', 'fear', 'joy', 'sadness', 'surprise')
+EMOTIONS_FILE = 'book_emo_v2.h5'
+MOOD_WORDS_FILE = 'book_moo_v2.h5'
+MOOD_STORE_FILE = 'moods.pmood'
+# Characters stripped from every word before the lexicon lookup
+STRIP = re.compile(r"[!@#$%^&*()_+:;,.?']")
+
+# Store layout: magic, header offset and header length, then the arrays,
+# each aligned to ALIGN bytes, then a JSON header describing them
+MAGIC = b'PMOOD001'
+PREFIX = struct.Struct('<8sQQ')
+ALIGN = 64
+
+_LEXICONS = {}
+_STORES = {}
+
+
+class MoodTable(object):
+
+    def __init__(self, emotions, counts):
+        """
+        Emotion counts of every paragraph in a doc, normalized once
+
+        Args:
+            emotions: list of emotion names, the columns of counts
+            counts: array of emotion counts, one row per paragraph
+
+        Attributes:
+            norms: total emotion count of each paragraph
+            weights: mood weight of each paragraph, log(norm + 1)
+                     scaled so the moodiest paragraph of the doc has
+                     weight 1
+            normalized: emotion counts divided by the paragraph norm,
+                        raw counts for paragraphs without emotions
+        """
+        self.emotions = list(emotions)
+        self.counts = np.asarray(counts)
+        self.norms = self.counts.sum(axis=1)
+        log_norms = np.log(self.norms+1.)
+        self.weights = log_norms/np.max(log_norms)
+        has_mood = self.norms != 0
+        self.has_mood = has_mood
+        self.normalized = np.zeros(self.counts.shape)
+        self.normalized[has_mood] = (self.counts[has_mood]
+                                     / self.norms[has_mood, np.newaxis])
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Build the table from a DataFrame of emotion counts, as stored in
+        the book_emo h5 files.
+        """
+        return cls(frame.columns, frame.values)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def weight_dict(self, par_id):
+        """
+        Normalized emotions and mood weight of a paragraph.
+
+        Args:
+            par_id: paragraph id (row of the table)
+
+        Returns:
+            mood_weight_dict: dict of emotion -> weight, plus 'weight'
+        """
+        if self.has_mood[par_id]:
+            row = self.normalized[par_id]
+        else:
+            row = self.counts[par_id]
+        mood_weight_dict = dict(zip(self.emotions, row))
+        mood_weight_dict['weight'] = self.weights[par_id]
+        return mood_weight_dict
+
+
+class Lexicon(object):
+
+    def __init__(self, associations, emotions=EMOTIONS):
+        """
+        Word-emotion lexicon, coded as an integer matrix
+
+        Args:
+            associations: iterable of (word, emotion) pairs. Emotions
+                          that are not in emotions are ignored
+            emotions: emotions to count [default: EMOTIONS]
+
+        Attributes:
+            emotions: list of emotion names, the columns of matrix
+            words: list of the words with at least one emotion
+            vocab: dict of word -> row of matrix
+            matrix: int array of shape (len(words), len(emotions)), 1
+                    where the word is associated with the emotion
+        """
+        self.emotions = list(emotions)
+        columns = {emotion: i for i, emotion in enumerate(self.emotions)}
+        self.words = []
+        self.vocab = {}
+        rows, cols = array('i'), array('i')
+        for word, emotion in associations:
+            if emotion not in columns:
+                continue
+            if word not in self.vocab:
+                self.vocab[word] = len(self.words)
+                self.words.append(word)
+            rows.append(self.vocab[word])
+            cols.append(columns[emotion])
+        self.matrix = np.zeros((len(self.words), len(self.emotions)),
+                               dtype=np.int64)
+        self.matrix[np.asarray(rows, dtype=np.int64),
+                    np.asarray(cols, dtype=np.int64)] = 1
+
+    @classmethod
+    def load(cls, path, emotions=EMOTIONS):
+        """
+        Read the NRC emotion lexicon, either the word-level text file
+        (word, emotion and 0/1 association separated by tabs) or an h5
+        DataFrame with word, emo and binary columns.
+
+        Args:
+            path: path to the lexicon file
+            emotions: emotions to count [default: EMOTIONS]
+
+        Returns:
+            lexicon: Lexicon object
+        """
+        if os.path.splitext(path)[1] == '.h5':
+            import pandas
+            frame = pandas.read_hdf(path)
+            frame = frame[frame['binary'] == 1]
+            return cls(zip(frame['word'], frame['emo']), emotions)
+        associations = []
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == '1':
+                    associations.append((fields[0], fields[1]))
+        return cls(associations, emotions)
+
+    def score(self, texts):
+        """
+        Count the emotions of each text. Words are split on whitespace
+        and stripped of punctuation, then looked up exactly.
+
+        Args:
+            texts: list of paragraph texts
+
+        Returns:
+            counts: int array of emotion counts, one row per text
+            mood_words: sorted list of the emotional words of each text
+        """
+        vocab = self.vocab
+        text_ids, word_ids = array('i'), array('i')
+        mood_words = []
+        for i, text in enumerate(texts):
+            ids = [vocab[word] for word in STRIP.sub('', text).split()
+                   if word in vocab]
+            text_ids.extend([i]*len(ids))
+            word_ids.extend(ids)
+            mood_words.append(sorted(set(self.words[j] for j in ids)))
+        counts = np.zeros((len(mood_words), len(self.emotions)),
+                          dtype=np.int64)
+        if word_ids:
+            np.add.at(counts, np.frombuffer(text_ids, dtype=np.int32),
+                      self.matrix[np.frombuffer(word_ids, dtype=np.int32)])
+        return counts, mood_words
+
+
+def load_lexicon(path):
+    """
+    Load an emotion lexicon. Lexicons are loaded once per process and
+    shared.
+
+    Args:
+        path: path to the lexicon file
+
+    Returns:
+        lexicon: Lexicon object
+    """
+    path = os.path.abspath(path)
+    if path not in _LEXICONS:
+        _LEXICONS[path] = Lexicon.load(path)
+    return _LEXICONS[path]
+
+
+def read_mood_frame(mood_dir, filename, doc_id):
+    """
+    Read one doc's table from a mood h5 file.
+
+    Args:
+        mood_dir: directory of the mood files
+        filename: EMOTIONS_FILE or MOOD_WORDS_FILE
+        doc_id: id of the doc, stored under the key 'book'+doc_id
+
+    Returns:
+        frame: pandas DataFrame, or None if there is no such table
+    """
+    import pandas
+    path = os.path.join(mood_dir, filename)
+    key = 'book'+str(doc_id)
+    if not os.path.exists(path):
+        return None
+    with pandas.HDFStore(path, mode='r') as store:
+        if '/'+key not in store.keys():
+            return None
+        return store[key]
+
+
+class MoodStore(object):
+
+    def __init__(self, path):
+        """
+        Mood tables of every doc of a corpus, read from one memory
+        mapped file
+
+        The arrays are read-only views of the map, so docs and worker
+        processes opening the same file share its pages without
+        copying. Use open_mood_store to open each file once per process.
+
+        Args:
+            path: path to a file written by MoodStore.write
+
+        Attributes:
+            emotions: list of emotion names, the columns of counts
+            words: list of mood words, indexed by word id
+            books: dict of doc id -> (first row, end row)
+            counts: float32 array of emotion counts, one row per
+                    paragraph of every doc
+            word_indptr: int64 array, the mood word ids of row i are
+                         word_ids[word_indptr[i]:word_indptr[i+1]]
+            word_ids: int32 array of mood word ids
+        """
+        self.path = path
+        with io.open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_start, header_len = PREFIX.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError('{} is not a mood store'.format(path))
+        header = json.loads(self._mmap[header_start:header_start+header_len]
+                            .decode('utf-8'))
+        self.emotions = header['emotions']
+        self.words = header['words']
+        self.books = {int(doc_id): tuple(rows)
+                      for doc_id, rows in header['books'].items()}
+        arrays = {}
+        for name, (offset, dtype, shape) in header['arrays'].items():
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.frombuffer(self._mmap, dtype=dtype,
+                                             count=count,
+                                             offset=offset).reshape(shape)
+        self.counts = arrays['counts']
+        self.word_indptr = arrays['word_indptr']
+        self.word_ids = arrays['word_ids']
+
+    def __contains__(self, doc_id):
+        return doc_id in self.books
+
+    def n_paragraphs(self, doc_id):
+        """
+        Number of paragraph rows of a doc, None if it isn't stored.
+        """
+        if doc_id not in self.books:
+            return None
+        start, end = self.books[doc_id]
+        return end - start
+
+    def table(self, doc_id):
+        """
+        MoodTable of a doc.
+        """
+        from_row, to_row = self.books[doc_id]
+        # Normalize in float64 like the h5 tables, the counts are exact
+        counts = self.counts[from_row:to_row].astype(np.float64)
+        return MoodTable(self.emotions, counts)
+
+    def mood_words(self, doc_id, par_id):
+        """
+        Sorted mood words of one paragraph of a doc.
+        """
+        row = self.books[doc_id][0] + par_id
+        ids = self.word_ids[self.word_indptr[row]:self.word_indptr[row+1]]
+        return [self.words[i] for i in ids]
+
+    def iter_books(self):
+        """
+        Yields:
+            (doc_id, counts, mood_words) for every stored doc
+        """
+        for doc_id in sorted(self.books):
+            start, end = self.books[doc_id]
+            yield (doc_id, self.counts[start:end],
+                   [self.mood_words(doc_id, i) for i in range(end - start)])
+
+    def close(self):
+        self._mmap.close()
+
+    @staticmethod
+    def write(path, books, emotions=EMOTIONS):
+        """
+        Write mood tables to a new store, replacing the file atomically.
+
+        Args:
+            path: path of the store
+            books: iterable of (doc_id, counts, mood_words), with one row
+                   of counts and one list of mood words per paragraph
+            emotions: emotion names, the columns of counts
+                      [default: EMOTIONS]
+        """
+        words, vocab = [], {}
+        rows = {}
+        counts, word_indptr, word_ids = [], array('q', [0]), array('i')
+        n_rows = 0
+        for doc_id, doc_counts, doc_words in books:
+            doc_counts = np.asarray(doc_counts, dtype=np.float32)
+            doc_counts = doc_counts.reshape(len(doc_words), len(emotions))
+            counts.append(doc_counts)
+            for par_words in doc_words:
+                for word in par_words:
+                    if word not in vocab:
+                        vocab[word] = len(words)
+                        words.append(word)
+                    word_ids.append(vocab[word])
+                word_indptr.append(len(word_ids))
+            rows[str(doc_id)] = (n_rows, n_rows + len(doc_words))
+            n_rows += len(doc_words)
+        if counts:
+            counts = np.concatenate(counts)
+        else:
+            counts = np.zeros((0, len(emotions)), dtype=np.float32)
+        arrays = [('counts', counts),
+                  ('word_indptr', np.frombuffer(word_indptr, dtype=np.int64)),
+                  ('word_ids', np.frombuffer(word_ids, dtype=np.int32)
+                   if word_ids else np.zeros(0, dtype=np.int32))]
+        header = {'emotions': list(emotions), 'words': words, 'books': rows,
+                  'arrays': {}}
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with io.open(tmp_path, 'wb') as f:
+            f.write(b'\0'*PREFIX.size)
+            for name, values in arrays:
+                f.write(b'\0'*(-f.tell() % ALIGN))
+                header['arrays'][name] = (f.tell(), values.dtype.str,
+                                          values.shape)
+                f.write(values.tobytes())
+            header_start = f.tell()
+            header_bytes = json.dumps(header).encode('utf-8')
+            f.write(header_bytes)
+            f.seek(0)
+            f.write(PREFIX.pack(MAGIC, header_start, len(header_bytes)))
+        os.replace(tmp_path, path)
+        _STORES.pop(os.path.abspath(path), None)
+
+    @classmethod
+    def update(cls, path, books, emotions=EMOTIONS):
+        """
+        Add or replace docs in a store, keeping the other docs.
+
+        Args:
+            path: path of the store, created if it doesn't exist
+            books: iterable of (doc_id, counts, mood_words)
+            emotions: emotion names, the columns of counts
+                      [default: EMOTIONS]
+        """
+        books = {doc_id: (doc_id, counts, mood_words)
+                 for doc_id, counts, mood_words in books}
+        store = open_mood_store(path)
+        if store is not None and store.emotions == list(emotions):
+            for book in store.iter_books():
+                books.setdefault(book[0], book)
+        cls.write(path, [books[doc_id] for doc_id in sorted(books)],
+                  emotions)
+
+    @classmethod
+    def from_h5(cls, mood_dir, path=None):
+        """
+        Convert the book_emo and book_moo h5 files of a directory into a
+        store. Docs without a mood words table get no mood words.
+
+        Args:
+            mood_dir: directory of the h5 files
+            path: path of the store. If None, MOOD_STORE_FILE in
+                  mood_dir [default: None]
+
+        Returns:
+            store: the new MoodStore
+        """
+        import pandas
+        if path is None:
+            path = os.path.join(mood_dir, MOOD_STORE_FILE)
+        with pandas.HDFStore(os.path.join(mood_dir, EMOTIONS_FILE),
+                             mode='r') as store:
+            keys = [key.lstrip('/') for key in store.keys()]
+        doc_ids = sorted(int(key[len('book'):]) for key in keys
+                         if key.startswith('book'))
+        emotions = None
+        books = []
+        for doc_id in doc_ids:
+            frame = read_mood_frame(mood_dir, EMOTIONS_FILE, doc_id)
+            if emotions is None:
+                emotions = list(frame.columns)
+            words_frame = read_mood_frame(mood_dir, MOOD_WORDS_FILE, doc_id)
+            mood_words = [[] for _ in range(len(frame))]
+            if words_frame is not None:
+                for i, row in enumerate(words_frame.values[:len(frame)]):
+                    mood_words[i] = [word for word in row
+                                     if isinstance(word, str)]
+            books.append((doc_id, frame[emotions].values, mood_words))
+        cls.write(path, books, emotions or EMOTIONS)
+        return open_mood_store(path)
+
+
+def open_mood_store(path):
+    """
+    Open a mood store, once per process. The store is reopened if the
+    file has been rewritten.
+
+    Args:
+        path: path of the store
+
+    Returns:
+        store: MoodStore, or None if the file doesn't exist
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    if path not in _STORES or _STORES[path][0] != key:
+        _STORES[path] = (key, MoodStore(path))
+    return _STORES[path][1]
@@ -1,37 +1,120 @@
 from __future__ import unicode_literals
-import spacy
 import os
-import textacy
-import string
-from .json_dump import dump_mem_to_json
-from .find_images import search_bing_for_image, search_np_for_image
+import re
+from .json_dump import (COMPRESSION_EXTENSIONS, MemoryBatch, MemoryReader,
+                        MemoryWriter, dump_mem_to_json)
+from .cache import ParseCache
+from .extract import extract_entities, top_activities
+from .segment import SegmentedText
+from .instrument import active as active_instrumentation, stage
+from .profiles import get_profile, load_nlp
 import json
-from tqdm import tqdm
-from collections import Counter
-import pandas
-import numpy as np
+from collections import Counter, OrderedDict
+from queue import Empty
 
-print('Loading spaCy...')
-NLP = spacy.load('en')
+
+def __getattr__(name):
+    # The spaCy model used to be loaded at import time as NLP, it is
+    # now only loaded when first used
+    if name == 'NLP':
+        return load_nlp()
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
+
+
+def parse_texts(texts, batch_size=1000, n_process=1, nlp=None):
+    """
+    Parse a sequence of texts with spaCy in batches
+
+    Args:
+        texts: iterable of unicode strings to parse
+        batch_size: number of texts buffered per nlp.pipe batch
+        n_process: number of worker processes used by nlp.pipe, only
+                   passed on when above 1, as spaCy before 2.2.2 has
+                   no n_process argument
+        nlp: spaCy Language object to parse with. If None, the
+             full-memory pipeline is used [default: None]
+
+    Returns:
+        spacy_docs: list of spaCy Doc objects, in the order of texts
+    """
+    if nlp is None:
+        nlp = load_nlp()
+    kwargs = {'n_process': n_process} if n_process > 1 else {}
+    return list(nlp.pipe(texts, batch_size=batch_size, **kwargs))
 
 
 class Corpus(object):
 
-    def __init__(self, corpus_dir=None, mood_dir='mood_files'):
+    def __init__(self, corpus_dir=None, mood_dir=None,
+                 batch_size=1000, n_process=1, cache_dir=None,
+                 cache_size=None, profile='full-memory', lexicon=None,
+                 image_cache=None, image_store=None):
         """
         Corpus to extract mems from
 
         Args:
             corpus_dir: Directory containing all corpus files
+            mood_dir: Directory containing the mood h5 files. If None,
+                      'mood_files' in the working directory, or in the
+                      corpus directory when a lexicon is given
+                      [default: None]
+            batch_size: number of paragraphs per spaCy batch
+            n_process: number of processes used for spaCy parsing
+            cache_dir: directory of the parsed paragraph cache. If None,
+                       nothing is cached [default: None]
+            cache_size: maximum size of the cache in bytes
+                        [default: None]
+            profile: name of the extraction profile, one of
+                     'density-only', 'full-memory' or 'with-keyterms'
+                     [default: 'full-memory']
+            lexicon: path to the NRC emotion lexicon. If given, mood
+                     tables missing from mood_dir, or not aligned with
+                     the paragraphs, are generated with it
+                     [default: None]
+            image_cache: JSON file caching the image url of each
+                         search keyterm across runs. If None, urls are
+                         only cached for the run [default: None]
+            image_store: where found images are uploaded, as display,
+                         thumbnail and icon renditions: 's3://bucket' or
+                         a local directory. Memories then hold the keys
+                         of the display and icon renditions. If None,
+                         memories hold the search urls [default: None]
 
         Attributes:
             docs: List of Doc objects from corpus
             paragraphs: List of Paragraph objects from corpus
+            stats: EntityStats of the docs processed so far
+            image_resolver: ImageResolver used for get_img
+            image_uploader: ImageUploader to the image store
+            words: dictionary of mem words extracted from corpus
         """
         self.corpus_dir = os.path.abspath(corpus_dir)
+        if mood_dir is None:
+            mood_dir = 'mood_files'
+            if lexicon is not None:
+                mood_dir = os.path.join(self.corpus_dir, mood_dir)
         self.mood_dir = os.path.abspath(mood_dir)
+        self.lexicon = lexicon
+        if lexicon is not None:
+            self.lexicon = os.path.abspath(lexicon)
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.profile = get_profile(profile)
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ParseCache(cache_dir, load_nlp(self.profile),
+                                    max_size=cache_size,
+                                    profile=self.profile)
+        self.image_cache = image_cache
+        self.image_store = image_store
         self._docs = None
         self._paragraphs = None
+        self._stats = None
+        self._image_resolver = None
+        self._image_uploader = None
 
     @property
     def docs(self):
@@ -47,6 +130,83 @@ class Corpus(object):
                 self._paragraphs += doc.paragraphs
         return self._paragraphs
 
+    @property
+    def stats(self):
+        if self._stats is None:
+            from .stats import EntityStats
+            self._stats = EntityStats()
+        return self._stats
+
+    @property
+    def image_resolver(self):
+        if self._image_resolver is None:
+            from .find_images import ImageResolver
+            self._image_resolver = ImageResolver(self.image_cache)
+        return self._image_resolver
+
+    @image_resolver.setter
+    def image_resolver(self, resolver):
+        self._image_resolver = resolver
+
+    @property
+    def image_uploader(self):
+        if self._image_uploader is None:
+            from .image import RENDITIONS, ImageUploader, open_storage
+            self._image_uploader = ImageUploader(open_storage(self.image_store),
+                                                 renditions=RENDITIONS)
+        return self._image_uploader
+
+    @image_uploader.setter
+    def image_uploader(self, uploader):
+        self._image_uploader = uploader
+
+    @property
+    def words(self):
+        for doc in self.docs:
+            self.stats.add_doc(doc)
+        return self.stats.totals()
+
+    def config(self):
+        """
+        Arguments needed to rebuild this corpus, e.g. in a worker process
+        """
+        return {'corpus_dir': self.corpus_dir,
+                'mood_dir': self.mood_dir,
+                'batch_size': self.batch_size,
+                'n_process': self.n_process,
+                'cache_dir': self.cache_dir,
+                'cache_size': self.cache_size,
+                'profile': self.profile.name,
+                'lexicon': self.lexicon,
+                'image_cache': self.image_cache,
+                'image_store': self.image_store}
+
+    def doc_paths(self):
+        """
+        Get the path and doc id of every file in the corpus.
+
+        Returns:
+            doc_paths: list of (file_path, doc_id) tuples, sorted by path
+        """
+        # Directories, e.g. the default mood_files, are not docs
+        file_list = sorted(name for name in os.listdir(self.corpus_dir)
+                           if os.path.isfile(os.path.join(self.corpus_dir, name)))
+        doc_paths = []
+        for i, file_name in enumerate(file_list):
+            # book4.txt is doc 4, files without a number use their position
+            match = re.search(r'(\d+)\D*$', file_name)
+            doc_id = int(match.group(1)) if match else i
+            doc_paths.append((os.path.join(self.corpus_dir, file_name), doc_id))
+        return doc_paths
+
+    def load_doc(self, file_path, doc_id):
+        print('Loading '+file_path)
+        return Doc(file_path, doc_id, self,
+                   batch_size=self.batch_size,
+                   n_process=self.n_process,
+                   cache=self.cache,
+                   profile=self.profile)
+
     def read_corpus(self):
         """
         Get a list of Doc objects for every file in the corpus.
@@ -54,14 +214,8 @@ class Corpus(object):
         Returns:
             docs: list of pensieve.Doc objects
         """
-        file_list = os.listdir(self.corpus_dir)
-        file_paths = [os.path.join(self.corpus_dir, f) for f in file_list]
-        docs = []
-        for file_path in file_paths:
-            i = int(file_path[-5:-4])
-            print('Loading '+file_path)
-            docs.append(Doc(file_path, i, self))
-        return docs
+        return [self.load_doc(file_path, i)
+                for file_path, i in self.doc_paths()]
 
     def find_character_paragraphs(self, char_name, density_cut=0.8):
         """
@@ -87,7 +241,10 @@ class Corpus(object):
         return char_pars
 
     def gather_corpus_memories(self, char_name, density_cut=0.8,
-                               n_verbs=3, save=None, get_img=False):
+                               n_verbs=3, save=None, get_img=False,
+                               n_jobs=1, min_words=None, keywords=None,
+                               stream=False, compression=None,
+                               normalize=False):
         """
         Collects memories from all character paragraphs in the corpus.
 
@@ -104,25 +261,237 @@ class Corpus(object):
                   not saved
             get_img: get an image url (set to False by default to avoid
                      using up all the API calls)
+            n_jobs: number of worker processes. Each worker loads its
+                    own docs and spaCy model; the memories are returned
+                    in corpus order [default: 1]
+            min_words: only consider paragraphs with at least this many
+                       words [default: None]
+            keywords: only consider paragraphs containing one of these
+                      words [default: None]
+            stream: write each memory to a JSON lines file in save as
+                    soon as it is made, and return lazy MemoryReader
+                    objects instead of lists [default: False]
+            compression: compression of the streamed files, 'gzip' or
+                         'zstd' [default: None]
+            normalize: return MemoryBatch objects, which store each
+                       distinct concept once, instead of lists. Saved
+                       files hold the batch [default: False]
 
         Returns:
-            memories: list of memories, ready to be put in DB
+            memories: list of memories, ready to be put in DB, a
+                      MemoryReader of the streamed files or a MemoryBatch
         """
-        memories = []
-        for doc in self.docs:
-            doc_mems = doc.gather_doc_memories(char_name,
-                                               density_cut=density_cut,
-                                               n_verbs=n_verbs,
-                                               save=save,
-                                               get_img=get_img)
-            for mem in doc_mems:
-                memories.append(mem)
+        kwargs = {'density_cut': density_cut, 'n_verbs': n_verbs,
+                  'save': save, 'get_img': get_img,
+                  'min_words': min_words, 'keywords': keywords,
+                  'stream': stream, 'compression': compression,
+                  'normalize': normalize}
+        if n_jobs > 1:
+            doc_mems = self._map_docs_parallel('gather_doc_memories',
+                                               char_name, n_jobs, **kwargs)
+        else:
+            doc_mems = (doc.gather_doc_memories(char_name, **kwargs)
+                        for doc in self.docs)
+        memories = _empty_memories(stream, normalize)
+        for mems in doc_mems:
+            memories = _concat_memories(memories, mems)
         return memories
 
+    def gather_cast_memories(self, cast, density_cut=0.8, n_verbs=3,
+                             save=None, get_img=False, n_jobs=1,
+                             min_words=None, keywords=None, stream=False,
+                             compression=None, normalize=False):
+        """
+        Collects memories for several characters in one pass over the
+        corpus. Every paragraph is parsed and extracted once, however
+        many characters it is selected for.
+
+        Args:
+            cast: dict of character name -> list of aliases, or a list
+                  whose items are a name or a list of aliases
+            density_cut: mentions/sentences cut to select paragraphs
+                         constituting memory
+            n_verbs: number of verbs kept in each memory
+            save: save per character, per book mem JSON files to this
+                  path. If None, files are not saved
+            get_img: get an image url (set to False by default to avoid
+                     using up all the API calls)
+            n_jobs: number of worker processes [default: 1]
+            min_words: only consider paragraphs with at least this many
+                       words [default: None]
+            keywords: only consider paragraphs containing one of these
+                      words [default: None]
+            stream: write each memory to a JSON lines file in save as
+                    soon as it is made, and return lazy MemoryReader
+                    objects instead of lists [default: False]
+            compression: compression of the streamed files, 'gzip' or
+                         'zstd' [default: None]
+            normalize: return MemoryBatch objects, which store each
+                       distinct concept once, instead of lists. Saved
+                       files hold the batch [default: False]
+
+        Returns:
+            memories: dict of character name -> list of memories,
+                      MemoryReader of the streamed files or MemoryBatch,
+                      in corpus order
+        """
+        cast = normalize_cast(cast)
+        kwargs = {'density_cut': density_cut, 'n_verbs': n_verbs,
+                  'save': save, 'get_img': get_img,
+                  'min_words': min_words, 'keywords': keywords,
+                  'stream': stream, 'compression': compression,
+                  'normalize': normalize}
+        if n_jobs > 1:
+            doc_mems = self._map_docs_parallel('gather_cast_memories',
+                                               cast, n_jobs, **kwargs)
+        else:
+            doc_mems = (doc.gather_cast_memories(cast, **kwargs)
+                        for doc in self.docs)
+        memories = OrderedDict((name, _empty_memories(stream, normalize))
+                               for name in cast)
+        for mems in doc_mems:
+            for name in cast:
+                memories[name] = _concat_memories(memories[name], mems[name])
+        return memories
+
+    def _map_docs_parallel(self, method, characters, n_jobs, **kwargs):
+        """
+        Call a Doc memory gathering method on every doc of the corpus in
+        a pool of worker processes.
+
+        Returns:
+            results: list of the results for each doc, in corpus order
+        """
+        from concurrent.futures import ProcessPoolExecutor, wait
+        from multiprocessing import Manager
+        from tqdm import tqdm
+        doc_paths = self.doc_paths()
+        if self.lexicon is not None:
+            # Score missing docs here, workers would race to rewrite the
+            # mood store
+            for doc in self.docs:
+                doc.mood_store
+        # Workers already run in parallel, don't nest nlp.pipe pools
+        config = self.config()
+        config['n_process'] = 1
+        # Workers instrument their docs when this process is instrumented
+        run = active_instrumentation()
+        with Manager() as manager, \
+                ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            queue = manager.Queue()
+            futures = [pool.submit(_doc_memories_worker, config, file_path,
+                                   doc_id, method, characters, kwargs,
+                                   queue,
+                                   None if run is None else run.settings())
+                       for file_path, doc_id in doc_paths]
+            progress = {}
+            bar = tqdm(total=0)
+            pending = futures
+            while pending:
+                done, pending = wait(pending, timeout=0.2)
+                _update_progress(bar, progress, queue)
+            _update_progress(bar, progress, queue)
+            bar.close()
+            results = []
+            for future in futures:
+                result, stats, profiles = future.result()
+                if run is not None:
+                    run.merge(stats, profiles)
+                results.append(result)
+            return results
+
+
+def normalize_cast(cast):
+    """
+    Turn a cast of characters into an ordered dict of name -> aliases.
+
+    Args:
+        cast: dict of name -> aliases, or a list whose items are a name
+              or a list of aliases
+
+    Returns:
+        cast: OrderedDict of character name -> list of aliases
+    """
+    if isinstance(cast, dict):
+        items = cast.items()
+    else:
+        items = []
+        for aliases in cast:
+            if isinstance(aliases, str):
+                items.append((aliases, [aliases]))
+            else:
+                items.append((' '.join(aliases), list(aliases)))
+    normalized = OrderedDict()
+    for name, aliases in items:
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        normalized[name] = list(aliases)
+    return normalized
+
+
+def _empty_memories(stream=False, normalize=False):
+    """
+    Empty memories of the type returned by the gather methods.
+    """
+    if stream:
+        return MemoryReader([])
+    if normalize:
+        return MemoryBatch()
+    return []
+
+
+def _concat_memories(memories, more):
+    """
+    Concatenate two lists, MemoryReader or MemoryBatch of memories.
+    """
+    if isinstance(memories, MemoryBatch):
+        return memories.extend(more)
+    return memories + more
+
+
+def _doc_memories_worker(config, file_path, doc_id, method, characters,
+                         kwargs, queue, instrument=None):
+    from .instrument import Instrumentation
+    corpus = Corpus(**config)
+    doc = corpus.load_doc(file_path, doc_id)
+
+    def progress(doc_id, n_done, n_total):
+        queue.put((doc_id, n_done, n_total))
+
+    if instrument is None:
+        return getattr(doc, method)(characters, progress=progress,
+                                    **kwargs), None, None
+    # instrument holds the settings of the parent's Instrumentation
+    with Instrumentation(**instrument) as run:
+        result = getattr(doc, method)(characters, progress=progress,
+                                      **kwargs)
+    return result, run.stats_json(), run.profile_data()
+
+
+def _update_progress(bar, progress, queue):
+    """
+    Drain (doc_id, n_done, n_total) messages from worker processes into
+    a single tqdm bar.
+    """
+    updated = False
+    while True:
+        try:
+            doc_id, n_done, n_total = queue.get_nowait()
+        except Empty:
+            break
+        progress[doc_id] = (n_done, n_total)
+        updated = True
+    if updated:
+        bar.total = sum(n_total for n_done, n_total in progress.values())
+        bar.update(sum(n_done for n_done, n_total in progress.values())
+                   - bar.n)
+
 
 class Doc(object):
 
-    def __init__(self, path_to_text, doc_id=None, corpus=None):
+    def __init__(self, path_to_text, doc_id=None, corpus=None,
+                 batch_size=1000, n_process=1, cache=None,
+                 profile='full-memory'):
         """
         Document level object
 
@@ -131,76 +500,293 @@ class Doc(object):
             id: index of doc in corpus [default: None]
             corpus: Corpus object containing document
                     [default: None]
+            batch_size: number of paragraphs per spaCy batch
+                        [default: 1000]
+            n_process: number of processes used for spaCy parsing
+                       [default: 1]
+            cache: ParseCache to read parsed paragraphs from and
+                   store them in [default: None]
+            profile: name of the extraction profile
+                     [default: 'full-memory']
 
         Attributes:
-            text: unicode string of text in document
+            text: unicode string of text in document, read on first
+                  use
+            segments: SegmentedText giving paragraph texts by id
+                      straight from the file
+            paragraph_texts: list of paragraph text strings, without
+                             any NLP parsing
             paragraphs: list of Paragraph objects for paragraph in doc
             words: dictionary of mem words extracted from doc
+            mention_index: MentionIndex of the people mentioned in
+                           each paragraph, built on first use
+            mood_table: MoodTable of normalized emotions and mood
+                        weights for every paragraph, built on first use
+            mood_store: MoodStore of the corpus holding this doc, or
+                        None to read the h5 tables
         """
         self.path_to_text = path_to_text
         self.id = doc_id
         self.corpus = corpus
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache = cache
+        self.profile = get_profile(profile)
         self.mood_dir = corpus.mood_dir
-        self.text = open(path_to_text, 'r').read()
+        self.lexicon = corpus.lexicon
+        self.segments = SegmentedText(path_to_text)
+        self._text = None
+        self._paragraph_texts = None
         self._paragraphs = None
         self._words = None
-        self.mood_weights = pandas.read_hdf(os.path.join(self.mood_dir, 'book_emo_v2.h5'),
-                                            key='book'+str(self.id))
-        self.mood_words = pandas.read_hdf(os.path.join(self.mood_dir, 'book_moo_v2.h5'),
-                                          key='book'+str(self.id))
+        self._mood_weights = None
+        self._mood_words = None
+        self._mood_table = None
+        self._mood_store = None
+        self._mention_index = None
+
+    @property
+    def nlp(self):
+        return load_nlp(self.profile)
+
+    @property
+    def mood_weights(self):
+        if self._mood_weights is None:
+            from .mood import EMOTIONS_FILE
+            self._mood_weights = self._read_mood_frame(EMOTIONS_FILE)
+        return self._mood_weights
+
+    @property
+    def mood_words(self):
+        if self._mood_words is None:
+            from .mood import MOOD_WORDS_FILE
+            self._mood_words = self._read_mood_frame(MOOD_WORDS_FILE)
+        return self._mood_words
+
+    def _read_mood_frame(self, filename):
+        from .mood import read_mood_frame
+        frame = read_mood_frame(self.mood_dir, filename, self.id)
+        if frame is None:
+            raise IOError('No book{} table in {}'
+                          .format(self.id, os.path.join(self.mood_dir, filename)))
+        return frame
+
+    @property
+    def mood_store(self):
+        """
+        MoodStore of the corpus if it holds this doc, otherwise None and
+        the h5 tables are read. With a lexicon, the doc is scored into
+        the store when it is missing or not aligned with the paragraphs.
+        """
+        if self._mood_store is None:
+            from .mood import MOOD_STORE_FILE, open_mood_store
+            path = os.path.join(self.mood_dir, MOOD_STORE_FILE)
+            store = open_mood_store(path)
+            if self.lexicon is not None and (store is None or store.n_paragraphs(self.id) != len(self.segments)):
+                self.score_mood()
+                store = open_mood_store(path)
+            self._mood_store = store if store is not None and self.id in store else False
+        return self._mood_store or None
+
+    def score_mood(self):
+        """
+        Score the paragraphs of the doc with the corpus lexicon and add
+        them to the mood store in mood_dir. Rows follow the paragraph
+        ids.
+        """
+        from .mood import MOOD_STORE_FILE, MoodStore, load_lexicon
+        lexicon = load_lexicon(self.lexicon)
+        counts, mood_words = lexicon.score(self.segments)
+        MoodStore.update(os.path.join(self.mood_dir, MOOD_STORE_FILE),
+                         [(self.id, counts, mood_words)], lexicon.emotions)
+        self._mood_store = None
+        self._mood_table = None
+
+    @property
+    def mood_table(self):
+        if self._mood_table is None:
+            from .mood import MoodTable
+            with stage('mood', self.id) as s:
+                if self.mood_store is not None:
+                    self._mood_table = self.mood_store.table(self.id)
+                else:
+                    self._mood_table = MoodTable.from_frame(self.mood_weights)
+                s.items_out = len(self._mood_table.weights)
+        return self._mood_table
+
+    def paragraph_mood_words(self, par_id):
+        """
+        Mood words of a paragraph, from the mood store or the h5 table.
 
+        Args:
+            par_id: paragraph id
+
+        Returns:
+            mood_words: list of strings
+        """
+        if self.mood_store is not None:
+            return self.mood_store.mood_words(self.id, par_id)
+        return list(self.mood_words.iloc[par_id].dropna())
+
+    @property
+    def text(self):
+        if self._text is None:
+            with stage('read', self.id) as s, open(self.path_to_text, 'r') as f:
+                self._text = f.read()
+                s.bytes = f.tell()
+        return self._text
+
+    def segment(self):
+        """
+        Split the document text into paragraph texts. Lines with at
+        least 25 words are paragraphs on their own, shorter lines and
+        the quoted lines following them are chunked together.
 
+        Returns:
+            texts: list of paragraph text strings, in document order
+        """
+        return list(self.segments)
+
+    @property
+    def paragraph_texts(self):
+        if self._paragraph_texts is None:
+            with stage('segment', self.id) as s:
+                self._paragraph_texts = self.segment()
+                s.items_out = len(self._paragraph_texts)
+                s.bytes = os.path.getsize(self.path_to_text)
+        return self._paragraph_texts
 
     @property
     def paragraphs(self):
         if not self._paragraphs:
             print('Generating memories for doc '+str(self.id))
-            self._paragraphs = []
-            line_list = self.text.split('\n')
-            myIterator = iter(enumerate(line_list))
-            tuple = next(myIterator, None)
-            j = 0
-            while tuple is not None:
-                i, line = tuple
-                if len(line.strip()) == 0:
-                    pass
-                elif len(line.split(' ')) >= 25:
-                    self._paragraphs.append(Paragraph(line, j, self))
-                    j += 1
-                else:
-                    chunk = ""
-                    while (tuple is not None) and (len(line.split(' ')) < 25 or line[0] == "'" or line[0] == '"'):
-                        chunk = chunk + "\n" + line
-                        tuple = next(myIterator, None)
-                        if tuple is not None:
-                            i, line = tuple
-                    self._paragraphs.append(Paragraph(chunk, j, self))
-                    j += 1
-                    continue
-                tuple = next(myIterator, None)
+            # Paragraphs read their text from the segment index when
+            # asked, the book is not decoded up front
+            with stage('segment', self.id) as s:
+                self._paragraphs = [Paragraph(None, j, self)
+                                    for j in range(len(self.segments))]
+                s.items_out = len(self._paragraphs)
+                s.bytes = os.path.getsize(self.path_to_text)
         return self._paragraphs
 
+    def parse(self, paragraphs=None):
+        """
+        Parse paragraphs with spaCy in batches. Paragraphs that have
+        already been parsed are skipped, and paragraphs found in the
+        parse cache are loaded from it instead of being parsed.
+
+        Args:
+            paragraphs: list of Paragraph objects to parse. If None,
+                        every paragraph in the doc is parsed
+                        [default: None]
+
+        Returns:
+            paragraphs: the list of parsed Paragraph objects
+        """
+        if paragraphs is None:
+            paragraphs = self.paragraphs
+        unparsed = [par for par in paragraphs if not par.is_parsed]
+        if not unparsed:
+            return paragraphs
+        with stage('parse', self.id, items_in=len(unparsed)) as s:
+            if self.cache is not None:
+                misses = []
+                for par in unparsed:
+                    entry = self.cache.get(par.text)
+                    if entry is None:
+                        misses.append(par)
+                    else:
+                        par.spacy_doc, par.entities = entry
+                unparsed = misses
+            texts = [par.text for par in unparsed]
+            spacy_docs = parse_texts(texts,
+                                     batch_size=self.batch_size,
+                                     n_process=self.n_process,
+                                     nlp=self.nlp)
+            for par, spacy_doc in zip(unparsed, spacy_docs):
+                par.spacy_doc = spacy_doc
+                if self.cache is not None:
+                    self.cache.put(par.text, spacy_doc, par.entities)
+            # Paragraphs read from the parse cache are not counted
+            s.items_out = len(spacy_docs)
+            s.bytes = sum(len(text) for text in texts)
+        return paragraphs
+
     @property
     def words(self):
-        if not self._words:
-            self._words = {'times': Counter(),
-                           'activities': Counter(),
-                           'people': Counter(),
-                           'places': Counter(),
-                           'things': Counter()}
-            for par in self.paragraphs:
-                for key in self._words:
-                    self._words[key] += par.words[key]
-            for key in self.words['people']:
-                # people are not places
-                if (2.5)*(self.words['people'][key]) > self.words['places'][key]:
-                    del self.words['places'][key]
-                # people are not things
-                if self.words['people'][key] > 5:
-                    del self.words['things'][key]
+        if self._words is None:
+            stats = self.corpus.stats
+            stats.add_doc(self)
+            # people are not places and people are not things
+            self._words = stats.totals(doc_id=self.id)
         return self._words
 
-    def find_character_paragraphs(self, char_name, density_cut=0.8):
+    @property
+    def mention_index(self):
+        return self.index_mentions(self.paragraphs)
+
+    def index_mentions(self, paragraphs):
+        """
+        Make sure paragraphs are in the mention index of the doc,
+        parsing the ones that are not yet. The index is built once and
+        grows as more paragraphs are parsed.
+
+        Args:
+            paragraphs: list of Paragraph objects of this doc
+
+        Returns:
+            index: MentionIndex over every paragraph position of the
+                   doc, where only indexed paragraphs can be selected
+        """
+        from .mentions import MentionIndex
+        if self._mention_index is None:
+            self._mention_index = MentionIndex.empty(len(self.paragraphs))
+        index = self._mention_index
+        new = [par for par in paragraphs if not index.indexed[par.id]]
+        if new:
+            self.parse(new)
+            index.update([par.id for par in new],
+                         [len(list(par.spacy_doc.sents)) for par in new],
+                         [par.words['people'] for par in new])
+        return index
+
+    def candidate_paragraphs(self, min_mood_weight=0., min_words=None,
+                             keywords=None):
+        """
+        Find the paragraphs that can become memories, using only
+        predicates that don't need spaCy.
+
+        Args:
+            min_mood_weight: only keep paragraphs with a mood weight
+                             above this [default: 0.]
+            min_words: only keep paragraphs with at least this many
+                       words [default: None]
+            keywords: only keep paragraphs containing one of these
+                      words [default: None]
+
+        Returns:
+            candidates: list of unparsed Paragraph objects, in order
+        """
+        import numpy as np
+        with stage('filter', self.id, items_in=len(self.paragraphs)) as s:
+            moody = np.flatnonzero(self.mood_table.weights > min_mood_weight)
+            candidates = [self.paragraphs[i] for i in moody
+                          if i < len(self.paragraphs)]
+            if min_words is not None:
+                candidates = [par for par in candidates
+                              if len(par.text.split()) >= min_words]
+            if keywords:
+                if isinstance(keywords, str):
+                    keywords = [keywords]
+                pattern = re.compile(r'\b(?:{})\b'.format(
+                    '|'.join(re.escape(keyword) for keyword in keywords)))
+                candidates = [par for par in candidates
+                              if pattern.search(par.text)]
+            s.items_out = len(candidates)
+        return candidates
+
+    def find_character_paragraphs(self, char_name, density_cut=0.8,
+                                  paragraphs=None):
         """
         Find paragraphs in the corpus where character is mentioned
         heavily.
@@ -210,28 +796,31 @@ class Doc(object):
                          accept a list of aliases
             density_cut: Only return paragraphs that pass this cut on
                          (number of mentions)/(number of sentences)
+            paragraphs: only search these paragraphs, which are the
+                        only ones parsed. If None, search the whole doc
+                        [default: None]
 
         Returns:
             character_paragraphs: list of Paragraph objects in doc that
                                   pass the density cut
         """
-        if isinstance(char_name, str):
-            char_name = [char_name]
-        char_pars = []
-        for par in self.paragraphs:
-            n_sentences = len(list(par.spacy_doc.sents))
-            if n_sentences == 0:
-                continue
-            mentions = 0
-            for alias in char_name:
-                mentions += par.words['people'][alias]
-            density = mentions/n_sentences
-            if density > density_cut:
-                char_pars.append(par)
+        import numpy as np
+        if paragraphs is None:
+            paragraphs = self.paragraphs
+        with stage('select', self.id, items_in=len(paragraphs)) as s:
+            index = self.index_mentions(paragraphs)
+            keep = np.zeros(len(index), dtype=bool)
+            keep[[par.id for par in paragraphs]] = True
+            positions = index.select(char_name, density_cut)
+            char_pars = [self.paragraphs[i] for i in positions[keep[positions]]]
+            s.items_out = len(char_pars)
         return char_pars
 
     def gather_doc_memories(self, char_name, density_cut=0.8,
-                            n_verbs=3, save=None, get_img=False):
+                            n_verbs=3, save=None, get_img=False,
+                            progress=None, min_words=None, keywords=None,
+                            stream=False, compression=None,
+                            normalize=False):
         """
         Collects memories from character paragraphs.
 
@@ -247,50 +836,359 @@ class Doc(object):
                   not saved
             get_img: get an image url (set to False by default to avoid
                      using up all the API calls)
+            progress: callable taking (doc_id, n_done, n_total), called
+                      as memories are generated. If None, a tqdm bar is
+                      shown instead [default: None]
+            min_words: only consider paragraphs with at least this many
+                       words [default: None]
+            keywords: only consider paragraphs containing one of these
+                      words [default: None]
+            stream: write each memory to a JSON lines file in save as
+                    soon as it is made, and return a lazy
+                    MemoryReader instead of a list [default: False]
+            compression: compression of the streamed files, 'gzip' or
+                         'zstd' [default: None]
+            normalize: return MemoryBatch objects, which store each
+                       distinct concept once, instead of lists. Saved
+                       files hold the batch [default: False]
 
         Returns:
-            memories: list of sanitized memories, ready to be put in DB
-        """
-        memories = []
-        char_pars = self.find_character_paragraphs(char_name, density_cut)
-        moody_pars = [par for par in char_pars if par.words['mood_weight']['weight'] > 0]
-        for par in tqdm(moody_pars):
-            mem_dict = par.gen_mem_dict(char_name, n_verbs, get_img=get_img)
-            json_mem = dump_mem_to_json(mem_dict)
-            memories.append(json_mem)
-        if save is not None:
-            if isinstance(char_name, str):
-                filebase = char_name.replace(' ', '_').lower().strip()
+            memories: list of sanitized memories, ready to be put in DB,
+                      a MemoryReader of the streamed file or a MemoryBatch
+        """
+        # Paragraphs without mood are dropped before any parsing
+        candidates = self.candidate_paragraphs(min_words=min_words,
+                                               keywords=keywords)
+        moody_pars = self.find_character_paragraphs(char_name, density_cut,
+                                                    paragraphs=candidates)
+        if progress is None:
+            from tqdm import tqdm
+            par_iter = tqdm(moody_pars)
+        else:
+            par_iter = moody_pars
+            progress(self.id, 0, len(moody_pars))
+
+        images = {}
+        if get_img:
+            images = self.resolve_images(moody_pars)
+
+        def gen_mem_dicts():
+            for n_done, par in enumerate(par_iter):
+                mem_dict = par.gen_mem_dict(char_name, n_verbs)
+                mem_dict.update(images.get(par.id, {}))
+                yield mem_dict
+                if progress is not None:
+                    progress(self.id, n_done+1, len(moody_pars))
+
+        return self.collect_memories(gen_mem_dicts(), char_name, save,
+                                     stream, compression, normalize)
+
+    def gather_cast_memories(self, cast, density_cut=0.8, n_verbs=3,
+                             save=None, get_img=False, progress=None,
+                             min_words=None, keywords=None, stream=False,
+                             compression=None, normalize=False):
+        """
+        Collects memories from the paragraphs of several characters.
+        Paragraphs selected for more than one character are parsed,
+        extracted and given an image only once.
+
+        Args:
+            cast: dict of character name -> list of aliases, or a list
+                  whose items are a name or a list of aliases
+            density_cut: mentions/sentences cut to select paragraphs
+                         constituting memory
+            n_verbs: number of verbs kept in each memory
+            save: save mem JSON files for each character to this path.
+                  If None, files are not saved
+            get_img: get an image url (set to False by default to avoid
+                     using up all the API calls)
+            progress: callable taking (doc_id, n_done, n_total), called
+                      as paragraphs are processed. If None, a tqdm bar is
+                      shown instead [default: None]
+            min_words: only consider paragraphs with at least this many
+                       words [default: None]
+            keywords: only consider paragraphs containing one of these
+                      words [default: None]
+            stream: write each memory to a JSON lines file in save as
+                    soon as it is made, and return lazy
+                    MemoryReader objects instead of lists [default: False]
+            compression: compression of the streamed files, 'gzip' or
+                         'zstd' [default: None]
+            normalize: return MemoryBatch objects, which store each
+                       distinct concept once, instead of lists. Saved
+                       files hold the batch [default: False]
+
+        Returns:
+            memories: dict of character name -> list of sanitized
+                      memories, ready to be put in DB, MemoryReader of
+                      the streamed files or MemoryBatch
+        """
+        cast = normalize_cast(cast)
+        # Paragraphs without mood are dropped before any parsing
+        candidates = self.candidate_paragraphs(min_words=min_words,
+                                               keywords=keywords)
+        char_pars = OrderedDict()
+        for name, aliases in cast.items():
+            char_pars[name] = self.find_character_paragraphs(
+                aliases, density_cut, paragraphs=candidates)
+        shared_pars = sorted(set(par for pars in char_pars.values()
+                                 for par in pars),
+                             key=lambda par: par.id)
+        if progress is None:
+            from tqdm import tqdm
+            par_iter = tqdm(shared_pars)
+        else:
+            par_iter = shared_pars
+            progress(self.id, 0, len(shared_pars))
+        for n_done, par in enumerate(par_iter):
+            # Extract once, every character reuses the record
+            par.entities
+            if progress is not None:
+                progress(self.id, n_done+1, len(shared_pars))
+        images = {}
+        if get_img:
+            images = self.resolve_images(shared_pars)
+
+        def gen_mem_dicts(aliases, pars):
+            for par in pars:
+                mem_dict = par.gen_mem_dict(aliases, n_verbs)
+                mem_dict.update(images.get(par.id, {}))
+                yield mem_dict
+
+        memories = OrderedDict()
+        for name, aliases in cast.items():
+            memories[name] = self.collect_memories(
+                gen_mem_dicts(aliases, char_pars[name]), aliases, save,
+                stream, compression, normalize)
+        return memories
+
+    def save_memories(self, memories, char_name, save):
+        """
+        Write the memories of a character in this doc to a JSON file.
+
+        Args:
+            memories: list of memories
+            char_name: name of character or list of aliases, used to
+                       name the file
+            save: directory to write the file to
+
+        Returns:
+            path: path of the written file
+        """
+        path = self.memory_path(char_name, save)
+        with open(path, 'w') as f:
+            json.dump(memories, f, indent=4)
+        return path
+
+    def memory_path(self, char_name, save, extension='.json'):
+        """
+        Path of the memory file of a character in this doc. The doc id
+        is always part of the name, so the docs of a corpus saving to
+        the same directory don't overwrite each other.
+
+        Args:
+            char_name: name of character or list of aliases
+            save: directory of the memory files
+            extension: file extension [default: '.json']
+
+        Returns:
+            path: path of the file
+        """
+        if isinstance(char_name, str):
+            char_name = [char_name]
+        filebase = '_'.join(char_name)+'_book'+str(self.id)
+        filebase = filebase.replace(' ', '_').lower().strip()
+        return os.path.join(save, filebase+extension)
+
+    def known_people(self):
+        """
+        People of the doc, without parsing anything: all of them once
+        the doc words are built, otherwise those of the paragraphs
+        extracted so far, which include the memory candidates.
+
+        Returns:
+            people: set of names
+        """
+        if self._words is not None:
+            return set(self._words['people'])
+        return set(name.strip() for par in self.paragraphs
+                   if par._entities is not None
+                   for name in par.entities.people)
+
+    def resolve_images(self, paragraphs):
+        """
+        Find an image for each paragraph. Keyterms shared by several
+        paragraphs are searched once, through the corpus image resolver
+        and its cache. If the corpus has an image store, the images are
+        uploaded there and the keys of their renditions are used instead
+        of the search urls.
+
+        Args:
+            paragraphs: list of Paragraph objects
+
+        Returns:
+            images: dict of paragraph id -> dict of img_url and
+                    icon_url
+        """
+        with stage('images', self.id, items_in=len(paragraphs)) as s:
+            images = self._resolve_images(paragraphs)
+            s.items_out = sum(1 for image in images.values()
+                              if image['img_url'])
+        return images
+
+    def _resolve_images(self, paragraphs):
+        people = self.known_people()
+        keyterms = dict((par.id, par.image_keyterm(people))
+                        for par in paragraphs)
+        urls = self.corpus.image_resolver.resolve(keyterms.values())
+        images = dict((par_id, {'img_url': urls[keyterm], 'icon_url': ''})
+                      for par_id, keyterm in keyterms.items())
+        if self.corpus.image_store is None:
+            return images
+        found = sorted(set(url for url in urls.values() if url))
+        uploaded = dict(zip(found, self.corpus.image_uploader.upload(found)))
+        for image in images.values():
+            success, keys = uploaded.get(image['img_url'], (False, None))
+            if success:
+                image['img_url'] = keys['display']
+                image['icon_url'] = keys['icon']
             else:
-                filebase = '_'.join(char_name)+'_book'+str(self.id)
-                filebase = filebase.replace(' ', '_').lower().strip()
-            path = os.path.join(save, filebase+'.json')
-            with open(path, 'w') as f:
-                json.dump(memories, f, indent=4)
+                image['img_url'] = ''
+        return images
+
+    def collect_memories(self, mem_dicts, char_name, save=None,
+                         stream=False, compression=None, normalize=False):
+        """
+        Turn mem_dicts into memories, in the form asked of the gather
+        methods, and save them.
+
+        Args:
+            mem_dicts: iterable of mem_dicts from Paragraph.gen_mem_dict
+            char_name: name of character or list of aliases
+            save: directory to save the memories to. If None, they are
+                  not saved [default: None]
+            stream: write the memories to a JSON lines file one by one
+                    [default: False]
+            compression: compression of the streamed file, 'gzip' or
+                         'zstd' [default: None]
+            normalize: collect the memories in a MemoryBatch
+                       [default: False]
+
+        Returns:
+            memories: list of memories, MemoryReader or MemoryBatch
+        """
+        if stream:
+            if normalize:
+                raise ValueError('Streamed memories cannot be normalized')
+            if save is None:
+                raise ValueError('Streaming memories needs a save directory')
+        # mem_dicts are generated as they are consumed, so the parsing
+        # and extraction they need are nested stages of serialize
+        with stage('serialize', self.id) as s:
+            path = None
+            if stream:
+                extension = '.jsonl' + COMPRESSION_EXTENSIONS[compression]
+                path = self.memory_path(char_name, save, extension)
+                with MemoryWriter(path, compression=compression) as sink:
+                    for mem_dict in mem_dicts:
+                        sink.add(mem_dict)
+                s.items_out = sink.n_written
+                memories = MemoryReader(path)
+            elif normalize:
+                memories = MemoryBatch()
+                for mem_dict in mem_dicts:
+                    memories.add(mem_dict)
+                s.items_out = len(memories.memories)
+                if save is not None:
+                    path = self.memory_path(char_name, save, '.batch.json')
+                    memories.save(path)
+            else:
+                memories = [dump_mem_to_json(mem_dict) for mem_dict in mem_dicts]
+                s.items_out = len(memories)
+                if save is not None:
+                    path = self.save_memories(memories, char_name, save)
+            if path is not None:
+                s.bytes = os.path.getsize(path)
         return memories
 
 
 class Paragraph(object):
 
-    def __init__(self, text, par_id=None, doc=None):
+    def __init__(self, text, par_id=None, doc=None, spacy_doc=None):
         """
         Paragraph level object
 
         Args:
-            text: text of paragraph
+            text: text of paragraph. If None, it is read from the
+                  segments of doc on first use
             par_id: index of paragraph in doc
             doc: Document object containing paragraph
                  [default: None]
+            spacy_doc: already parsed spaCy Doc for text. If None,
+                       nothing is parsed until spacy_doc is first used,
+                       usually by a batched Doc.parse, which also reads
+                       the parse cache [default: None]
 
         Attributes:
-            spacy_doc: spaCy Doc object
-            words: dictionary of all words extracted with spaCy
+            text: text of paragraph
+            spacy_doc: spaCy Doc object, set by Doc.parse or parsed on
+                       its own on first use
+            entities: Entities record of everything extracted from
+                      spacy_doc, built on first use
+            words: dictionary of all words extracted with spaCy,
+                   built on first use
         """
         self.doc = doc
-        self.text = text
         self.id = par_id
-        self.spacy_doc = NLP(text)
-        self.words = self.build_words_dict()
+        self._text = text
+        self._spacy_doc = spacy_doc
+        self._entities = None
+        self._words = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.doc.segments[self.id]
+        return self._text
+
+    @property
+    def is_parsed(self):
+        return self._spacy_doc is not None
+
+    @property
+    def spacy_doc(self):
+        if self._spacy_doc is None:
+            nlp = load_nlp() if self.doc is None else self.doc.nlp
+            self._spacy_doc = nlp(self.text)
+        return self._spacy_doc
+
+    @spacy_doc.setter
+    def spacy_doc(self, spacy_doc):
+        self._spacy_doc = spacy_doc
+        self._entities = None
+        self._words = None
+
+    @property
+    def entities(self):
+        if self._entities is None:
+            profile = None if self.doc is None else self.doc.profile
+            spacy_doc = self.spacy_doc
+            doc_id = None if self.doc is None else self.doc.id
+            with stage('extract', doc_id, items_in=1) as s:
+                self._entities = extract_entities(spacy_doc, profile)
+                s.items_out = 1
+        return self._entities
+
+    @entities.setter
+    def entities(self, entities):
+        self._entities = entities
+        self._words = None
+
+    @property
+    def words(self):
+        if self._words is None:
+            self._words = self.build_words_dict()
+        return self._words
 
     def extract_times(self):
         """
@@ -298,11 +1196,7 @@ class Paragraph(object):
         
         Returns: List of strings representing times
         """
-        times = []
-        include_types = ['DATE', 'TIME', 'EVENT']
-        for time in textacy.extract.named_entities(self.spacy_doc,
-                                                   include_types=include_types):
-            times.append(time.text)
+        times = list(self.entities.times)
         times.append('Book '+str(self.doc.id))
         times.append('Par. '+str(self.id))
         return times
@@ -313,13 +1207,7 @@ class Paragraph(object):
         
         Returns: List of strings representing verbs
         """
-        verb_ranking = [(x, x.rank) for x in textacy.spacy_utils.get_main_verbs_of_sent(self.spacy_doc)]
-        verbs = []
-        for verb in sorted(verb_ranking, key=lambda x: -x[1])[:n_verbs]:
-            text = verb[0].lemma_
-            if text[0] in string.ascii_lowercase:
-                verbs.append(text)
-        return verbs
+        return top_activities(self.entities.verbs, n_verbs)
 
     def extract_people(self):
         """
@@ -327,21 +1215,7 @@ class Paragraph(object):
         
         Returns: List of strings representing people
         """
-        names = []
-        for name in textacy.extract.named_entities(self.spacy_doc,
-                                                   include_types=['PERSON']):
-            # Exclude words too short to be names and strange characters
-            if len(name.text) < 3:
-                continue
-            # objects should not be people
-            if (name.doc[name.start - 1].text == 'the') or (name.doc[name.start - 1].text == 'a') or (name.doc[name.start - 1].text == 'an'):
-                continue
-            # Handle possessives
-            if name.text[-2] not in string.ascii_lowercase:
-                names.append(name.text[:-2])
-            else:
-                names.append(name.text)
-        return names
+        return list(self.entities.people)
 
     def extract_places(self):
         """
@@ -349,12 +1223,7 @@ class Paragraph(object):
         
         Returns: List of strings representing places
         """
-        places = []
-        include_types = ['LOC', 'GPE', 'FACILITY']
-        for place in textacy.extract.named_entities(self.spacy_doc,
-                                                include_types=include_types):
-            places.append(place.text)
-        return places
+        return list(self.entities.places)
 
     def extract_things(self):
         """
@@ -362,55 +1231,51 @@ class Paragraph(object):
         
         Returns: List of strings representing things
         """
-        # Get named objects
-        include_types = ['ORG', 'NORP', 'WORK_OF_ART', 'PRODUCT']
-        things = []
-        for obj in textacy.extract.named_entities(self.spacy_doc,
-                                                  include_types=include_types):
-            things.append(obj.text.strip())
-        # Get noun chunks
-        for nch in textacy.extract.noun_chunks(self.spacy_doc, drop_determiners=True):
-            if len(nch) == 1 and nch[0].pos == spacy.parts_of_speech.PRON:
-                continue
-            things.append(nch.text.strip())
-        return things
+        return list(self.entities.things)
 
     def extract_mood_words(self):
         """
         Extract the mood/emotion of the paragraph using EMO-Lexicon
         """
-        para_moods = self.doc.mood_words.iloc[self.id].dropna()
-        return list(para_moods)
+        return self.doc.paragraph_mood_words(self.id)
 
     def extract_mood_weights(self):
         """
-        Extract normalized paragraph mood weights from h5 file
+        Extract normalized paragraph mood weights from the mood tables
         """
-        para_emotions = self.doc.mood_weights.iloc[self.id]
-        norm = np.sum(para_emotions)
-        weight = np.log(norm+1.)
-        weight /= np.max(np.log(self.doc.mood_weights.T.sum()+1.))
-        if norm == 0.:
-            mood_weight_dict = dict(para_emotions)
-            mood_weight_dict['weight'] = weight
-            return mood_weight_dict
-        else:
-            mood_weight_dict = dict(para_emotions/norm)
-            mood_weight_dict['weight'] = weight
-            return mood_weight_dict
+        return self.doc.mood_table.weight_dict(self.id)
 
-    def extract_img_url(self):
+    def image_keyterm(self, people=None):
         """
-        Use the keyterms from the text to get a relevant image.
-        The decisions behind this function can be found in the
+        Pick the keyterm used to search for an image of the paragraph:
+        the highest ranked textrank keyterm that isn't a person. The
+        decisions behind this function can be found in the
         image_search_query notebook
+
+        Args:
+            people: names that are not keyterms. If None, the people
+                    known to the doc, see Doc.known_people
+                    [default: None]
+
+        Returns: keyterm string, or None
         """
-        keyterms = textacy.keyterms.textrank(self.spacy_doc)
-        best_keyterm = None
+        if people is None:
+            people = self.doc.known_people()
+        keyterms = self.entities.keyterms
+        if not keyterms:
+            import textacy
+            keyterms = textacy.keyterms.textrank(self.spacy_doc)
         for keyterm, rank in keyterms:
-            if keyterm.title() not in self.doc.words['people']:
-                best_keyterm = keyterm
-                break
+            if keyterm.title() not in people:
+                return keyterm
+        return None
+
+    def extract_img_url(self):
+        """
+        Use the keyterms from the text to get a relevant image.
+        """
+        from .find_images import search_bing_for_image, search_np_for_image
+        best_keyterm = self.image_keyterm()
         try:
             urls = search_np_for_image(best_keyterm)
         except Exception as e:
@@ -481,7 +1346,7 @@ class Paragraph(object):
         mem_places = self.extract_places()
         mem_things = self.extract_things()
         mem_activities = self.extract_activities(n_verbs)
-        mem_weights = self.extract_mood_weights()
+        mem_weights = dict(self.words['mood_weight'])
         mem_moods = self.extract_mood_words()
         if get_img:
             mem_img_url = self.extract_img_url()
@@ -0,0 +1,91 @@
+from collections import namedtuple
+
+
+class Profile(namedtuple('Profile', ['name', 'disable', 'sentencizer',
+                                     'things', 'activities', 'keyterms'])):
+    """
+    Named extraction profile
+
+    Attributes:
+        name: profile name
+        disable: spaCy pipeline components that are not loaded
+        sentencizer: add the rule based sentencizer, for pipelines
+                     without the parser
+        things: extract noun chunks as things
+        activities: extract main verbs as activities
+        keyterms: extract textrank keyterms (used for image search)
+    """
+    __slots__ = ()
+
+
+PROFILES = {
+    # NER and sentence boundaries, enough for find_character_paragraphs
+    'density-only': Profile(name='density-only',
+                            disable=('tagger', 'parser'),
+                            sentencizer=True,
+                            things=False,
+                            activities=False,
+                            keyterms=False),
+    # Everything gen_mem_dict needs
+    'full-memory': Profile(name='full-memory',
+                           disable=(),
+                           sentencizer=False,
+                           things=True,
+                           activities=True,
+                           keyterms=False),
+    # full-memory plus the keyterms used to look up images
+    'with-keyterms': Profile(name='with-keyterms',
+                             disable=(),
+                             sentencizer=False,
+                             things=True,
+                             activities=True,
+                             keyterms=True),
+}
+DEFAULT_PROFILE = 'full-memory'
+
+_NLP = {}
+
+
+def get_profile(profile=None):
+    """
+    Look up an extraction profile.
+
+    Args:
+        profile: profile name or Profile. If None, the default
+                 profile is used [default: None]
+
+    Returns:
+        profile: Profile object
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if isinstance(profile, Profile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown extraction profile {}, choose from {}'
+                         .format(profile, ', '.join(sorted(PROFILES))))
+
+
+def load_nlp(profile=None):
+    """
+    Load the spaCy pipeline for an extraction profile. Pipelines are
+    loaded once per process and shared.
+
+    Args:
+        profile: profile name or Profile [default: None]
+
+    Returns:
+        nlp: spaCy Language object
+    """
+    profile = get_profile(profile)
+    key = (profile.disable, profile.sentencizer)
+    if key not in _NLP:
+        import spacy
+        print('Loading spaCy ({})...'.format(profile.name))
+        nlp = spacy.load('en', disable=list(profile.disable))
+        if profile.sentencizer:
+            nlp.add_pipe(nlp.create_pipe('sentencizer'), first=True)
+        _NLP[key] = nlp
+    return _NLP[key]
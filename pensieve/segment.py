@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+import io
+import mmap
+from array import array
+from collections import namedtuple
+
+# Lines with fewer words than this are chunked with their neighbours
+MIN_PARAGRAPH_WORDS = 25
+QUOTES = (b"'", b'"')
+
+
+class ParagraphSpan(namedtuple('ParagraphSpan', ['start', 'end', 'chunked'])):
+    """
+    Location of a paragraph in a text file
+
+    Attributes:
+        start: byte offset of the first line of the paragraph
+        end: byte offset just past the last line of the paragraph
+        chunked: True if the paragraph is a run of short or quoted
+                 lines, whose text starts with a newline
+    """
+    __slots__ = ()
+
+    def decode(self, data, encoding='utf-8'):
+        """
+        Materialize the paragraph text from the file contents.
+
+        Args:
+            data: bytes-like contents of the file (e.g. an mmap)
+            encoding: text encoding of the file [default: utf-8]
+
+        Returns:
+            text: unicode string of the paragraph
+        """
+        text = data[self.start:self.end].decode(encoding)
+        text = text.replace('\r\n', '\n')
+        if self.chunked:
+            text = '\n' + text
+        return text
+
+
+def _iter_lines(f):
+    """
+    Yield (offset, line) for every line of a binary file, matching what
+    text.split('\n') gives for the decoded text.
+    """
+    offset = 0
+    ended = True
+    for raw in f:
+        ended = raw.endswith(b'\n')
+        line = raw[:-1] if ended else raw
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        yield offset, line
+        offset += len(raw)
+    if ended:
+        # A trailing newline leaves one last empty line
+        yield offset, b''
+
+
+def iter_paragraph_spans(f, encoding='utf-8'):
+    """
+    Segment a file into paragraphs, reading one line at a time. Lines
+    with at least MIN_PARAGRAPH_WORDS words are paragraphs on their own.
+    A shorter line starts a chunk that runs on while lines stay short or
+    start with a quote.
+
+    Args:
+        f: file object opened in binary mode
+        encoding: text encoding of the file [default: utf-8]
+
+    Yields:
+        span: ParagraphSpan for each paragraph, in file order
+    """
+    chunk_start = None
+    chunk_end = None
+    for offset, line in _iter_lines(f):
+        line_end = offset + len(line)
+        short = line.count(b' ') + 1 < MIN_PARAGRAPH_WORDS
+        if chunk_start is not None:
+            if short or line[:1] in QUOTES:
+                chunk_end = line_end
+                continue
+            yield ParagraphSpan(chunk_start, chunk_end, True)
+            chunk_start = None
+        # Whitespace only lines are skipped, however many spaces they
+        # hold, but a long one still ends the chunk before it
+        if len(line.decode(encoding, 'replace').strip()) == 0:
+            continue
+        if short:
+            chunk_start = offset
+            chunk_end = line_end
+        else:
+            yield ParagraphSpan(offset, line_end, False)
+    if chunk_start is not None:
+        yield ParagraphSpan(chunk_start, chunk_end, True)
+
+
+class SegmentedText(object):
+
+    def __init__(self, path, encoding='utf-8'):
+        """
+        Paragraph index over a text file
+
+        The file is segmented once into byte offsets. Paragraph text is
+        read from a memory map only when asked for, so any paragraph
+        can be fetched by id without keeping the book in memory.
+
+        Args:
+            path: path to the text file
+            encoding: text encoding of the file [default: utf-8]
+        """
+        self.path = path
+        self.encoding = encoding
+        self._starts = None
+        self._ends = None
+        self._chunked = None
+        self._mmap = None
+
+    def _build_index(self):
+        starts, ends, chunked = array('q'), array('q'), bytearray()
+        with io.open(self.path, 'rb') as f:
+            for span in iter_paragraph_spans(f, self.encoding):
+                starts.append(span.start)
+                ends.append(span.end)
+                chunked.append(span.chunked)
+        self._starts, self._ends, self._chunked = starts, ends, chunked
+
+    @property
+    def data(self):
+        if self._mmap is None:
+            with io.open(self.path, 'rb') as f:
+                try:
+                    self._mmap = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty files cannot be mapped
+                    self._mmap = b''
+        return self._mmap
+
+    def span(self, par_id):
+        if self._starts is None:
+            self._build_index()
+        return ParagraphSpan(self._starts[par_id], self._ends[par_id],
+                             bool(self._chunked[par_id]))
+
+    def __len__(self):
+        if self._starts is None:
+            self._build_index()
+        return len(self._starts)
+
+    def __getitem__(self, par_id):
+        return self.span(par_id).decode(self.data, self.encoding)
+
+    def __iter__(self):
+        for par_id in range(len(self)):
+            yield self[par_id]
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._mmap = None
@@ -0,0 +1,247 @@
+import json
+from array import array
+from collections import Counter
+import numpy as np
+
+# Categories counted, in the order of Doc.words
+CATEGORIES = ('times', 'activities', 'people', 'places', 'things')
+
+
+class EntityStats(object):
+
+    def __init__(self):
+        """
+        Entity counts for a corpus, with per-doc and per-paragraph
+        breakdowns
+
+        Strings are interned to integer ids and every (doc, paragraph,
+        category, entity, count) entry is appended to compact arrays as
+        docs are processed. Totals and the cleanup rules are computed
+        with vectorized numpy passes over those arrays.
+
+        Attributes:
+            strings: list of interned strings, indexed by entity id
+            vocab: dict of string -> entity id
+            doc_ids: set of ids of the docs added with add_doc
+        """
+        self.strings = []
+        self.vocab = {}
+        self.doc_ids = set()
+        self._doc = array('i')
+        self._par = array('i')
+        self._cat = array('b')
+        self._ent = array('i')
+        self._count = array('i')
+
+    def __len__(self):
+        return len(self._ent)
+
+    def intern(self, string):
+        entity_id = self.vocab.get(string)
+        if entity_id is None:
+            entity_id = len(self.strings)
+            self.vocab[string] = entity_id
+            self.strings.append(string)
+        return entity_id
+
+    def add_paragraph(self, doc_id, par_id, words):
+        """
+        Add the counts of one paragraph.
+
+        Args:
+            doc_id: id of the doc containing the paragraph
+            par_id: id of the paragraph in its doc
+            words: words dictionary of the paragraph (Paragraph.words)
+        """
+        for cat, category in enumerate(CATEGORIES):
+            for key, count in words[category].items():
+                self._doc.append(doc_id)
+                self._par.append(par_id)
+                self._cat.append(cat)
+                self._ent.append(self.intern(key))
+                self._count.append(count)
+
+    def add_doc(self, doc):
+        """
+        Add the counts of every paragraph of a doc, unless the doc has
+        been added already.
+
+        Args:
+            doc: pensieve.Doc object
+        """
+        if doc.id in self.doc_ids:
+            return
+        for par in doc.parse():
+            self.add_paragraph(doc.id, par.id, par.words)
+        self.doc_ids.add(doc.id)
+
+    def arrays(self):
+        """
+        Numpy copies of the entry arrays.
+
+        Returns:
+            arrays: (doc, par, cat, ent, count) tuple of int arrays
+        """
+        return (_to_numpy(self._doc, np.int32),
+                _to_numpy(self._par, np.int32),
+                _to_numpy(self._cat, np.int8),
+                _to_numpy(self._ent, np.int32),
+                _to_numpy(self._count, np.int32))
+
+    def _select(self, doc_id=None, par_id=None):
+        doc, par, cat, ent, count = self.arrays()
+        mask = np.ones(len(ent), dtype=bool)
+        if doc_id is not None:
+            mask &= doc == doc_id
+        if par_id is not None:
+            mask &= par == par_id
+        return cat[mask], ent[mask], count[mask]
+
+    def count_matrix(self, doc_id=None, par_id=None):
+        """
+        Total counts of every entity in every category.
+
+        Args:
+            doc_id: only count this doc. If None, count the whole
+                    corpus [default: None]
+            par_id: only count this paragraph [default: None]
+
+        Returns:
+            counts: int array of shape (len(CATEGORIES), len(strings))
+        """
+        cat, ent, count = self._select(doc_id, par_id)
+        n_strings = len(self.strings)
+        counts = np.bincount(cat.astype(np.int64)*n_strings + ent,
+                             weights=count,
+                             minlength=len(CATEGORIES)*n_strings)
+        return counts.astype(np.int64).reshape(len(CATEGORIES), n_strings)
+
+    @staticmethod
+    def clean(counts):
+        """
+        Apply the cleanup rules to a count matrix, in place: people are
+        not places and people are not things.
+
+        Args:
+            counts: int array from count_matrix
+
+        Returns:
+            counts: the cleaned count matrix
+        """
+        people = counts[CATEGORIES.index('people')]
+        places = counts[CATEGORIES.index('places')]
+        things = counts[CATEGORIES.index('things')]
+        places[2.5*people > places] = 0
+        things[people > 5] = 0
+        return counts
+
+    def totals(self, doc_id=None, par_id=None, clean=True):
+        """
+        Counters of the entities in each category.
+
+        Args:
+            doc_id: only count this doc. If None, count the whole
+                    corpus [default: None]
+            par_id: only count this paragraph [default: None]
+            clean: apply the people vs places and people vs things
+                   cleanup [default: True]
+
+        Returns:
+            words: dict of category -> Counter, keys in order of first
+                   appearance
+        """
+        counts = self.count_matrix(doc_id, par_id)
+        if clean:
+            self.clean(counts)
+        cat, ent, count = self._select(doc_id, par_id)
+        words = {}
+        for c, category in enumerate(CATEGORIES):
+            ids, first = np.unique(ent[cat == c], return_index=True)
+            ids = ids[np.argsort(first)]
+            ids = ids[counts[c, ids] > 0]
+            words[category] = Counter(dict(zip([self.strings[i] for i in ids],
+                                               counts[c, ids].tolist())))
+        return words
+
+    def paragraph_matrix(self, category, strings, doc_id=None):
+        """
+        Sparse paragraph x entity matrix of the counts of some entities.
+
+        Args:
+            category: one of CATEGORIES
+            strings: entity strings, the columns of the matrix
+            doc_id: only count this doc. If None, count the whole
+                    corpus [default: None]
+
+        Returns:
+            doc: int array of the doc id of each row
+            par: int array of the paragraph id of each row
+            matrix: scipy.sparse CSR matrix of counts, one row for each
+                    paragraph mentioning at least one of the strings,
+                    ordered by doc and paragraph
+        """
+        import scipy.sparse
+        doc, par, cat, ent, count = self.arrays()
+        columns = np.full(len(self.strings), -1, dtype=np.int64)
+        for j, string in enumerate(strings):
+            if string in self.vocab:
+                columns[self.vocab[string]] = j
+        mask = (cat == CATEGORIES.index(category)) & (columns[ent] >= 0)
+        if doc_id is not None:
+            mask &= doc == doc_id
+        keys = (doc[mask].astype(np.int64) << 32) | par[mask]
+        keys, rows = np.unique(keys, return_inverse=True)
+        matrix = scipy.sparse.csr_matrix(
+            (count[mask], (rows.ravel(), columns[ent[mask]])),
+            shape=(len(keys), len(strings)))
+        return keys >> 32, keys & 0xffffffff, matrix
+
+    def paragraph(self, doc_id, par_id):
+        """
+        Counters of the entities in one paragraph, without cleanup.
+        """
+        return self.totals(doc_id, par_id, clean=False)
+
+    def save(self, path):
+        """
+        Write the statistics to a numpy .npz file.
+
+        Args:
+            path: path of the file
+        """
+        doc, par, cat, ent, count = self.arrays()
+        np.savez_compressed(path, doc=doc, par=par, cat=cat, ent=ent,
+                            count=count,
+                            doc_ids=np.array(sorted(self.doc_ids),
+                                             dtype=np.int32),
+                            strings=np.frombuffer(json.dumps(self.strings).encode('utf-8'),
+                                                  dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read statistics written by EntityStats.save.
+
+        Args:
+            path: path of the file
+
+        Returns:
+            stats: EntityStats object
+        """
+        stats = cls()
+        with np.load(path) as data:
+            stats.strings = json.loads(data['strings'].tobytes().decode('utf-8'))
+            stats.vocab = {string: i for i, string in enumerate(stats.strings)}
+            stats.doc_ids = set(data['doc_ids'].tolist())
+            stats._doc = array('i', data['doc'].tobytes())
+            stats._par = array('i', data['par'].tobytes())
+            stats._cat = array('b', data['cat'].tobytes())
+            stats._ent = array('i', data['ent'].tobytes())
+            stats._count = array('i', data['count'].tobytes())
+        return stats
+
+
+def _to_numpy(values, dtype):
+    if len(values) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=dtype).copy()
@@ -0,0 +1,17 @@
+import argparse
+import os
+
+parser = argparse.ArgumentParser(description='Convert the mood h5 files to '
+                                             'a memory mapped mood store')
+parser.add_argument('-m', '--mood_dir', default='mood_files',
+                    type=str, help='Path to mood file directory')
+parser.add_argument('-o', '--output', default=None, type=str,
+                    help='Path of the mood store [default: moods.pmood in '
+                         'the mood file directory]')
+
+args = parser.parse_args()
+
+from pensieve.mood import MoodStore
+store = MoodStore.from_h5(os.path.abspath(args.mood_dir), args.output)
+print('Wrote {} books, {} paragraphs and {} mood words to {}'.format(
+    len(store.books), len(store.counts), len(store.words), store.path))
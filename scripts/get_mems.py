@@ -1,19 +1,47 @@
 import argparse
 import os
 
+from pensieve.instrument import STAGES
+
 parser = argparse.ArgumentParser(description='Collect memories from a corpus')
 parser.add_argument('-c', '--corpus_dir', default='hp_corpus',
                     type=str, help='Path to corpus directory')
 parser.add_argument('-n', '--name', default='harry potter',
                     type=str, help='Character name')
+parser.add_argument('--cast', nargs='+', default=None, type=str,
+                    help='Several character names, e.g. '
+                         '--cast "harry potter" "ron weasley". Memories '
+                         'for all of them are gathered in one pass')
 parser.add_argument('-m', '--mood_dir', default='mood_files',
                     type=str, help='Path to mood file directory')
 parser.add_argument('-i', '--images', action='store_true',
                     help='Get images')
+parser.add_argument('--image_cache', default=None, type=str,
+                    help='JSON file caching image urls across runs')
 parser.add_argument('-s', '--save_dir', default='memories')
+parser.add_argument('--cache_dir', default=None, type=str,
+                    help='Directory caching parsed paragraphs, so reruns '
+                         'skip spaCy for paragraphs seen before')
+parser.add_argument('--cache_size', default=None, type=int,
+                    help='Maximum size of the parse cache in bytes')
+parser.add_argument('-j', '--n_jobs', default=1, type=int,
+                    help='Number of books to process in parallel')
+parser.add_argument('--report', default=None, type=str,
+                    help='Write per stage timings and counters to this '
+                         'JSON file')
+parser.add_argument('--cprofile_stage', default=None, type=str,
+                    choices=list(STAGES) + ['hottest'],
+                    help='Run a pipeline stage under cProfile, e.g. parse, '
+                         'or "hottest", and add its listing to the report')
+parser.add_argument('--cprofile_every', default=1, type=int,
+                    help='Only profile one in this many calls of the stage')
 
 args = parser.parse_args()
-print('Extracting memories for {} from text in directory:'.format(args.name))
+if args.cast is not None:
+    names = ', '.join(args.cast)
+else:
+    names = args.name
+print('Extracting memories for {} from text in directory:'.format(names))
 print(os.path.abspath(args.corpus_dir))
 print()
 print('Mood files are found in directory:')
@@ -29,7 +57,25 @@ if not os.path.isdir(os.path.abspath(args.save_dir)):
     os.makedirs(os.path.abspath(args.save_dir))
 
 import pensieve
-corpus = pensieve.Corpus(corpus_dir=os.path.abspath(args.corpus_dir))
-corpus.gather_corpus_memories(char_name=args.name.title().split(),
-                              save=os.path.abspath(args.save_dir),
-                              get_img=args.images)
+corpus = pensieve.Corpus(corpus_dir=os.path.abspath(args.corpus_dir),
+                         cache_dir=args.cache_dir,
+                         cache_size=args.cache_size,
+                         image_cache=args.image_cache)
+run = None
+if args.report is not None:
+    run = pensieve.Instrumentation(profile=args.cprofile_stage,
+                                   profile_every=args.cprofile_every).start()
+if args.cast is not None:
+    cast = {name: name.title().split() for name in args.cast}
+    corpus.gather_cast_memories(cast,
+                                save=os.path.abspath(args.save_dir),
+                                get_img=args.images,
+                                n_jobs=args.n_jobs)
+else:
+    corpus.gather_corpus_memories(char_name=args.name.title().split(),
+                                  save=os.path.abspath(args.save_dir),
+                                  get_img=args.images,
+                                  n_jobs=args.n_jobs)
+if run is not None:
+    run.stop().save(args.report)
+    print('Stage report written to '+os.path.abspath(args.report))
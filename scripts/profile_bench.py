@@ -0,0 +1,99 @@
+"""
+Measure throughput and accuracy of the extraction profiles on a corpus.
+
+Every profile parses and extracts the same paragraphs. Accuracy is
+reported against the full-memory profile: agreement of sentence counts
+and people found per paragraph, and precision/recall of the paragraphs
+find_character_paragraphs selects for a character.
+
+python scripts/profile_bench.py -c hp_corpus -n 'harry potter' -p 500
+"""
+import argparse
+import json
+import os
+import time
+from collections import Counter
+
+import pensieve
+from pensieve.profiles import PROFILES
+
+parser = argparse.ArgumentParser(description='Benchmark extraction profiles')
+parser.add_argument('-c', '--corpus_dir', default='hp_corpus',
+                    type=str, help='Path to corpus directory')
+parser.add_argument('-m', '--mood_dir', default='mood_files',
+                    type=str, help='Path to mood file directory')
+parser.add_argument('-n', '--name', default='harry potter',
+                    type=str, help='Character name')
+parser.add_argument('-p', '--max_pars', default=None, type=int,
+                    help='Only use the first paragraphs of each book')
+parser.add_argument('-d', '--density_cut', default=0.8, type=float)
+parser.add_argument('-o', '--output', default=None,
+                    help='Write the results to this JSON file')
+args = parser.parse_args()
+char_name = args.name.title().split()
+
+
+def run_profile(profile):
+    corpus = pensieve.Corpus(os.path.abspath(args.corpus_dir),
+                             mood_dir=args.mood_dir, profile=profile)
+    result = {'profile': profile, 'paragraphs': 0, 'words': 0,
+              'seconds': 0., 'n_sentences': [], 'people': [],
+              'selected': set()}
+    # Only the timed parsing and extraction are instrumented
+    run = pensieve.Instrumentation()
+    for doc in corpus.docs:
+        pars = doc.paragraphs[:args.max_pars]
+        start = time.time()
+        run.start()
+        doc.parse(pars)
+        for par in pars:
+            par.entities
+        run.stop()
+        result['seconds'] += time.time() - start
+        result['paragraphs'] += len(pars)
+        result['words'] += sum(len(par.text.split()) for par in pars)
+        for par in pars:
+            n_sentences = len(list(par.spacy_doc.sents))
+            result['n_sentences'].append(n_sentences)
+            people = Counter(par.extract_people())
+            result['people'].append(people)
+            mentions = sum(people[alias] for alias in char_name)
+            if n_sentences > 0 and mentions/n_sentences > args.density_cut:
+                result['selected'].add((doc.id, par.id))
+    result['stages'] = dict((name, stats.self_seconds)
+                            for name, stats in run.totals().items())
+    return result
+
+
+def compare(result, reference):
+    pairs = list(zip(result['n_sentences'], reference['n_sentences']))
+    sentence_agreement = sum(a == b for a, b in pairs)/len(pairs)
+    found = sum(sum((a & b).values()) for a, b in
+                zip(result['people'], reference['people']))
+    n_result = sum(sum(a.values()) for a in result['people'])
+    n_reference = sum(sum(b.values()) for b in reference['people'])
+    selected, ref_selected = result['selected'], reference['selected']
+    hits = len(selected & ref_selected)
+    return {'sentence_agreement': sentence_agreement,
+            'people_precision': found/max(n_result, 1),
+            'people_recall': found/max(n_reference, 1),
+            'selection_precision': hits/max(len(selected), 1),
+            'selection_recall': hits/max(len(ref_selected), 1)}
+
+
+results = {name: run_profile(name) for name in sorted(PROFILES)}
+report = []
+for name in sorted(PROFILES):
+    result = results[name]
+    row = {'profile': name,
+           'paragraphs': result['paragraphs'],
+           'seconds': result['seconds'],
+           'paragraphs_per_second': result['paragraphs']/result['seconds'],
+           'words_per_second': result['words']/result['seconds'],
+           'stage_seconds': result['stages']}
+    row.update(compare(result, results['full-memory']))
+    report.append(row)
+    print(json.dumps(row, indent=4))
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
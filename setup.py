@@ -10,6 +10,12 @@ setup(name='pensieve',
       packages=['pensieve',],
       install_requires=[
           'spacy',
-          'textacy'
-          ]
+          'textacy',
+          'numpy',
+          'scipy',
+          'networkx'
+          ],
+      extras_require={
+          'bench': ['pytest', 'pytest-benchmark'],
+          }
       )
\ No newline at end of file
@@ -0,0 +1,45 @@
+"""
+Helpers shared by the tests and the benchmarks.
+"""
+import contextlib
+import threading
+from collections import Counter
+
+
+@contextlib.contextmanager
+def serve(handler):
+    """
+    Run a local HTTP server in a background thread.
+
+    Args:
+        handler: BaseHTTPRequestHandler subclass answering the requests
+
+    Yields:
+        root: base URL of the server, e.g. 'http://127.0.0.1:8000'
+    """
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def paragraph_words(**counts):
+    """
+    Words dictionary of a paragraph, as Paragraph.words gives it, with
+    the given categories filled in and the others empty.
+
+    Args:
+        counts: Counter of each category given, e.g. people=Counter(...)
+
+    Returns:
+        words: dict of category -> Counter
+    """
+    from pensieve.stats import CATEGORIES
+    words = dict((category, Counter()) for category in CATEGORIES)
+    words.update(counts)
+    return words
@@ -0,0 +1,41 @@
+"""Import-time regression benchmark.
+# python -m pytest tests/test_import.py
+"""
+import os
+import sys
+import json
+import subprocess
+
+# Importing pensieve must not load any of these
+HEAVY_MODULES = ['spacy', 'textacy', 'pandas', 'numpy', 'tqdm', 'boto3',
+                 'PIL', 'requests', 'networkx', 'matplotlib', 'pylab']
+# Best of several cold imports, in seconds
+IMPORT_BUDGET = 0.25
+N_RUNS = 5
+
+IMPORT_CODE = """
+import sys, json, time
+start = time.perf_counter()
+import pensieve
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': list(sys.modules)}))
+"""
+
+
+def import_pensieve():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_CODE],
+                                  cwd=root)
+    return json.loads(out.decode('utf-8').splitlines()[-1])
+
+
+def test_import_is_light():
+    result = import_pensieve()
+    loaded = set(name.split('.')[0] for name in result['modules'])
+    assert [name for name in HEAVY_MODULES if name in loaded] == []
+
+
+def test_import_time():
+    elapsed = min(import_pensieve()['elapsed'] for i in range(N_RUNS))
+    print('import pensieve took {:.1f} ms'.format(1000*elapsed))
+    assert elapsed < IMPORT_BUDGET
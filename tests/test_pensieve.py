@@ -2,9 +2,13 @@
 # python -m pytest tests/test_pensieve.py
 """
 import os
+import importlib.util
+import multiprocessing
 import pytest
 import pensieve
 
+needs_spacy = pytest.mark.skipif(importlib.util.find_spec('spacy') is None,
+                                 reason='spaCy is not installed')
 
 
 @pytest.fixture
@@ -20,3 +24,771 @@ def test_corpus(corpus_dir):
     print(corpus.paragraphs)
     assert 3 == len(corpus.paragraphs)
 
+
+def test_paragraphs_are_lazy(corpus_dir):
+    corpus = pensieve.Corpus(corpus_dir)
+    assert 3 == len(corpus.paragraphs)
+    assert not any(par.is_parsed for par in corpus.paragraphs)
+    doc = corpus.docs[0]
+    assert doc._paragraph_texts is None
+    assert all(par._text is None for par in doc.paragraphs)
+    assert [par.text for par in doc.paragraphs] == doc.paragraph_texts
+
+
+
+def test_parse_texts_single_process():
+    class Pipeline(object):
+        def pipe(self, texts, batch_size):
+            return (text.upper() for text in texts)
+
+    # Older spaCy has no n_process, it is only passed when asked for
+    assert pensieve.parse_texts(['a', 'b'], nlp=Pipeline()) == ['A', 'B']
+
+
+@needs_spacy
+def test_batched_parse_matches_single(corpus_dir):
+    corpus = pensieve.Corpus(corpus_dir, batch_size=2)
+    for doc in corpus.docs:
+        doc.parse()
+    for par in corpus.paragraphs:
+        single = pensieve.pensieve.NLP(par.text)
+        assert [(t.text, t.tag_, t.dep_, t.ent_type_) for t in single] == \
+            [(t.text, t.tag_, t.dep_, t.ent_type_) for t in par.spacy_doc]
+
+
+@needs_spacy
+def test_parse_cache_roundtrip(corpus_dir, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    cold = pensieve.Corpus(corpus_dir, cache_dir=cache_dir)
+    cold_entities = [par.entities for par in cold.docs[0].parse()]
+    warm = pensieve.Corpus(corpus_dir, cache_dir=cache_dir)
+    warm_pars = warm.docs[0].parse()
+    assert all(par._entities is not None for par in warm_pars)
+    assert cold_entities == [par.entities for par in warm_pars]
+
+
+def test_parse_cache_keeps_unrelated_data(tmpdir):
+    import json
+    from pensieve.cache import MARKER, NAMESPACE, remove_stale
+    project = tmpdir.join('important_project', 'src')
+    project.ensure(dir=True)
+    project.join('a.py').write('x = 1\n')
+    root = tmpdir.join(NAMESPACE)
+    markers = {'0123456789abcdef': 'full-memory',
+               'fedcba9876543210': 'full-memory',
+               'aaaaaaaaaaaaaaaa': 'density-only',
+               'bbbbbbbbbbbbbbbb': 'with-keyterms'}
+    for name, profile in markers.items():
+        root.join(name).ensure(dir=True)
+        root.join(name, MARKER).write(json.dumps({'profile': profile,
+                                                  'fingerprint': name}))
+    root.join('notes').ensure(dir=True)
+    remove_stale(str(root), '0123456789abcdef', 'full-memory')
+    assert project.join('a.py').check()
+    # Stale entries of the profile go, other profiles' entries stay
+    assert sorted(path.basename for path in root.listdir()) == \
+        ['0123456789abcdef', 'aaaaaaaaaaaaaaaa', 'bbbbbbbbbbbbbbbb', 'notes']
+
+
+def test_parse_cache_eviction_and_invalidation(tmpdir):
+    from types import SimpleNamespace
+    from pensieve.cache import NAMESPACE, ParseCache
+    # Stand-in for a parsed spaCy Doc, the fingerprint replaces the model
+    spacy_doc = SimpleNamespace(to_bytes=lambda: b'x'*1000)
+    cache_dir = str(tmpdir.join('cache'))
+    other = ParseCache(cache_dir, None, profile='full-memory',
+                       fingerprint='3'*16)
+    other.put('kept', spacy_doc, None)
+    cache = ParseCache(cache_dir, None, profile='density-only',
+                       fingerprint='1'*16)
+    cache.put('a', spacy_doc, None)
+    entry_size = cache.size
+    cache.max_size = 3.5*entry_size
+    for text in ['b', 'c']:
+        cache.put(text, spacy_doc, None)
+    for text, mtime in [('a', 100), ('b', 50), ('c', 200)]:
+        os.utime(cache.path(text), (mtime, mtime))
+    # Past max_size the least recently used entries go, down to 90%
+    cache.put('d', spacy_doc, None)
+    assert [os.path.exists(cache.path(text)) for text in 'abcd'] == \
+        [True, False, True, True]
+    assert cache.size == 3*entry_size
+    # A new fingerprint of the profile drops its old entries only
+    new = ParseCache(cache_dir, None, profile='density-only',
+                     fingerprint='2'*16)
+    assert sorted(os.listdir(os.path.join(cache_dir, NAMESPACE))) == \
+        ['2'*16, '3'*16]
+    assert new.size == 0
+    assert os.path.exists(other.path('kept'))
+
+
+def test_segmented_text(corpus_dir, tmpdir):
+    path = tmpdir.join('book1.txt')
+    path.write_binary(b'Chapter One\r\n\r\n"Hello," said Harry.\r\n'
+                      + b' '.join([b'word']*30) + b'\r\n')
+    segments = pensieve.segment.SegmentedText(str(path))
+    assert len(segments) == 2
+    assert segments[1] == ' '.join(['word']*30)
+    assert segments[0] == '\nChapter One\n\n"Hello," said Harry.'
+    path.write('a b\n' + ' '*30 + '\nfoo\n')
+    segments = pensieve.segment.SegmentedText(str(path))
+    assert list(segments) == ['\na b', '\nfoo\n']
+    path.write(' '*30 + '\n' + ' '.join(['word']*30) + '\n')
+    segments = pensieve.segment.SegmentedText(str(path))
+    assert list(segments) == [' '.join(['word']*30)]
+
+
+def test_mention_index():
+    from collections import Counter
+    from pensieve.mentions import MentionIndex
+    index = MentionIndex([2, 0, 1, 4],
+                         [Counter({'Harry': 2, 'Ron': 1}),
+                          Counter({'Harry': 1}),
+                          Counter({'Potter': 1}),
+                          Counter({'Ron': 4})])
+    assert list(index.mentions(['Harry', 'Potter'])) == [2, 1, 1, 0]
+    assert list(index.select(['Harry', 'Potter'], 0.8)) == [0, 2]
+    assert list(index.select('Ron', 0.4)) == [0, 3]
+    assert list(index.select('Hermione', 0.)) == []
+
+
+def test_mention_index_grows(corpus_dir):
+    from collections import Counter
+    from types import SimpleNamespace
+    doc = pensieve.Corpus(corpus_dir).docs[0]
+    people = [Counter({'Harry': 2}), Counter({'Ron': 1}), Counter({'Harry': 1})]
+    for par, par_people in zip(doc.paragraphs, people):
+        # Stand-ins for parsed paragraphs: sentences and people only
+        par._spacy_doc = SimpleNamespace(sents=['one sentence'])
+        par._words = {'people': par_people}
+    first = doc.find_character_paragraphs('Harry', paragraphs=doc.paragraphs[:2])
+    index = doc._mention_index
+    assert [par.id for par in first] == [0]
+    assert index.indexed.tolist() == [True, True, False]
+    # The index is extended, not rebuilt, and later subsets reuse it
+    later = doc.find_character_paragraphs('Harry', paragraphs=doc.paragraphs[1:])
+    assert doc._mention_index is index
+    assert [par.id for par in later] == [2]
+    assert [par.id for par in doc.find_character_paragraphs('Harry')] == [0, 2]
+
+
+def test_image_keyterm_parses_nothing_more(corpus_dir):
+    from pensieve.extract import Entities
+    doc = pensieve.Corpus(corpus_dir).docs[0]
+    first, second, third = doc.paragraphs
+    first.entities = Entities((), ('Harry',), (), (), (),
+                              (('harry', 0.9), ('wand', 0.5)))
+    second.entities = Entities((), ('Dudley ',), (), (), (),
+                               (('dudley', 0.8), ('cupboard', 0.1)))
+    # Keyterms skip people of the extracted paragraphs only, the others
+    # are never parsed for it
+    assert doc.known_people() == {'Harry', 'Dudley'}
+    assert [first.image_keyterm(), second.image_keyterm()] == ['wand',
+                                                              'cupboard']
+    assert third._entities is None and not third.is_parsed
+    assert doc._words is None
+
+
+class _Bar(object):
+    # Records what _map_docs_parallel shows on its tqdm bar
+    def __init__(self, total=0):
+        self.total = total
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+    def close(self):
+        pass
+
+
+def test_update_progress():
+    import queue
+    from pensieve.pensieve import _update_progress
+    bar, progress, messages = _Bar(), {}, queue.Queue()
+    _update_progress(bar, progress, messages)
+    assert (bar.n, bar.total) == (0, 0)
+    for message in [(1, 1, 4), (2, 2, 3), (1, 3, 4)]:
+        messages.put(message)
+    _update_progress(bar, progress, messages)
+    assert progress == {1: (3, 4), 2: (2, 3)}
+    assert (bar.n, bar.total) == (5, 7)
+    messages.put((2, 3, 3))
+    _update_progress(bar, progress, messages)
+    assert (bar.n, bar.total) == (6, 7)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='workers must inherit the patched Doc')
+def test_map_docs_parallel(tmpdir, monkeypatch):
+    import tqdm
+    bars = []
+    monkeypatch.setattr(tqdm, 'tqdm',
+                        lambda total: bars.append(_Bar(total)) or bars[-1])
+
+    def fake_memories(doc, characters, progress=None, size=1):
+        n_total = doc.id*size
+        for n_done in range(1, n_total + 1):
+            progress(doc.id, n_done, n_total)
+        return [(doc.id, characters)]
+
+    monkeypatch.setattr(pensieve.pensieve.Doc, 'fake_memories',
+                        fake_memories, raising=False)
+    for doc_id in [3, 1, 2]:
+        tmpdir.join('book{}.txt'.format(doc_id)).write('Harry\n')
+    corpus = pensieve.Corpus(str(tmpdir))
+    results = corpus._map_docs_parallel('fake_memories', ['Harry'], 2,
+                                        size=2)
+    # In corpus order, whichever worker finishes first
+    assert results == [[(1, ['Harry'])], [(2, ['Harry'])], [(3, ['Harry'])]]
+    assert (bars[0].n, bars[0].total) == (12, 12)
+
+
+def test_normalize_cast():
+    cast = pensieve.pensieve.normalize_cast(['Hermione', ['Harry', 'Potter']])
+    assert list(cast.items()) == [('Hermione', ['Hermione']),
+                                  ('Harry Potter', ['Harry', 'Potter'])]
+    cast = pensieve.pensieve.normalize_cast({'ron': 'Ron'})
+    assert cast['ron'] == ['Ron']
+
+
+def test_gather_cast_memories(tmpdir, monkeypatch):
+    import json
+    from collections import Counter
+    from types import SimpleNamespace
+    from pensieve.extract import Entities
+    filler = ' '.join(['proud']*25)
+    corpus_dir = tmpdir.join('corpus')
+    corpus_dir.mkdir()
+    corpus_dir.join('book0.txt').write(
+        'Harry met Ron {0}\nHarry alone {0}\nRon alone {0}\n'.format(filler))
+    lexicon = tmpdir.join('lexicon.txt')
+    lexicon.write('proud\tjoy\t1\n')
+    extracted = Counter()
+
+    def fake_extract(spacy_doc, profile=None):
+        extracted[spacy_doc.text] += 1
+        people = tuple(word for word in spacy_doc.text.split()
+                       if word in ('Harry', 'Ron'))
+        return Entities((), people, (), (), ())
+
+    monkeypatch.setattr(pensieve.pensieve, 'extract_entities', fake_extract)
+    corpus = pensieve.Corpus(str(corpus_dir), mood_dir=str(tmpdir.join('moods')),
+                             lexicon=str(lexicon))
+    doc = corpus.docs[0]
+    for par in doc.paragraphs:
+        # Stand-in for a spaCy parse of one sentence
+        par._spacy_doc = SimpleNamespace(text=par.text, sents=['sentence'])
+    save = str(tmpdir.join('mems'))
+    os.mkdir(save)
+    memories = doc.gather_cast_memories({'harry': ['Harry'], 'ron': ['Ron']},
+                                        save=save, progress=lambda *args: None)
+    assert [len(memories['harry']), len(memories['ron'])] == [2, 2]
+    # The paragraph of both characters is extracted once
+    assert sorted(extracted.values()) == [1, 1, 1]
+    assert sorted(os.listdir(save)) == ['harry_book0.json', 'ron_book0.json']
+    with open(os.path.join(save, 'harry_book0.json')) as f:
+        assert len(json.load(f)) == 2
+
+
+def test_entity_stats(tmpdir):
+    from collections import Counter
+    from pensieve.stats import EntityStats
+    stats = EntityStats()
+    stats.add_paragraph(1, 0, {'times': Counter({'Book 1': 1}),
+                               'activities': Counter({'say': 1}),
+                               'people': Counter({'Harry': 3}),
+                               'places': Counter({'Harry': 2, 'Hogwarts': 1}),
+                               'things': Counter({'Harry': 1, 'wand': 2})})
+    stats.add_paragraph(1, 1, {'times': Counter(),
+                               'activities': Counter(),
+                               'people': Counter({'Harry': 3}),
+                               'places': Counter(),
+                               'things': Counter({'wand': 1})})
+    words = stats.totals(doc_id=1)
+    assert words['people'] == Counter({'Harry': 6})
+    assert words['places'] == Counter({'Hogwarts': 1})
+    assert list(words['things'].items()) == [('wand', 3)]
+    assert stats.paragraph(1, 0)['places']['Harry'] == 2
+    path = str(tmpdir.join('stats.npz'))
+    stats.save(path)
+    assert EntityStats.load(path).totals() == stats.totals()
+
+
+def test_mood_table():
+    from pensieve.mood import MoodTable
+    table = MoodTable(['anger', 'joy'], [[0, 0], [1, 3], [0, 1]])
+    assert table.weight_dict(0) == {'anger': 0, 'joy': 0, 'weight': 0.}
+    mood = table.weight_dict(1)
+    assert (mood['anger'], mood['joy'], mood['weight']) == (0.25, 0.75, 1.)
+    assert 0. < table.weight_dict(2)['weight'] < 1.
+
+
+def test_candidate_paragraphs(corpus_dir):
+    from pensieve.mood import MoodTable
+    doc = pensieve.Corpus(corpus_dir).docs[0]
+    doc._mood_table = MoodTable(['joy'], [[0], [2], [1]])
+    candidates = doc.candidate_paragraphs()
+    assert [par.id for par in candidates] == [1, 2]
+    assert not any(par.is_parsed for par in candidates)
+    longest = max(candidates, key=lambda par: len(par.text.split()))
+    assert doc.candidate_paragraphs(
+        min_words=len(longest.text.split())) == [longest]
+    assert doc.candidate_paragraphs(keywords=['Potters']) == [candidates[1]]
+
+
+def test_lexicon_mood_tables(corpus_dir, tmpdir):
+    from pensieve.mood import Lexicon
+    lexicon_path = tmpdir.join('lexicon.txt')
+    lexicon_path.write('fear\tfear\t1\nfear\tnegative\t1\n'
+                       'proud\tjoy\t1\nproud\tanger\t0\n'
+                       'strange\tsurprise\t1\n')
+    lexicon = Lexicon.load(str(lexicon_path))
+    counts, mood_words = lexicon.score(["proud, proud! and strange",
+                                        "nothing here"])
+    assert counts.tolist() == [[0, 0, 0, 2, 0, 1], [0, 0, 0, 0, 0, 0]]
+    assert mood_words == [['proud', 'strange'], []]
+
+    mood_dir = str(tmpdir.join('moods'))
+    corpus = pensieve.Corpus(corpus_dir, mood_dir=mood_dir,
+                             lexicon=str(lexicon_path))
+    doc = corpus.docs[0]
+    assert len(doc.mood_table) == len(doc.paragraphs)
+    assert doc.mood_table.counts[:, 3].tolist() == [1, 0, 0]
+    assert doc.paragraph_mood_words(0) == ['proud', 'strange']
+
+    # The default mood_dir lives in the corpus dir and is not a doc
+    book_dir = tmpdir.join('books')
+    book_dir.mkdir()
+    book_dir.join('book1.txt').write(open(doc.path_to_text).read())
+    corpus = pensieve.Corpus(str(book_dir), lexicon=str(lexicon_path))
+    corpus.docs[0].mood_table
+    assert os.path.isdir(corpus.mood_dir)
+    assert os.path.dirname(corpus.mood_dir) == str(book_dir)
+    assert [doc_id for _, doc_id in corpus.doc_paths()] == [1]
+
+
+def test_mood_store(tmpdir):
+    from pensieve.mood import MoodStore, open_mood_store
+    path = str(tmpdir.join('moods.pmood'))
+    MoodStore.write(path, [(2, [[0, 1], [3, 1]], [['glad'], ['cross', 'glad']])],
+                    emotions=['anger', 'joy'])
+    MoodStore.update(path, [(1, [[1, 0]], [['cross']])],
+                     emotions=['anger', 'joy'])
+    store = open_mood_store(path)
+    assert store is open_mood_store(path)
+    assert sorted(store.books) == [1, 2]
+    assert store.mood_words(2, 1) == ['cross', 'glad']
+    assert store.table(2).weight_dict(1)['anger'] == 0.75
+    assert store.n_paragraphs(1) == 1
+    assert open_mood_store(str(tmpdir.join('missing.pmood'))) is None
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_memory_writer_roundtrip(tmpdir, compression):
+    from pensieve.json_dump import MemoryReader, MemoryWriter
+    memories = [pensieve.dump_mem_to_json({'people': ['Ron'],
+                                           'narrative': 'par {}'.format(i)})
+                for i in range(50)]
+    path = str(tmpdir.join('mems.jsonl'))
+    with MemoryWriter(path, compression=compression, buffer_size=256) as sink:
+        for mem in memories:
+            sink.write(mem)
+    assert sink.n_written == 50
+    reader = MemoryReader(path)
+    assert list(reader) == memories
+    assert list(reader + reader) == memories + memories
+
+
+@pytest.mark.skipif(importlib.util.find_spec('zstandard') is not None,
+                    reason='zstandard is installed')
+def test_memory_writer_without_zstandard(tmpdir):
+    from pensieve.json_dump import MemoryWriter
+    path = str(tmpdir.join('mems.jsonl.zst'))
+    with pytest.raises(ImportError):
+        MemoryWriter(path, compression='zstd')
+    assert not os.path.exists(path)
+
+
+def test_streamed_memories_per_doc(tmpdir):
+    save = tmpdir.join('memories')
+    save.ensure(dir=True)
+    corpus_dir = tmpdir.join('corpus')
+    for i in (1, 2):
+        corpus_dir.join('book{}.txt'.format(i)).write('Harry {}\n'.format(i),
+                                                     ensure=True)
+    corpus = pensieve.Corpus(str(corpus_dir))
+    readers = [doc.collect_memories([{'people': ['Ron'],
+                                      'narrative': 'book {}'.format(doc.id)}],
+                                    'Harry', str(save), stream=True)
+               for doc in corpus.docs]
+    memories = readers[0] + readers[1]
+    assert len(set(memories.paths)) == 2
+    assert [mem['narrative']['node']['text'] for mem in memories] == \
+        ['book 1', 'book 2']
+
+
+def test_memory_reader_skips_truncated_line(tmpdir):
+    from pensieve.json_dump import MemoryReader
+    path = tmpdir.join('mems.jsonl')
+    path.write('{"memory": "a"}\n{"memory": "b"}\n{"memo')
+    assert list(MemoryReader(str(path))) == [{'memory': 'a'},
+                                             {'memory': 'b'}]
+
+
+def test_memory_reader_unfinished_gzip(tmpdir):
+    import shutil
+    from pensieve.json_dump import MemoryReader, MemoryWriter
+    path = str(tmpdir.join('mems.jsonl.gz'))
+    crashed = str(tmpdir.join('crashed.jsonl.gz'))
+    with MemoryWriter(path, compression='gzip') as sink:
+        for i in range(3):
+            sink.write({'memory': i})
+        sink.flush()
+        # A copy taken before close has no gzip trailer
+        shutil.copy(path, crashed)
+    assert list(MemoryReader(crashed)) == [{'memory': i} for i in range(3)]
+
+
+def test_memory_batch_expands_to_schema(tmpdir):
+    from pensieve.json_dump import MemoryBatch
+    mem_dicts = [{'people': ['Ron Weasley', 'Hermione'], 'places': ['Hogwarts'],
+                  'mood_words': None, 'img_url': 'a.jpg',
+                  'mood_weight': {'weight': 0.3, 'joy': 1.0},
+                  'narrative': 'first'},
+                 {'places': ['Hogwarts'], 'things': ['wand'],
+                  'narrative': 'second'}]
+    batch = MemoryBatch(timestamp='2017-08-05T02:05:30.000Z')
+    for mem_dict in mem_dicts:
+        batch.add(mem_dict)
+    assert len(batch.concepts) == 4
+    expected = [pensieve.dump_mem_to_json(mem_dict, timestamp=batch.timestamp)
+                for mem_dict in mem_dicts]
+    assert batch.expand() == expected
+    path = str(tmpdir.join('batch.json'))
+    batch.save(path)
+    merged = MemoryBatch(batch.timestamp).extend(MemoryBatch.load(path))
+    merged.extend(batch)
+    assert merged.expand() == expected + expected
+    assert len(merged.concepts) == 4
+
+
+@pytest.fixture
+def image_server():
+    import json
+    from collections import Counter
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    from helpers import serve
+    hits = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            hits[url.path] += 1
+            if url.path == '/np/icons/flaky' and hits[url.path] == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if url.path.startswith('/np/icons/'):
+                query = url.path[len('/np/icons/'):]
+                if query == 'nothing':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = {'icons': [{'preview_url': 'np/' + query}]}
+            else:
+                body = {'value': [{'contentUrl': 'bing/' + parse_qs(url.query)['q'][0]}]}
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    with serve(Handler) as root:
+        yield root, hits
+
+
+def test_image_resolver(image_server, tmpdir):
+    from pensieve.find_images import ImageResolver
+    root, hits = image_server
+    cache_path = str(tmpdir.join('images.json'))
+    kwargs = {'np_url': root + '/np', 'np_auth': ('key', 'secret'),
+              'bing_url': root + '/bing', 'bing_key': 'key',
+              'backoff': 0.01}
+    resolver = ImageResolver(cache_path, **kwargs)
+    urls = resolver.resolve(['wand', 'wand', 'nothing', 'flaky', None])
+    assert urls == {'wand': 'np/wand', 'nothing': 'bing/nothing',
+                    'flaky': 'np/flaky', None: ''}
+    assert hits['/np/icons/wand'] == 1
+    assert hits['/np/icons/flaky'] == 2
+    warm = ImageResolver(cache_path, **kwargs)
+    assert warm.resolve(['wand', 'nothing']) == {'wand': 'np/wand',
+                                                 'nothing': 'bing/nothing',
+                                                 None: ''}
+    assert sum(hits.values()) == 5
+
+
+@pytest.fixture
+def png_server():
+    import io
+    from collections import Counter
+    from http.server import BaseHTTPRequestHandler
+    from PIL import Image
+    from helpers import serve
+    images = {}
+    for name, color in [('red', 'red'), ('red_copy', 'red'), ('blue', 'blue')]:
+        out = io.BytesIO()
+        Image.new('RGBA', (64, 48), color).save(out, 'PNG')
+        images['/' + name + '.png'] = out.getvalue()
+    hits = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits[self.path] += 1
+            if self.path not in images:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(images[self.path])))
+            self.end_headers()
+            self.wfile.write(images[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    with serve(Handler) as root:
+        yield root, hits
+
+
+def test_upload_images_dedupes_content(png_server, tmpdir):
+    from pensieve.image import LocalStorage, upload_images
+    root, hits = png_server
+    storage = LocalStorage(str(tmpdir.join('images')))
+    urls = [root + path for path in
+            ('/red.png', '/red_copy.png', '/blue.png', '/red.png', '/gone.png')]
+    results = upload_images(urls, storage=storage, n_workers=4)
+    assert [success for success, key in results] == [True]*4 + [False]
+    keys = [key for success, key in results[:4]]
+    assert keys[0] == keys[1] == keys[3] != keys[2]
+    assert sorted(os.listdir(storage.root)) == sorted(set(keys))
+    assert hits['/red.png'] == 1
+    assert upload_images(urls[:1], storage=storage)[0] == (True, keys[0])
+
+
+def test_make_renditions():
+    import io
+    from PIL import Image
+    from pensieve.image import make_renditions
+    img = Image.new('RGB', (2000, 1000), 'green')
+    exif = img.getexif()
+    exif[0x0112] = 6  # rotated 90 degrees
+    out = io.BytesIO()
+    img.save(out, 'JPEG', exif=exif.tobytes())
+    renditions = make_renditions(out.getvalue(),
+                                 {'icon': (64, 64), 'display': (1024, 1024)})
+    assert list(renditions) == ['icon', 'display']
+    sizes = dict((name, Image.open(io.BytesIO(data)).size)
+                 for name, data in renditions.items())
+    assert sizes == {'icon': (32, 64), 'display': (512, 1024)}
+
+    out = io.BytesIO()
+    Image.new('RGBA', (10, 10), (0, 0, 0, 0)).save(out, 'PNG')
+    icon = Image.open(io.BytesIO(make_renditions(out.getvalue())['icon']))
+    assert icon.mode == 'RGB' and icon.getpixel((5, 5))[0] > 250
+
+
+def test_upload_renditions(png_server, tmpdir):
+    from pensieve.image import RENDITIONS, LocalStorage, upload_images
+    root, hits = png_server
+    storage = LocalStorage(str(tmpdir.join('images')))
+    results = upload_images([root + '/red.png', root + '/red_copy.png'],
+                            storage=storage, renditions=RENDITIONS)
+    (_, keys), (_, copy_keys) = results
+    assert keys == copy_keys and list(keys) == list(RENDITIONS)
+    assert sorted(os.listdir(storage.root)) == sorted(keys.values())
+
+
+def test_graph_cooccurrence():
+    import math
+    from collections import Counter
+    from types import SimpleNamespace
+    from pensieve.graph import Graph
+    from pensieve.stats import EntityStats
+    from helpers import paragraph_words
+    stats = EntityStats()
+    paragraphs = [Counter({'Harry': 3, 'Ron': 1}),
+                  Counter({'Harry': 1, 'Ron': 2, 'Hermione': 1}),
+                  Counter({'Hermione': 2, 'Neville': 1}),
+                  Counter({'Neville': 4})]
+    for par_id, people in enumerate(paragraphs):
+        stats.add_paragraph(7, par_id, paragraph_words(people=people))
+    book = SimpleNamespace(id=7, corpus=SimpleNamespace(stats=stats),
+                           words=stats.totals(doc_id=7))
+    graph = Graph(book)
+    graph.create_graph(3)
+    top = dict(Counter(book.words['people']).most_common(3))
+    assert dict(graph.G.nodes(data='weight')) == top
+    expected = Counter()
+    for people in paragraphs:
+        for p1 in people:
+            for p2 in people:
+                if p1 in top and p2 in top and p1 != p2:
+                    expected[frozenset((p1, p2))] += people[p1] + people[p2]
+    assert {frozenset((u, v)): w for u, v, w in graph.G.edges(data='weight')} \
+        == dict(expected)
+    u, v, w = next(iter(graph.G.edges(data='weight')))
+    graph.set_weights()
+    p1, p2 = w/top[u], w/top[v]
+    assert math.isclose(graph.G[u][v]['weight'],
+                        max(p1*math.pow(p2, 0.8), p2*math.pow(p1, 0.8)))
+
+
+def test_cooccurrence_partials():
+    from collections import Counter
+    from pensieve.graph import Cooccurrence, Timeline, merge_partials
+    from pensieve.stats import EntityStats
+    from helpers import paragraph_words
+    stats = EntityStats()
+    books = {1: [Counter({'Harry': 3, 'Ron': 1}),
+                 Counter({'Harry': 1, 'Ron': 2, 'Hermione': 1}),
+                 Counter(),
+                 Counter({'Hermione': 2, 'Neville': 1})],
+             2: [Counter({'Neville': 4, 'Luna': 1}),
+                 Counter({'Harry': 2, 'Luna': 1})]}
+    for doc_id, paragraphs in books.items():
+        for par_id, people in enumerate(paragraphs):
+            stats.add_paragraph(doc_id, par_id,
+                                paragraph_words(people=people))
+    partials = [Cooccurrence.from_stats(stats, doc_id, len(paragraphs), 2)
+                for doc_id, paragraphs in books.items()]
+    # Merging the doc partials matches the whole corpus at once
+    total = merge_partials(partials)
+    assert total.n_paragraphs == 6
+    people = total.top(5)
+    _, _, counts = stats.paragraph_matrix('people', people)
+    from pensieve.graph import cooccurrence
+    mentions, weights = total.select(people)
+    assert (weights == cooccurrence(counts).toarray()).all()
+    assert mentions.tolist() == counts.sum(axis=0).A1.tolist()
+    assert people[0] == 'Harry'
+    reverse = merge_partials(partials[::-1])
+    assert (reverse.select(people)[1] == weights).all()
+    # Windows of blocks are differences of cumulative sums
+    timeline = Timeline(partials, people)
+    assert timeline.blocks == [(0, 0), (0, 2), (1, 0)]
+    window_mentions, window_weights = timeline.window(0, len(timeline))
+    assert (window_weights == weights).all()
+    assert (window_mentions == mentions).all()
+    windows = list(timeline.sliding(2))
+    assert [(start, stop) for start, stop, _, _ in windows] == [(0, 2), (1, 3)]
+    G = timeline.graph(2, 3)
+    assert G['Neville']['Luna']['weight'] == 2*(4 + 1)
+    assert not G.has_edge('Harry', 'Ron')
+
+
+def test_graph_export(tmp_path):
+    import json
+    import networkx as nx
+    from pensieve.graph import Graph, LayoutCache, build_graph, graph_key
+    people = ['Harry', 'Ron', 'Hermione', 'Neville']
+    weights = [[0, 8, 4, 0], [8, 0, 6, 0], [4, 6, 0, 2], [0, 0, 2, 0]]
+    graph = Graph()
+    graph.G = build_graph(people, [10, 6, 5, 3], weights)
+    cache = LayoutCache(str(tmp_path / 'layouts'))
+    pos = graph.layout(cache=cache)
+    assert set(pos) == set(people)
+    key = graph_key(graph.G, 'auto', 0)
+    assert key == graph_key(build_graph(people[::-1], [3, 5, 6, 10],
+                                        [row[::-1] for row in weights[::-1]]),
+                            'auto', 0)
+    # The same content is read back from the cache, not laid out again
+    again = Graph()
+    again.G = graph.G.copy()
+    cached = again.layout(cache=cache)
+    assert all((cached[node] == pos[node]).all() for node in people)
+    # A changed graph starts from the previous positions
+    graph.G.add_edge('Neville', 'Luna', weight=2, thickness=1)
+    graph.G.nodes['Luna']['weight'] = 1
+    assert set(graph.layout(cache=cache)) == set(people) | {'Luna'}
+    assert len(graph.layout(method='spectral')) == 5
+    graph.export(str(tmp_path / 'g.gexf'))
+    graph.export(str(tmp_path / 'g.graphml'))
+    graph.export(str(tmp_path / 'g.json'))
+    G = nx.read_graphml(str(tmp_path / 'g.graphml'))
+    assert G.nodes['Luna']['x'] == graph.pos['Luna'][0]
+    G = nx.read_gexf(str(tmp_path / 'g.gexf'))
+    assert G.nodes['Ron']['viz']['position']['y'] == graph.pos['Ron'][1]
+    with open(str(tmp_path / 'g.json')) as f:
+        data = json.load(f)
+    assert len(data['nodes']) == 5 and len(data['links']) == 5
+    graph.render(str(tmp_path / 'g.png'))
+    graph.render(str(tmp_path / 'g.svg'))
+    assert (tmp_path / 'g.png').read_bytes()[:4] == b'\x89PNG'
+    assert b'<svg' in (tmp_path / 'g.svg').read_bytes()
+
+
+def test_instrumentation(corpus_dir, tmpdir):
+    import json
+    from pensieve.instrument import NULL_STAGE, Instrumentation, stage
+    assert stage('parse') is NULL_STAGE
+    events = []
+    with Instrumentation(callback=events.append, profile='serialize') as run:
+        corpus = pensieve.Corpus(corpus_dir)
+        doc = corpus.docs[0]
+        doc.paragraph_texts
+        doc.text
+        with stage('serialize', doc.id) as outer:
+            with stage('images', doc.id, items_in=3) as inner:
+                inner.items_out = 2
+            outer.bytes = 10
+        with stage('serialize', doc.id):
+            pass
+    assert stage('parse') is NULL_STAGE
+    segment = run.stats[(doc.id, 'segment')]
+    assert segment.calls == 1 and segment.items_out == 3
+    assert segment.bytes == os.path.getsize(doc.path_to_text)
+    assert run.stats[(doc.id, 'read')].bytes == segment.bytes
+    serialize = run.stats[(doc.id, 'serialize')]
+    images = run.stats[(doc.id, 'images')]
+    assert serialize.calls == 2 and serialize.bytes == 10
+    assert images.items_in == 3 and images.items_out == 2
+    assert serialize.self_seconds <= serialize.seconds - images.seconds + 1e-9
+    assert [event['stage'] for event in events] == \
+        ['segment', 'read', 'images', 'serialize', 'serialize']
+    # Stats of a worker process merge into the totals
+    worker = Instrumentation()
+    worker.stats[(5, 'parse')] = pensieve.instrument.StageStats(1, 2., 2., 3, 3)
+    run.merge(worker.stats_json())
+    path = str(tmpdir.join('report.json'))
+    run.save(path)
+    with open(path) as f:
+        report = json.load(f)
+    assert report['hottest'] == 'parse'
+    assert report['docs']['5']['parse']['items_out'] == 3
+    assert set(report['stages']) == {'segment', 'read', 'serialize', 'images',
+                                     'parse'}
+    assert report['profiled'] == 'serialize'
+    assert 'function calls' in report['profile']
+
+
+def test_instrumentation_merges_worker_profiles():
+    import pickle
+    from pensieve.instrument import Instrumentation, stage
+    run = Instrumentation(profile='parse', profile_lines=5)
+    # A worker runs with the parent's settings and sends back pickles
+    with Instrumentation(**run.settings()) as worker:
+        with stage('parse', 1):
+            sorted(range(1000))
+    stats, profiles = pickle.loads(pickle.dumps(
+        (worker.stats_json(), worker.profile_data())))
+    run.merge(stats, profiles)
+    run.merge(stats, profiles)
+    assert run.stats[(1, 'parse')].calls == 2
+    assert run.profiled() == 'parse'
+    assert 'sorted' in run.profile_text()